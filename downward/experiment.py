@@ -19,6 +19,7 @@ A module for running Fast Downward experiments.
 """
 
 from collections import defaultdict, OrderedDict
+import itertools
 import logging
 import os.path
 
@@ -36,6 +37,48 @@ def _get_solver_resource_name(cached_rev):
     return "fast_downward_" + cached_rev.name
 
 
+def _get_driver_options(driver_options):
+    return [
+        "--validate",
+        "--overall-time-limit",
+        "30m",
+        "--overall-memory-limit",
+        "3584M",
+    ] + (driver_options or [])
+
+
+def _get_overall_memory_limit(driver_options):
+    """Return the memory limit (in MiB) that the driver options set.
+
+    >>> _get_overall_memory_limit(["--overall-memory-limit", "3584M"])
+    3584
+    >>> _get_overall_memory_limit(["--overall-memory-limit=2G", "--validate"])
+    2048
+    >>> _get_overall_memory_limit(["--search-memory-limit", "512"]) is None
+    True
+    >>> _get_overall_memory_limit(["--search-time-limit", 10, "--validate"]) is None
+    True
+    >>> _get_overall_memory_limit(["--overall-memory-limit", 512])
+    512
+    """
+    limit = None
+    # Options may be numbers, e.g., the values of time limits.
+    options = (str(option) for option in driver_options)
+    for option in options:
+        if option == "--overall-memory-limit":
+            limit = next(options, None)
+        elif option.startswith("--overall-memory-limit="):
+            limit = option.partition("=")[2]
+    if not limit:
+        return None
+    # Fast Downward interprets numbers without a suffix as MiB.
+    factors = {"K": 1 / 1024, "M": 1, "G": 1024}
+    factor = factors.get(limit[-1].upper())
+    if factor is None:
+        return int(limit)
+    return int(int(limit[:-1]) * factor)
+
+
 class FastDownwardRun(Run):
     def __init__(self, exp, algo, task):
         Run.__init__(self, exp)
@@ -51,48 +94,145 @@ class FastDownwardRun(Run):
             "problem", self.task.problem_file, "problem.pddl", symlink=True
         )
 
-        self.add_command(
-            "planner",
-            [tools.get_python_executable()]
-            + ["{" + _get_solver_resource_name(algo.cached_revision) + "}"]
-            + algo.driver_options
-            + ["{domain}", "{problem}"]
-            + algo.component_options,
-        )
+        self.add_command("planner", algo.planner_command)
+
+    def _get_memory_limit(self):
+        limits = [
+            limit
+            for limit in [
+                Run._get_memory_limit(self),
+                _get_overall_memory_limit(self.algo.driver_options),
+            ]
+            if limit is not None
+        ]
+        return max(limits, default=None)
 
     def _set_properties(self):
         self.set_property("algorithm", self.algo.name)
-        self.set_property("repo", self.algo.cached_revision.repo)
-        self.set_property("local_revision", self.algo.cached_revision.local_rev)
-        self.set_property("global_revision", self.algo.cached_revision.global_rev)
-        self.set_property("revision_summary", self.algo.cached_revision.summary)
-        self.set_property("build_options", self.algo.cached_revision.build_options)
-        self.set_property("driver_options", self.algo.driver_options)
-        self.set_property("component_options", self.algo.component_options)
+        # All runs of an algorithm share these properties.
+        self.add_property_group(
+            {
+                "repo": self.algo.cached_revision.repo,
+                "local_revision": self.algo.cached_revision.local_rev,
+                "global_revision": self.algo.cached_revision.global_rev,
+                "revision_summary": self.algo.cached_revision.summary,
+                "build_options": self.algo.cached_revision.build_options,
+                "driver_options": self.algo.driver_options,
+                "component_options": self.algo.component_options,
+                "experiment_name": self.experiment.name,
+            }
+        )
 
         for key, value in self.task.properties.items():
             self.set_property(key, value)
 
-        self.set_property("experiment_name", self.experiment.name)
-
         self.set_property("id", [self.algo.name, self.task.domain, self.task.problem])
 
 
+class _FastDownwardRunRecord:
+    """Compact placeholder for a FastDownwardRun.
+
+    The experiment stores one record per algorithm and task and only
+    creates the FastDownwardRun while the run is written to disk. This
+    keeps the memory usage of the experiment script low for large
+    experiments. All records of an algorithm or task share its data.
+
+    Scripts may still treat the entries of ``exp.runs`` as runs, e.g.,
+    to set properties before building the experiment. Accessing any
+    other attribute creates the FastDownwardRun and keeps it, so that
+    the changes are written to disk.
+    """
+
+    __slots__ = ["experiment", "algo", "task", "_run"]
+
+    def __init__(self, experiment, algo, task):
+        self.experiment = experiment
+        self.algo = algo
+        self.task = task
+        self._run = None
+
+    def _expand(self):
+        if self._run is not None:
+            return self._run
+        return FastDownwardRun(self.experiment, self.algo, self.task)
+
+    def __getattr__(self, name):
+        if name == "_run" or name.startswith("__"):
+            raise AttributeError(name)
+        if self._run is None:
+            self._run = FastDownwardRun(self.experiment, self.algo, self.task)
+        return getattr(self._run, name)
+
+
 class _DownwardAlgorithm:
     def __init__(self, name, cached_revision, driver_options, component_options):
         self.name = name
         self.cached_revision = cached_revision
         self.driver_options = driver_options
         self.component_options = component_options
+        # All runs of this algorithm share the planner command.
+        self.planner_command = (
+            [tools.get_python_executable()]
+            + ["{" + _get_solver_resource_name(cached_revision) + "}"]
+            + driver_options
+            + ["{domain}", "{problem}"]
+            + component_options
+        )
 
-    def __eq__(self, other):
-        """Return true iff all components (excluding the name) match."""
+    def _get_key(self):
         return (
-            self.cached_revision == other.cached_revision
-            and self.driver_options == other.driver_options
-            and self.component_options == other.component_options
+            self.cached_revision.name,
+            tuple(self.driver_options),
+            tuple(self.component_options),
         )
 
+    def __eq__(self, other):
+        """Return true iff all components (excluding the name) match."""
+        return self._get_key() == other._get_key()
+
+    def __hash__(self):
+        return hash(self._get_key())
+
+
+class _AlgorithmSweep:
+    """Lazily expand option axes into algorithms (see
+    :meth:`FastDownwardExperiment.add_algorithm_sweep`)."""
+
+    def __init__(self, name, cached_revision, component_options, driver_options, axes):
+        self.name = name
+        self.cached_revision = cached_revision
+        self.component_options = component_options
+        self.driver_options = driver_options
+        # Map each axis to a list of (label, value) pairs.
+        self.axes = OrderedDict()
+        for axis, values in axes.items():
+            if isinstance(values, dict):
+                self.axes[axis] = list(values.items())
+            else:
+                self.axes[axis] = [(str(value), value) for value in values]
+            if not self.axes[axis]:
+                logging.critical(f"Axis {axis} of sweep {name} has no values.")
+
+    def __len__(self):
+        size = 1
+        for values in self.axes.values():
+            size *= len(values)
+        return size
+
+    def __iter__(self):
+        for combination in itertools.product(*self.axes.values()):
+            labels = {axis: label for axis, (label, _) in zip(self.axes, combination)}
+            values = {axis: value for axis, (_, value) in zip(self.axes, combination)}
+            try:
+                yield _DownwardAlgorithm(
+                    self.name.format(**labels),
+                    self.cached_revision,
+                    [option.format(**values) for option in self.driver_options],
+                    [option.format(**values) for option in self.component_options],
+                )
+            except (KeyError, IndexError) as err:
+                logging.critical(f"Sweep {self.name} uses undefined axis {err}.")
+
 
 class FastDownwardExperiment(Experiment):
     """Conduct a Fast Downward experiment.
@@ -137,10 +277,12 @@ class FastDownwardExperiment(Experiment):
     #: "planner_wall_clock_time".
     PLANNER_PARSER = os.path.join(DOWNWARD_SCRIPTS_DIR, "planner-parser.py")
 
-    def __init__(self, path=None, environment=None, revision_cache=None):
+    def __init__(
+        self, path=None, environment=None, revision_cache=None, run_dir_layout=None
+    ):
         """
         See :class:`lab.experiment.Experiment` for an explanation of
-        the *path* and *environment* parameters.
+        the *path*, *environment* and *run_dir_layout* parameters.
 
         *revision_cache* is the directory for caching Fast Downward
         revisions. It defaults to ``<scriptdir>/data/revision-cache``.
@@ -164,7 +306,9 @@ class FastDownwardExperiment(Experiment):
         >>> exp.add_parser(exp.PLANNER_PARSER)
 
         """
-        Experiment.__init__(self, path=path, environment=environment)
+        Experiment.__init__(
+            self, path=path, environment=environment, run_dir_layout=run_dir_layout
+        )
 
         self.revision_cache = revision_cache or os.path.join(
             get_default_data_dir(), "revision-cache"
@@ -174,6 +318,10 @@ class FastDownwardExperiment(Experiment):
 
         # Use OrderedDict to ensure that names are unique and ordered.
         self._algorithms = OrderedDict()
+        # Map each algorithm to itself for detecting duplicates quickly.
+        self._algorithm_registry = {}
+        self._algorithm_sweeps = []
+        self._cached_revisions = {}
 
     def _get_tasks(self):
         tasks = []
@@ -300,29 +448,97 @@ class FastDownwardExperiment(Experiment):
         """
         if not isinstance(name, str):
             logging.critical(f"Algorithm name must be a string: {name}")
-        if name in self._algorithms:
-            logging.critical(f"Algorithm names must be unique: {name}")
-        build_options = build_options or []
-        driver_options = [
-            "--validate",
-            "--overall-time-limit",
-            "30m",
-            "--overall-memory-limit",
-            "3584M",
-        ] + (driver_options or [])
-        algorithm = _DownwardAlgorithm(
-            name,
-            CachedFastDownwardRevision(repo, rev, build_options),
-            driver_options,
-            component_options,
+        self._register_algorithm(
+            _DownwardAlgorithm(
+                name,
+                self._get_cached_revision(repo, rev, build_options),
+                _get_driver_options(driver_options),
+                component_options,
+            )
         )
-        for algo in self._algorithms.values():
-            if algorithm == algo:
-                logging.critical(
-                    "Algorithms {algo.name} and {algorithm.name} are "
-                    "identical.".format(**locals())
-                )
-        self._algorithms[name] = algorithm
+
+    def add_algorithm_sweep(
+        self,
+        name,
+        repo,
+        rev,
+        component_options,
+        build_options=None,
+        driver_options=None,
+        **axes,
+    ):
+        """
+        Add an algorithm for each combination of option values.
+
+        Each keyword argument in *axes* defines an axis of the sweep.
+        Its value is either a list of option values or a dictionary
+        that maps short labels to option values. The sweep contains
+        the cross product of all axes. In each combination,
+        ``{axis}`` placeholders in *component_options* and
+        *driver_options* are replaced by the option value of the axis
+        and placeholders in *name* are replaced by the label (or, for
+        lists, by the value). Literal braces must be doubled.
+
+        All other parameters are the same as for :meth:`.add_algorithm`.
+        The sweep is only expanded when the experiment is built, so
+        adding large sweeps is cheap. Algorithm names must be unique
+        and algorithms must not be identical across all sweeps and
+        algorithms.
+
+        Example::
+
+            exp.add_algorithm_sweep(
+                "{search}-{h}-{w}", repo, rev,
+                ["--search", "{search}([{h}()], w={w})"],
+                search={"lazy": "lazy_wastar", "eager": "eager_wastar"},
+                h=["ff", "cg", "cea"],
+                w=[1, 2, 5])
+
+        This adds 18 algorithms, e.g., ``lazy-ff-1`` with the search
+        component ``lazy_wastar([ff()], w=1)``.
+
+        """
+        if not isinstance(name, str):
+            logging.critical(f"Algorithm name must be a string: {name}")
+        if not axes:
+            logging.critical(f"Sweep {name} needs at least one axis.")
+        self._algorithm_sweeps.append(
+            _AlgorithmSweep(
+                name,
+                self._get_cached_revision(repo, rev, build_options),
+                component_options,
+                _get_driver_options(driver_options),
+                axes,
+            )
+        )
+
+    def _get_cached_revision(self, repo, rev, build_options):
+        # Avoid calling the version control system for each algorithm.
+        build_options = build_options or []
+        key = (repo, rev, tuple(build_options))
+        if key not in self._cached_revisions:
+            self._cached_revisions[key] = CachedFastDownwardRevision(
+                repo, rev, build_options
+            )
+        return self._cached_revisions[key]
+
+    def _register_algorithm(self, algorithm):
+        if algorithm.name in self._algorithms:
+            logging.critical(f"Algorithm names must be unique: {algorithm.name}")
+        existing = self._algorithm_registry.get(algorithm)
+        if existing is not None:
+            logging.critical(
+                f"Algorithms {existing.name} and {algorithm.name} are identical."
+            )
+        self._algorithm_registry[algorithm] = algorithm
+        self._algorithms[algorithm.name] = algorithm
+
+    def _expand_algorithm_sweeps(self):
+        for sweep in self._algorithm_sweeps:
+            logging.info(f"Adding {len(sweep)} algorithms for sweep {sweep.name}")
+            for algorithm in sweep:
+                self._register_algorithm(algorithm)
+        self._algorithm_sweeps = []
 
     def build(self, **kwargs):
         """Add Fast Downward code, runs and write everything to disk.
@@ -330,6 +546,7 @@ class FastDownwardExperiment(Experiment):
         This method is called by the second experiment step.
 
         """
+        self._expand_algorithm_sweeps()
         if not self._algorithms:
             logging.critical("You must add at least one algorithm.")
 
@@ -365,7 +582,9 @@ class FastDownwardExperiment(Experiment):
         for cached_rev in self._get_unique_cached_revisions():
             cache_path = os.path.join(self.revision_cache, cached_rev.name)
             dest_path = "code-" + cached_rev.name
-            self.add_resource("", cache_path, dest_path)
+            # Hard-link the cached revision to avoid copying it for each
+            # experiment.
+            self.add_resource("", cache_path, dest_path, hardlink=True)
             # Overwrite the script to set an environment variable.
             self.add_resource(
                 _get_solver_resource_name(cached_rev),
@@ -374,6 +593,7 @@ class FastDownwardExperiment(Experiment):
             )
 
     def _add_runs(self):
+        tasks = self._get_tasks()
         for algo in self._algorithms.values():
-            for task in self._get_tasks():
-                self.add_run(FastDownwardRun(self, algo, task))
+            for task in tasks:
+                self.add_run(_FastDownwardRunRecord(self, algo, task))
@@ -140,6 +140,10 @@ exp.add_step("build", exp.build)
 # Add step that executes all runs.
 exp.add_step("start", exp.start_runs)
 
+# Add step that shows the progress of the runs (use it in a second
+# terminal while the runs are executed).
+exp.add_step("status", exp.show_status)
+
 # Add step that collects properties from run directories and
 # writes them to *-eval/properties.
 exp.add_fetcher(name="fetch")
@@ -0,0 +1,171 @@
+# Lab is a Python package for evaluating algorithms.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pack the run directories of an experiment into a single archive.
+
+Experiments that are built with ``exp.build(archive=True)`` don't write
+a directory for each run. Instead, all run directories are stored in
+the uncompressed tar file ``runs.tar``. The members of each run are
+stored consecutively and the index file ``runs.tar.index`` holds the
+start and end offset of each run, so a job can extract its own run
+with a single read and without touching the files of other runs.
+"""
+
+import io
+import logging
+import os
+import struct
+import tarfile
+import time
+
+from lab import tools
+from lab.tools import json
+
+
+RUN_ARCHIVE_FILENAME = "runs.tar"
+RUN_ARCHIVE_INDEX_FILENAME = "runs.tar.index"
+
+# Start and end offsets are stored as little-endian unsigned 64-bit integers.
+_RANGE_FORMAT = "<QQ"
+_RANGE_SIZE = struct.calcsize(_RANGE_FORMAT)
+
+
+class RunArchiveWriter:
+    """Write run directories in run ID order to the archive in *exp_dir*."""
+
+    def __init__(self, exp_dir):
+        self.exp_dir = os.path.abspath(exp_dir)
+        self.tar = tarfile.open(
+            os.path.join(exp_dir, RUN_ARCHIVE_FILENAME),
+            mode="w",
+            format=tarfile.PAX_FORMAT,
+        )
+        self.index_file = open(os.path.join(exp_dir, RUN_ARCHIVE_INDEX_FILENAME), "wb")
+        self.mtime = int(time.time())
+
+    def _get_tarinfo(self, name, type):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mtime = self.mtime
+        return info
+
+    def _add_file(self, name, data, mode):
+        info = self._get_tarinfo(name, tarfile.REGTYPE)
+        info.size = len(data)
+        info.mode = mode
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def _add_path(self, path, name):
+        # Add each file on its own: tarfile.add() would store files that
+        # share an inode with a file of a different run as hard links.
+        info = self.tar.gettarinfo(path, arcname=name)
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        if os.path.isdir(path):
+            info.type = tarfile.DIRTYPE
+            self.tar.addfile(info)
+            for child in sorted(os.listdir(path)):
+                self._add_path(os.path.join(path, child), f"{name}/{child}")
+        elif os.path.islink(path):
+            self.tar.addfile(info)
+        else:
+            info.type = tarfile.REGTYPE
+            info.size = os.path.getsize(path)
+            with open(path, "rb") as f:
+                self.tar.addfile(info, f)
+
+    def add(self, spec, properties_filename):
+        """Add the run described by the run specification *spec*.
+
+        The format of *spec* is the same as for compact experiments
+        (see :mod:`lab.runner`). The static properties are written to
+        *properties_filename*.
+        """
+        start = self.tar.offset
+        run_dir = spec["run_dir"]
+        abs_run_dir = os.path.join(self.exp_dir, run_dir)
+        info = self._get_tarinfo(run_dir, tarfile.DIRTYPE)
+        info.mode = 0o755
+        self.tar.addfile(info)
+        for dest, content, permissions in spec["new_files"]:
+            self._add_file(f"{run_dir}/{dest}", tools.get_bytes(content), permissions)
+        for source, dest, symlink in spec["resources"]:
+            name = f"{run_dir}/{dest}"
+            if symlink:
+                info = self._get_tarinfo(name, tarfile.SYMTYPE)
+                # Runs are extracted elsewhere, so only links to files in
+                # the experiment directory may be relative.
+                if source.startswith(self.exp_dir + os.sep):
+                    info.linkname = os.path.relpath(source, start=abs_run_dir)
+                else:
+                    info.linkname = source
+                self.tar.addfile(info)
+            else:
+                self._add_path(source, name)
+        props = tools.Properties()
+        props.update(spec["properties"])
+        self._add_file(
+            f"{run_dir}/{properties_filename}", tools.get_bytes(str(props)), 0o644
+        )
+        self.index_file.write(struct.pack(_RANGE_FORMAT, start, self.tar.offset))
+
+    def close(self):
+        self.tar.close()
+        self.index_file.close()
+
+
+def has_run_archive(exp_dir):
+    return os.path.exists(os.path.join(exp_dir, RUN_ARCHIVE_FILENAME))
+
+
+def _open_run(exp_dir, run_id):
+    with open(os.path.join(exp_dir, RUN_ARCHIVE_INDEX_FILENAME), "rb") as f:
+        f.seek((run_id - 1) * _RANGE_SIZE)
+        data = f.read(_RANGE_SIZE)
+    if len(data) != _RANGE_SIZE:
+        logging.critical(f"There is no run with ID {run_id} in {exp_dir}")
+    start, end = struct.unpack(_RANGE_FORMAT, data)
+    with open(os.path.join(exp_dir, RUN_ARCHIVE_FILENAME), "rb") as f:
+        f.seek(start)
+        return tarfile.open(fileobj=io.BytesIO(f.read(end - start)), mode="r:")
+
+
+def extract_run(exp_dir, run_id, dest_dir):
+    """Extract the run with the given (1-based) ID into *dest_dir*.
+
+    Return the relative run directory, i.e., the run ends up in
+    ``dest_dir/<run_dir>``.
+    """
+    # The archive is trusted, but newer Python versions warn about
+    # extracting archives without a filter.
+    kwargs = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+    with _open_run(exp_dir, run_id) as tar:
+        members = tar.getmembers()
+        tar.extractall(dest_dir, members=members, **kwargs)
+    return members[0].name
+
+
+def read_static_run_properties(exp_dir, filename):
+    """Yield the relative run directory and static properties of all runs.
+
+    *filename* is the name of the static properties file in each run.
+    """
+    with tarfile.open(os.path.join(exp_dir, RUN_ARCHIVE_FILENAME), mode="r|") as tar:
+        for member in tar:
+            run_dir, _, name = member.name.rpartition("/")
+            if name == filename and member.isfile():
+                content = tools.get_string(tar.extractfile(member).read())
+                yield run_dir, json.loads(content)
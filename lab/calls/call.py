@@ -13,26 +13,139 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import codecs
 import errno
+import io
 import logging
 import os
-import resource
 import select
+import signal
+import stat
 import subprocess
 import sys
+import threading
 import time
 
 from lab import tools
+from lab.calls.limits import get_limit_backend
 
 
-def set_limit(kind, soft_limit, hard_limit):
+# Seconds between two checks of the files that a process writes directly.
+MONITOR_INTERVAL = 0.1
+
+# Maximum number of bytes that are moved from a pipe to a stream at once.
+CHUNK_SIZE = 2**16
+
+# Seconds between SIGTERM and SIGKILL when a command is aborted.
+KILL_GRACE_PERIOD = 5
+
+# Signals that we pass on to the command while waiting for it.
+FORWARDED_SIGNALS = [signal.SIGINT, signal.SIGTERM]
+
+# Resource usage that is stored as "<call name>_<attribute>" for each call.
+RESOURCE_USAGE_ATTRIBUTES = [
+    "wall_time",
+    "cpu_time",
+    "peak_rss",
+    "voluntary_context_switches",
+    "involuntary_context_switches",
+    "block_reads",
+    "block_writes",
+    "peak_memory",
+    "kill_reason",
+]
+
+
+def _is_regular_file(stream):
     try:
-        resource.setrlimit(kind, (soft_limit, hard_limit))
-    except (OSError, ValueError) as err:
-        logging.error(
-            f"Resource limit for {kind} could not be set to "
-            f"[{soft_limit}, {hard_limit}] ({err})"
-        )
+        return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+class _Output:
+    """Output of a process that goes to *stream* with soft and hard limits
+    (in bytes).
+
+    If *stream* is a regular file, the process writes to it directly and
+    the number of written bytes is the growth of the file. Otherwise,
+    the output is copied from a pipe to the stream (see :meth:`copy`).
+    """
+
+    def __init__(self, stream, soft_limit, hard_limit):
+        self.stream = stream
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.exceeded_hard_limit = False
+        self.aborted_process = False
+        # Write pending data before the process appends to the stream.
+        stream.flush()
+        self.direct = _is_regular_file(stream)
+        if self.direct:
+            self.start = os.fstat(stream.fileno()).st_size
+        self.bytes_written = 0
+        self.pipe = None
+        self._splice = hasattr(os, "splice")
+        self._decoder = None
+
+    def get_bytes_written(self):
+        if self.direct:
+            return os.fstat(self.stream.fileno()).st_size - self.start
+        return self.bytes_written
+
+    def _write(self, data):
+        try:
+            os.write(self.stream.fileno(), data)
+        except (AttributeError, OSError, ValueError):
+            if isinstance(self.stream, io.TextIOBase):
+                # Don't split multi-byte characters at chunk boundaries.
+                if self._decoder is None:
+                    self._decoder = codecs.getincrementaldecoder(
+                        tools.DEFAULT_ENCODING
+                    )(errors="replace")
+                self.stream.write(self._decoder.decode(data))
+            else:
+                self.stream.write(data)
+
+    def copy(self):
+        """Move the available data from the pipe to the stream.
+
+        Data beyond the hard limit is discarded. Return False when the
+        pipe is closed.
+        """
+        pipe_fd = self.pipe.fileno()
+        room = CHUNK_SIZE
+        if self.hard_limit is not None:
+            room = min(room, self.hard_limit - self.bytes_written)
+        if room <= 0:
+            data = os.read(pipe_fd, CHUNK_SIZE)
+            if data:
+                self.exceeded_hard_limit = True
+            return bool(data)
+        if self._splice:
+            try:
+                moved = os.splice(pipe_fd, self.stream.fileno(), room)
+            except (AttributeError, OSError, ValueError):
+                # The stream doesn't support splicing, copy the data instead.
+                self._splice = False
+            else:
+                self.bytes_written += moved
+                return moved > 0
+        data = os.read(pipe_fd, room)
+        self._write(data)
+        self.bytes_written += len(data)
+        return bool(data)
+
+    def finish(self):
+        """Discard the output beyond the hard limit and flush the stream."""
+        if self.direct:
+            if self.exceeded_hard_limit:
+                os.truncate(self.stream.fileno(), self.start + self.hard_limit)
+            # The process has moved the file offset, so update the stream.
+            self.stream.seek(0, os.SEEK_END)
+        elif self._decoder is not None:
+            self.stream.write(self._decoder.decode(b"", final=True))
+        self.stream.flush()
 
 
 class Call:
@@ -46,6 +159,11 @@ class Call:
         hard_stdout_limit=None,
         soft_stderr_limit=None,
         hard_stderr_limit=None,
+        fsync=True,
+        properties_file="properties",
+        limit_backend="rlimit",
+        logger=None,
+        forward_signals=True,
         **kwargs,
     ):
         """Make system calls with time and memory constraints.
@@ -53,12 +171,51 @@ class Call:
         *args* and *kwargs* are passed to `subprocess.Popen
         <http://docs.python.org/library/subprocess.html>`_.
 
+        If *fsync* is True, the redirected output is forced to disk
+        before :meth:`wait` returns.
+
+        :meth:`wait` adds the resource usage of the process (see
+        :meth:`get_resource_usage`) to the JSON file *properties_file*.
+        It defaults to the ``properties`` file in the current directory,
+        i.e., the run directory. Pass None to disable this.
+
+        *limit_backend* selects how the time and memory limits are
+        enforced (see :mod:`lab.calls.limits`).
+
+        The command runs in its own process group. If it exceeds the
+        wall-clock time limit or a hard output limit, the whole group
+        receives SIGTERM and, after :data:`KILL_GRACE_PERIOD` seconds,
+        SIGKILL. Processes of the group that outlive the command are
+        killed when it exits.
+
+        Commands write directly to output streams that are regular
+        files. Their size is only checked every :data:`MONITOR_INTERVAL`
+        seconds, so the file may temporarily grow beyond the hard limit
+        by what the command writes in this time. The group is then
+        killed with SIGKILL right away and the file is truncated to the
+        hard limit afterwards. Output to other streams never exceeds
+        the hard limit. If *forward_signals* is True, SIGINT and
+        SIGTERM are passed on to the group while we wait for the
+        command.
+
+        Messages about the command go to *logger* (default: the root
+        logger).
+
+        Instead of blocking in :meth:`wait`, callers that supervise many
+        commands can call :meth:`poll` regularly until it returns the
+        exit code and then call :meth:`finish`. This is only supported
+        if the output goes to regular files.
+
         See also the documentation for
         ``lab.experiment._Buildable.add_command()``.
 
         """
         assert "stdin" not in kwargs, "redirecting stdin is not supported"
         self.name = name
+        self.logger = logger or logging.getLogger()
+        self.time_limit = time_limit
+        self.fsync = fsync
+        self.properties_file = properties_file and os.path.abspath(properties_file)
 
         if time_limit is None:
             self.wall_clock_time_limit = None
@@ -78,37 +235,44 @@ class Call:
                 kwargs[stream_name] = file
                 self.opened_files.append(file)
 
-        # Allow redirecting and limiting the output to streams.
-        self.redirected_streams_and_limits = {}
+        # Allow redirecting and limiting the output to streams. Processes
+        # write directly to regular files. The output for other streams is
+        # copied from pipes.
+        self.outputs = {}
         for stream_name, soft_limit, hard_limit in [
             ("stdout", get_bytes(soft_stdout_limit), get_bytes(hard_stdout_limit)),
             ("stderr", get_bytes(soft_stderr_limit), get_bytes(hard_stderr_limit)),
         ]:
             stream = kwargs.pop(stream_name, None)
             if stream:
-                self.redirected_streams_and_limits[stream_name] = (
-                    stream,
-                    (soft_limit, hard_limit),
-                )
-                kwargs[stream_name] = subprocess.PIPE
+                output = _Output(stream, soft_limit, hard_limit)
+                self.outputs[stream_name] = output
+                kwargs[stream_name] = stream if output.direct else subprocess.PIPE
+
+        self.limits = get_limit_backend(limit_backend, name, time_limit, memory_limit)
+        preexec_fn = kwargs.pop("preexec_fn", None)
 
         def prepare_call():
-            # When the soft time limit is reached, SIGXCPU is emitted. Once we
-            # reach the higher hard time limit, SIGKILL is sent. Having some
-            # padding between the two limits allows programs to handle SIGXCPU.
-            if time_limit is not None:
-                set_limit(resource.RLIMIT_CPU, time_limit, time_limit + 5)
-            if memory_limit is not None:
-                _, hard_mem_limit = resource.getrlimit(resource.RLIMIT_AS)
-                # Convert memory from MiB to Bytes.
-                set_limit(
-                    resource.RLIMIT_AS, memory_limit * 1024 * 1024, hard_mem_limit
-                )
-            set_limit(resource.RLIMIT_CORE, 0, 0)
+            os.setpgid(0, 0)
+            self.limits.prepare_process()
+            if preexec_fn:
+                preexec_fn()
 
+        self.process = None
+        self.rusage = None
+        self.kill_reason = None
+        self.abort_time = None
+        self.killed_group = False
+        self.received_signal = None
+        self.old_handlers = {}
+        if forward_signals:
+            self._install_signal_handlers()
+        self.start_time = time.monotonic()
         try:
             self.process = subprocess.Popen(args, preexec_fn=prepare_call, **kwargs)
         except OSError as err:
+            self.limits.finish()
+            self._restore_signal_handlers()
             if err.errno == errno.ENOENT:
                 sys.exit(
                     'Error: Call {name} failed. "{path}" not found'.format(
@@ -117,122 +281,279 @@ class Call:
                 )
             else:
                 raise
+        for stream_name, output in self.outputs.items():
+            if not output.direct:
+                output.pipe = getattr(self.process, stream_name)
+
+    def _install_signal_handlers(self):
+        # Only the main thread may set signal handlers.
+        if threading.current_thread() is threading.main_thread():
+            for sig in FORWARDED_SIGNALS:
+                self.old_handlers[sig] = signal.signal(sig, self._forward_signal)
+
+    def _restore_signal_handlers(self):
+        for sig, handler in self.old_handlers.items():
+            signal.signal(sig, handler)
+        self.old_handlers = {}
+        if self.received_signal is not None:
+            # Let the original handler deal with the signal.
+            os.kill(os.getpid(), self.received_signal)
+
+    def _forward_signal(self, signum, frame):
+        self.logger.warning(f"{self.name} received signal {signum} -> abort command")
+        if self.received_signal is None:
+            self.received_signal = signum
+        self._abort("interrupted", signum)
+
+    def _signal_group(self, sig):
+        if self.process is None or self.rusage is not None:
+            return
+        try:
+            os.killpg(self.process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _abort(self, reason, sig=signal.SIGTERM):
+        """Send *sig* to the process group and SIGKILL after a grace period."""
+        if self.kill_reason is None:
+            self.kill_reason = reason
+        if self.abort_time is None:
+            self.abort_time = time.monotonic()
+        self._signal_group(sig)
+
+    def _check_hard_limits(self):
+        """Abort the process if it exceeded a hard output limit."""
+        for output in self.outputs.values():
+            if (
+                output.direct
+                and output.hard_limit is not None
+                and output.get_bytes_written() > output.hard_limit
+            ):
+                output.exceeded_hard_limit = True
+            if output.exceeded_hard_limit and not output.aborted_process:
+                output.aborted_process = True
+                self.logger.error(
+                    "{} wrote {} KiB (hard limit) to {} -> abort command".format(
+                        self.name, output.hard_limit / 1024, output.stream.name
+                    )
+                )
+                if output.direct:
+                    # Don't let the process fill the disk during the grace period.
+                    self._abort("output_limit", signal.SIGKILL)
+                    self.killed_group = True
+                else:
+                    self._abort("output_limit")
+
+    def _check_wall_clock_limit(self):
+        if self.wall_clock_time_limit is None or self.abort_time is not None:
+            return
+        wall_time = time.monotonic() - self.start_time
+        if wall_time > self.wall_clock_time_limit:
+            self.logger.error(
+                "wall-clock time for %s too high: %.2f > %d -> abort command"
+                % (self.name, wall_time, self.wall_clock_time_limit)
+            )
+            self._abort("wall_clock_time_limit")
+
+    def _monitor(self):
+        """Enforce the limits while the process runs."""
+        self._check_hard_limits()
+        self._check_wall_clock_limit()
+        self.limits.check()
+        if (
+            self.abort_time is not None
+            and not self.killed_group
+            and time.monotonic() - self.abort_time > KILL_GRACE_PERIOD
+        ):
+            self.killed_group = True
+            self._signal_group(signal.SIGKILL)
+
+    def _try_reap(self):
+        """Reap the process if it exited, record its resource usage and
+        return True iff it's gone."""
+        if self.rusage is not None:
+            return True
+        pid = self.process.pid
+        if hasattr(os, "waitid"):
+            # Kill the remaining processes of the group while the exited
+            # process still reserves the group ID.
+            if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+                return False
+            self._signal_group(signal.SIGKILL)
+        pid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if not pid:
+            return False
+        self.wall_time = time.monotonic() - self.start_time
+        self.rusage = rusage
+        self.limits_usage = self.limits.finish()
+        # Let the Popen object know that the process is gone.
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+
+        if self.kill_reason is None:
+            self.kill_reason = self.limits.kill_reason
+        if (
+            self.kill_reason is None
+            and self.time_limit is not None
+            and self.process.returncode in [-signal.SIGXCPU, -signal.SIGKILL]
+            and rusage.ru_utime + rusage.ru_stime >= self.time_limit
+        ):
+            self.kill_reason = "cpu_time_limit"
+        return True
+
+    def _reap(self):
+        """Wait for the process to exit and return its exit code.
+
+        While waiting, check the hard limits of the files that the
+        process writes directly and enforce the time limits.
+        """
+        delay = 0.001
+        last_check = time.monotonic()
+        while not self._try_reap():
+            time.sleep(delay)
+            # Poll quickly at first, so that short commands finish fast.
+            delay = min(2 * delay, MONITOR_INTERVAL)
+            if time.monotonic() - last_check >= MONITOR_INTERVAL:
+                self._monitor()
+                last_check = time.monotonic()
+        return self.process.returncode
+
+    def get_resource_usage(self):
+        """Return the resource usage of the finished process.
+
+        Keys are prefixed with the name of the call. Times are in
+        seconds, peak memory (resident set size) is in KiB. With the
+        cgroup limit backend, the CPU time and the peak memory
+        (``peak_memory``) cover all processes of the command. If we or
+        the limit backend stopped the command, ``kill_reason`` tells why.
+        """
+        rusage = self.rusage
+        # ru_maxrss is given in bytes on macOS and in KiB elsewhere.
+        peak_rss = rusage.ru_maxrss
+        if sys.platform == "darwin":
+            peak_rss //= 1024
+        usage = {
+            "wall_time": round(self.wall_time, 3),
+            "cpu_time": round(rusage.ru_utime + rusage.ru_stime, 3),
+            "peak_rss": peak_rss,
+            "voluntary_context_switches": rusage.ru_nvcsw,
+            "involuntary_context_switches": rusage.ru_nivcsw,
+            "block_reads": rusage.ru_inblock,
+            "block_writes": rusage.ru_oublock,
+        }
+        usage.update(self.limits_usage)
+        if self.kill_reason is not None:
+            usage["kill_reason"] = self.kill_reason
+        return {
+            f"{self.name}_{attribute}": usage[attribute]
+            for attribute in RESOURCE_USAGE_ATTRIBUTES
+            if attribute in usage
+        }
 
     def _redirect_streams(self):
         """
         Redirect output from original stdout and stderr streams to new
         streams if redirection is requested in the constructor and limit
-        the output written to the new streams.
+        the output written to the new streams until the process exits.
+        Return its exit code.
 
         Redirection could also be achieved py passing suitable
         parameters to Popen, but neither Popen.wait() nor
         Popen.communicate() allow limiting the redirected output.
 
-        Code adapted from the Python 2 version of subprocess.py.
+        Regular files are passed to the process, which writes to them
+        without any copying. Meanwhile, we check the file sizes every
+        MONITOR_INTERVAL seconds and abort the process if it exceeds a
+        hard limit. Output beyond the hard limit is cut off afterwards.
+        The output for other streams is moved in large binary chunks
+        from pipes to the streams.
         """
-        fd_to_infile = {}
-        fd_to_outfile = {}
-        fd_to_limits = {}
-        fd_to_bytes = {}
-
+        fd_to_output = {
+            output.pipe.fileno(): output
+            for output in self.outputs.values()
+            if output.pipe
+        }
         poller = select.poll()
+        for fd in fd_to_output:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
 
-        def register_and_append(file_obj, eventmask):
-            poller.register(file_obj.fileno(), eventmask)
-            fd_to_infile[file_obj.fileno()] = file_obj
-            fd_to_bytes[file_obj.fileno()] = 0
-
-        def close_unregister_and_remove(fd):
-            poller.unregister(fd)
-            fd_to_infile[fd].close()
-            fd_to_infile.pop(fd)
-
-        select_POLLIN_POLLPRI = select.POLLIN | select.POLLPRI
-
-        for (
-            stream_name,
-            (new_stream, limits),
-        ) in self.redirected_streams_and_limits.items():
-            old_stream = getattr(self.process, stream_name)
-            register_and_append(old_stream, select_POLLIN_POLLPRI)
-            fd = old_stream.fileno()
-            fd_to_outfile[fd] = new_stream
-            fd_to_limits[fd] = limits
-
-        while fd_to_infile:
-            try:
-                ready = poller.poll()
-            except OSError as e:
-                if e.args[0] == errno.EINTR:
-                    continue
-                raise
+        last_check = time.monotonic()
+        while fd_to_output:
+            for fd, _ in poller.poll(MONITOR_INTERVAL * 1000):
+                output = fd_to_output[fd]
+                if not output.copy():
+                    poller.unregister(fd)
+                    output.pipe.close()
+                    del fd_to_output[fd]
+            self._check_hard_limits()
+            if time.monotonic() - last_check >= MONITOR_INTERVAL:
+                self._monitor()
+                # Once the process exits, its leftover children are
+                # killed, so they can't keep the pipes open.
+                self._try_reap()
+                last_check = time.monotonic()
 
-            for fd, mode in ready:
-                if mode & select_POLLIN_POLLPRI:
-                    data = os.read(fd, 4096)
-                    if not data:
-                        close_unregister_and_remove(fd)
-                    if fd_to_outfile[fd]:
-                        outfile = fd_to_outfile[fd]
-                        _, hard_limit = fd_to_limits[fd]
-                        if (
-                            hard_limit is not None
-                            and fd_to_bytes[fd] + len(data) > hard_limit
-                        ):
-                            # Don't write to this outfile in subsequent rounds.
-                            fd_to_outfile[fd] = None
-                            logging.error(
-                                "{} wrote {} KiB (hard limit) to {} ->"
-                                " abort command".format(
-                                    self.name, hard_limit / 1024, outfile.name
-                                )
-                            )
-                            self.process.terminate()
-                            # Strip extra bytes.
-                            data = data[: hard_limit - fd_to_bytes[fd]]
-                        outfile.write(tools.get_string(data))
-                        fd_to_bytes[fd] += len(data)
-                else:
-                    # Ignore hang up or errors.
-                    close_unregister_and_remove(fd)
+        return self._reap()
+
+    def poll(self):
+        """Enforce the limits of the running process without blocking.
 
-        # Check soft limit.
-        for fd, outfile in fd_to_outfile.items():
+        Return the exit code once the process has exited and None
+        before.
+        """
+        assert not any(output.pipe for output in self.outputs.values())
+        if self._try_reap():
+            return self.process.returncode
+        self._monitor()
+        return None
+
+    def finish(self):
+        """Finish the output of the exited process, record its resource
+        usage and return its exit code."""
+        retcode = self.process.returncode
+        # Check the output that was written since the last check.
+        self._check_hard_limits()
+
+        for output in self.outputs.values():
+            output.finish()
             # Ignore streams that exceeded the hard limit.
-            if outfile is not None:
-                soft_limit, _ = fd_to_limits[fd]
-                bytes_written = fd_to_bytes[fd]
-                if soft_limit is not None and bytes_written > soft_limit:
-                    logging.error(
-                        "{} finished and wrote {} KiB to {} (soft limit: {} KiB)".format(
-                            self.name,
-                            bytes_written / 1024,
-                            outfile.name,
-                            soft_limit / 1024,
-                        )
+            if output.exceeded_hard_limit:
+                continue
+            bytes_written = output.get_bytes_written()
+            if output.soft_limit is not None and bytes_written > output.soft_limit:
+                self.logger.error(
+                    "{} finished and wrote {} KiB to {} (soft limit: {} KiB)".format(
+                        self.name,
+                        bytes_written / 1024,
+                        output.stream.name,
+                        output.soft_limit / 1024,
                     )
-
-    def wait(self):
-        wall_clock_start_time = time.time()
-        self._redirect_streams()
-        retcode = self.process.wait()
-        for stream, _ in self.redirected_streams_and_limits.values():
+                )
             # Write output to disk before the next Call starts.
-            stream.flush()
-            os.fsync(stream.fileno())
+            if self.fsync and output.direct:
+                os.fsync(output.stream.fileno())
 
         # Close files that were opened in the constructor.
         for file in self.opened_files:
             file.close()
-        wall_clock_time = time.time() - wall_clock_start_time
-        logging.info(f"{self.name} wall-clock time: {wall_clock_time:.2f}s")
-        if (
-            self.wall_clock_time_limit is not None
-            and wall_clock_time > self.wall_clock_time_limit
-        ):
-            logging.error(
-                "wall-clock time for %s too high: %.2f > %d"
-                % (self.name, wall_clock_time, self.wall_clock_time_limit)
-            )
-        logging.info(f"{self.name} exit code: {retcode}")
+        self.logger.info(f"{self.name} wall-clock time: {self.wall_time:.2f}s")
+        self.logger.info(f"{self.name} exit code: {retcode}")
+        if self.properties_file:
+            props = tools.Properties(self.properties_file)
+            props.update(self.get_resource_usage())
+            props.write()
+        return retcode
+
+    def wait(self):
+        try:
+            self._redirect_streams()
+            retcode = self.finish()
+        finally:
+            if self.rusage is None:
+                # Don't leave the command behind if we fail.
+                self._signal_group(signal.SIGKILL)
+            # Signals that we passed on to the command reach us now.
+            self._restore_signal_handlers()
         return retcode
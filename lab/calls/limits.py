@@ -0,0 +1,321 @@
+# Lab is a Python package for evaluating algorithms.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Enforce the time and memory limits of commands.
+
+:class:`RlimitBackend` sets resource limits for the process of a
+command. They apply to each process of the command on its own.
+
+:class:`CgroupBackend` moves the command into a new cgroup (version 2),
+which limits and accounts for all processes of the command together.
+This needs a cgroup that is delegated to the user and offers the
+``cpu`` and ``memory`` controllers, e.g., a systemd unit with
+``Delegate=yes``. The processes of this cgroup move into its child
+``lab-job`` and the command cgroups are created next to it, so they
+never leave the delegated cgroup.
+
+The ``"rlimit"`` backend is the default. The ``"auto"`` backend uses
+cgroups if they are available and resource limits otherwise, so the
+way limits are enforced may differ between machines.
+"""
+
+import errno
+import functools
+import logging
+import os
+import resource
+import signal
+import time
+
+
+LIMIT_BACKENDS = ["auto", "rlimit", "cgroup"]
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_CONTROLLERS = ["cpu", "memory"]
+# Child of our cgroup that holds our own processes.
+CGROUP_LEAF = "lab-job"
+
+# Seconds between the soft and the hard time limit. Programs can handle
+# SIGXCPU in between.
+TIME_LIMIT_PADDING = 5
+
+
+def set_limit(kind, soft_limit, hard_limit):
+    try:
+        resource.setrlimit(kind, (soft_limit, hard_limit))
+    except (OSError, ValueError) as err:
+        logging.error(
+            f"Resource limit for {kind} could not be set to "
+            f"[{soft_limit}, {hard_limit}] ({err})"
+        )
+
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _write_file(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _read_keyed_values(path):
+    """Parse files like cpu.stat and memory.events into a dictionary."""
+    values = {}
+    for line in (_read_file(path) or "").splitlines():
+        key, _, value = line.partition(" ")
+        if value.isdigit():
+            values[key] = int(value)
+    return values
+
+
+def _get_own_cgroup():
+    for line in (_read_file("/proc/self/cgroup") or "").splitlines():
+        if line.startswith("0::"):
+            return os.path.normpath(os.path.join(CGROUP_ROOT, line[3:].lstrip("/")))
+    return None
+
+
+def _has_controllers(path, filename):
+    available = (_read_file(os.path.join(path, filename)) or "").split()
+    return all(controller in available for controller in CGROUP_CONTROLLERS)
+
+
+@functools.lru_cache(maxsize=None)
+def get_cgroup_parent():
+    """Return the cgroup directory below which commands get their own
+    cgroups or None if cgroups can't be used.
+
+    This is our own cgroup, which must be delegated to us. Since a
+    cgroup with enabled controllers can't contain processes, we move
+    its processes into the leaf child :data:`CGROUP_LEAF` first.
+    """
+    if not os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        # No unified cgroup hierarchy.
+        return None
+    path = _get_own_cgroup()
+    if path is None:
+        return None
+    if os.path.basename(path) == CGROUP_LEAF:
+        # We (or the process that started us) already set up the cgroup.
+        path = os.path.dirname(path)
+    if not os.access(path, os.W_OK) or not _has_controllers(
+        path, "cgroup.controllers"
+    ):
+        return None
+    if _has_controllers(path, "cgroup.subtree_control"):
+        return path
+    leaf = os.path.join(path, CGROUP_LEAF)
+    try:
+        if not os.path.exists(leaf):
+            os.mkdir(leaf)
+        for pid in (_read_file(os.path.join(path, "cgroup.procs")) or "").split():
+            try:
+                _write_file(os.path.join(leaf, "cgroup.procs"), pid)
+            except ProcessLookupError:
+                pass
+        _write_file(
+            os.path.join(path, "cgroup.subtree_control"),
+            " ".join(f"+{controller}" for controller in CGROUP_CONTROLLERS),
+        )
+    except OSError as err:
+        logging.warning(f"Could not enable cgroup controllers in {path}: {err}")
+        return None
+    if not _has_controllers(path, "cgroup.subtree_control"):
+        return None
+    return path
+
+
+class RlimitBackend:
+    """Limit the resources of the command's process with setrlimit().
+
+    When the soft time limit is reached, SIGXCPU is emitted. Once we
+    reach the higher hard time limit, SIGKILL is sent. The memory limit
+    restricts the address space of the process.
+    """
+
+    name = "rlimit"
+
+    def __init__(self, call_name, time_limit, memory_limit):
+        self.call_name = call_name
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        # Reason for stopping the command, if the backend stopped it.
+        self.kill_reason = None
+
+    def prepare_process(self):
+        """Set the limits. Runs in the child process before the command."""
+        if self.time_limit is not None:
+            set_limit(
+                resource.RLIMIT_CPU,
+                self.time_limit,
+                self.time_limit + TIME_LIMIT_PADDING,
+            )
+        if self.memory_limit is not None:
+            _, hard_mem_limit = resource.getrlimit(resource.RLIMIT_AS)
+            # Convert memory from MiB to Bytes.
+            set_limit(
+                resource.RLIMIT_AS, self.memory_limit * 1024 * 1024, hard_mem_limit
+            )
+        set_limit(resource.RLIMIT_CORE, 0, 0)
+
+    def check(self):
+        """Enforce the limits while the command runs."""
+
+    def finish(self):
+        """Clean up after the command's process exited and return the
+        resource usage that the backend measured."""
+        return {}
+
+
+class CgroupBackend(RlimitBackend):
+    """Limit the resources of all processes of the command together.
+
+    The command runs in its own cgroup. The memory limit is written to
+    ``memory.max`` and the kernel kills the whole cgroup when it's
+    exceeded. ``cpu.max`` limits CPU bandwidth rather than CPU time, so
+    the time limit is checked against the usage in ``cpu.stat``: at the
+    soft limit, all processes receive SIGXCPU and at the hard limit,
+    all processes are killed. Peak memory is read from ``memory.peak``.
+    """
+
+    name = "cgroup"
+    _counter = 0
+
+    def __init__(self, call_name, time_limit, memory_limit):
+        super().__init__(call_name, time_limit, memory_limit)
+        CgroupBackend._counter += 1
+        self.path = os.path.join(
+            get_cgroup_parent(),
+            f"lab-{os.getpid()}-{CgroupBackend._counter}-{call_name}",
+        )
+        os.mkdir(self.path)
+        self.sent_sigxcpu = False
+        self.killed = False
+        try:
+            _write_file(self._get_file("memory.oom.group"), "1")
+            if memory_limit is not None:
+                _write_file(self._get_file("memory.max"), str(memory_limit * 2**20))
+                _write_file(self._get_file("memory.swap.max"), "0")
+        except OSError:
+            self._remove()
+            raise
+
+    def _get_file(self, name):
+        return os.path.join(self.path, name)
+
+    def prepare_process(self):
+        _write_file(self._get_file("cgroup.procs"), "0")
+        set_limit(resource.RLIMIT_CORE, 0, 0)
+
+    def _get_pids(self):
+        return [
+            int(pid)
+            for pid in (_read_file(self._get_file("cgroup.procs")) or "").split()
+        ]
+
+    def _signal_all(self, sig):
+        for pid in self._get_pids():
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def kill(self):
+        """Kill all processes in the cgroup."""
+        try:
+            _write_file(self._get_file("cgroup.kill"), "1")
+        except OSError:
+            # cgroup.kill needs Linux 5.14.
+            self._signal_all(signal.SIGKILL)
+
+    def get_cpu_time(self):
+        return _read_keyed_values(self._get_file("cpu.stat")).get("usage_usec", 0) / 1e6
+
+    def check(self):
+        if self.time_limit is None or self.killed:
+            return
+        cpu_time = self.get_cpu_time()
+        if cpu_time > self.time_limit + TIME_LIMIT_PADDING:
+            logging.error(
+                f"{self.call_name} used {cpu_time:.2f}s CPU time "
+                f"(hard limit) -> kill command"
+            )
+            self.killed = True
+            self.kill_reason = "cpu_time_limit"
+            self.kill()
+        elif cpu_time > self.time_limit and not self.sent_sigxcpu:
+            self.sent_sigxcpu = True
+            self._signal_all(signal.SIGXCPU)
+
+    def _remove(self):
+        # The cgroup can only be removed once the killed processes are gone.
+        for _ in range(100):
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError as err:
+                if err.errno != errno.EBUSY:
+                    break
+                time.sleep(0.01)
+        logging.warning(f"cgroup {self.path} could not be removed")
+
+    def finish(self):
+        usage = {"cpu_time": round(self.get_cpu_time(), 3)}
+        peak = _read_file(self._get_file("memory.peak"))
+        if peak and peak.isdigit():
+            # memory.peak needs Linux 5.19.
+            usage["peak_memory"] = int(peak) // 1024
+        if _read_keyed_values(self._get_file("memory.events")).get("oom_kill"):
+            self.kill_reason = "memory_limit"
+            logging.error(
+                f"{self.call_name} exceeded the memory limit of "
+                f"{self.memory_limit} MiB -> command was killed"
+            )
+        # Don't leave behind processes that the command started.
+        if self._get_pids():
+            self.kill()
+        self._remove()
+        return usage
+
+
+def get_limit_backend(backend, call_name, time_limit, memory_limit):
+    """Return the *backend* instance that limits the command *call_name*.
+
+    For ``"auto"``, fall back to resource limits if cgroups can't be used.
+    """
+    if backend not in LIMIT_BACKENDS:
+        logging.critical(
+            f"limit_backend must be one of {LIMIT_BACKENDS}, not {backend!r}"
+        )
+    if backend == "rlimit":
+        return RlimitBackend(call_name, time_limit, memory_limit)
+    if get_cgroup_parent() is not None:
+        try:
+            return CgroupBackend(call_name, time_limit, memory_limit)
+        except OSError as err:
+            if backend == "cgroup":
+                logging.critical(f"Could not create cgroup for {call_name}: {err}")
+    elif backend == "cgroup":
+        logging.critical(
+            "The cgroup limit backend needs a delegated cgroup v2 hierarchy "
+            "with the cpu and memory controllers"
+        )
+    return RlimitBackend(call_name, time_limit, memory_limit)
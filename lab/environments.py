@@ -14,14 +14,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import multiprocessing
 import os
 import random
 import re
 import subprocess
 import sys
+import time
 
-from lab import tools
+from lab import local_executor, status, tools, work_queue
+from lab.calls.call import KILL_GRACE_PERIOD
+import lab.experiment
 
 
 def _get_job_prefix(exp_name):
@@ -40,10 +42,85 @@ def is_run_step(step):
     return step._funcname == "start_runs"
 
 
+class RandomTaskOrder:
+    """Start runs in random order (the default)."""
+
+    def __call__(self, exp, run_ids):
+        run_ids = list(run_ids)
+        random.shuffle(run_ids)
+        return run_ids
+
+
+class _PredictedTimeTaskOrder:
+    longest_first = None
+
+    def __init__(self, eval_dir, attribute="planner_time"):
+        self.eval_dir = eval_dir
+        self.attribute = attribute
+
+    def __call__(self, exp, run_ids):
+        props = tools.Properties(os.path.join(self.eval_dir, "properties"))
+        if not props:
+            logging.critical(f"No properties found in {self.eval_dir}")
+
+        def get_predicted_time(run_id):
+            run = exp.runs[run_id - 1]._expand()
+            value = props.get("-".join(run.properties["id"]), {}).get(self.attribute)
+            # Runs without a value may have timed out or be new.
+            return float("inf") if value is None else value
+
+        predicted_times = {run_id: get_predicted_time(run_id) for run_id in run_ids}
+        logging.info(
+            "Found {} for {} of {} runs".format(
+                self.attribute,
+                sum(time != float("inf") for time in predicted_times.values()),
+                len(predicted_times),
+            )
+        )
+        # Start runs with equal predictions in random order.
+        run_ids = RandomTaskOrder()(exp, run_ids)
+        return sorted(
+            run_ids,
+            key=lambda run_id: predicted_times[run_id],
+            reverse=self.longest_first,
+        )
+
+
+class LongestFirstTaskOrder(_PredictedTimeTaskOrder):
+    """Start runs with the highest value for *attribute* in the
+    properties file of a previous evaluation directory *eval_dir*
+    first.
+
+    Runs without a value (e.g., because they timed out or are new) are
+    started first. Together with the dynamic task distribution of the
+    :class:`.LocalEnvironment`, this minimizes the time between the
+    start of the first and the end of the last run. ::
+
+        env = LocalEnvironment(
+            task_order=LongestFirstTaskOrder("data/previous-exp-eval"))
+
+    """
+
+    longest_first = True
+
+
+class ShortestFirstTaskOrder(_PredictedTimeTaskOrder):
+    """Start runs with the lowest value for *attribute* in the
+    properties file of a previous evaluation directory *eval_dir*
+    first.
+
+    This yields many results early on. Runs without a value are
+    started last.
+
+    """
+
+    longest_first = False
+
+
 class Environment:
     """Abstract base class for all environments."""
 
-    def __init__(self, randomize_task_order=True):
+    def __init__(self, randomize_task_order=True, task_order=None):
         """
         If *randomize_task_order* is True (default), tasks for runs are
         started in a random order. This is useful to avoid systematic
@@ -52,13 +129,23 @@ class Environment:
         run directories may be pristine while the experiment is running
         even though the logs say the runs are finished.
 
+        If given, *task_order* overrides *randomize_task_order*. It must
+        be a callable that receives the experiment and a list of run
+        IDs and returns the run IDs in the order in which the runs
+        should be started, e.g., :class:`.RandomTaskOrder`,
+        :class:`.LongestFirstTaskOrder` or
+        :class:`.ShortestFirstTaskOrder`.
+
         """
         self.exp = None
         self.randomize_task_order = randomize_task_order
+        self.task_order = task_order
 
     def _get_task_order(self):
-        task_order = list(range(1, len(self.exp.runs) + 1))
-        if self.randomize_task_order:
+        task_order = list(self.exp._get_run_ids_to_start())
+        if self.task_order:
+            task_order = list(self.task_order(self.exp, task_order))
+        elif self.randomize_task_order:
             random.shuffle(task_order)
         return task_order
 
@@ -78,38 +165,259 @@ class Environment:
 class LocalEnvironment(Environment):
     """
     Environment for running experiments locally on a single machine.
+
+    The runs are handed to the worker processes one at a time in the
+    order given by the task order (see :class:`.Environment`), so no
+    process idles while there are unstarted runs.
+
+    Each run occupies as many cores as its ``cores`` property says
+    (default: 1). Multi-core runs are only started once enough cores
+    are free and take their cores from a single NUMA node whenever
+    possible. Runs that need fewer cores may overtake a waiting
+    multi-core run. ::
+
+        run.set_property("cores", 4)
+
+    A run needs as much memory as the highest ``memory_limit`` of its
+    commands (for Fast Downward runs, also the
+    ``--overall-memory-limit`` driver option). If the environment has
+    a memory budget, runs are only started if their memory and the
+    memory of all running runs fit into it. Runs without memory limit
+    don't count towards the budget.
+
     """
 
     EXP_RUN_SCRIPT = "run"
 
-    def __init__(self, processes=None, **kwargs):
+    def __init__(
+        self,
+        processes=None,
+        pin_cores=True,
+        memory_budget=None,
+        max_memory_pressure=10.0,
+        resume=False,
+        in_process=False,
+        supervisor=False,
+        **kwargs,
+    ):
         """
-        If given, *processes* must be between 1 and #CPUs. If omitted,
-        it will be set to #CPUs.
+        If given, *processes* must be between 1 and the number of
+        usable cores. If omitted, it will be set to the number of usable
+        cores. Usable cores are the cores in the CPU affinity mask of
+        the process, limited by a cgroup CPU quota if there is one.
+
+        If *pin_cores* is True (default), each run is pinned to its
+        cores with ``sched_setaffinity()`` on platforms that support
+        it. This prevents concurrent runs from competing for the same
+        cores and from migrating between NUMA nodes.
+
+        *memory_budget* is the memory (in MiB) that concurrent runs may
+        use together. Pass ``"total"`` to use the physical memory of the
+        machine (or the cgroup memory limit, if lower). By default,
+        there is no budget, since the memory limits of commands are
+        usually much higher than the memory the runs actually use.
+        Independent of the budget, new runs are postponed while the
+        machine has less available memory than the next run needs or
+        while the memory pressure (the percentage of time in which some
+        processes stalled on memory during the last ten seconds, see
+        ``/proc/pressure/memory``) exceeds *max_memory_pressure*.
+
+        The ``run`` script in the experiment directory records started
+        and finished runs in the file ``run-journal``. If *resume* is
+        True (or the experiment script is called with ``--resume``),
+        the start step skips the runs that finished before and restarts
+        the runs that were interrupted. ::
+
+            ./myexp.py start --resume
+
+        Building the experiment again clears the journal.
+
+        By default, each run is executed by a new Python interpreter.
+        If *in_process* is True, each run is executed by a forked copy
+        of the job process, which has already imported Lab. For
+        compact experiments (``exp.build(compact=True)``), parsers are
+        also executed in this process instead of in a new interpreter.
+        This makes experiments with many short runs much faster. The
+        commands of the runs still run in their own processes.
+
+        If *supervisor* is True, no Python process is started for the
+        runs at all. Instead, a single asyncio event loop in the job
+        process starts the commands of all runs, enforces their limits,
+        writes their output to files and starts the parsers after the
+        other commands. The commands are started and polled like in run
+        scripts (see :mod:`lab.supervisor`), and each parser still runs
+        in its own Python process. This has the lowest overhead per
+        run, but only works for compact experiments and can't be
+        combined with *in_process*.
 
         See :py:class:`~lab.environments.Environment` for inherited
         parameters.
 
         """
         Environment.__init__(self, **kwargs)
-        cores = multiprocessing.cpu_count()
+        cores = local_executor.get_num_usable_cores()
         if processes is None:
             processes = cores
         if not 1 <= processes <= cores:
             raise ValueError("processes must be in the range [1, ..., #CPUs].")
         self.processes = processes
+        self.pin_cores = pin_cores
+        self.memory_budget = memory_budget
+        self.max_memory_pressure = max_memory_pressure
+        self.resume = resume
+        if in_process and supervisor:
+            raise ValueError("in_process and supervisor can't be combined.")
+        self.in_process = in_process
+        self.supervisor = supervisor
+
+    def _get_run_requirements(self, run_ids):
+        run_cores = {}
+        run_memory = {}
+        for run_id in run_ids:
+            _, cores, memory = self.exp._run_summaries[run_id]
+            if not isinstance(cores, int) or not 1 <= cores <= self.processes:
+                logging.critical(
+                    f"Run {run_id} needs {cores} cores, but the number of cores "
+                    f"must be an integer in the range [1, ..., {self.processes}]."
+                )
+            if cores > 1:
+                run_cores[run_id] = cores
+            if memory is not None:
+                run_memory[run_id] = memory
+        return run_cores, run_memory
 
     def write_main_script(self):
+        task_order = self._get_task_order()
+        run_cores, run_memory = self._get_run_requirements(task_order)
         script = tools.fill_template(
-            "local-job.py", task_order=self._get_task_order(), processes=self.processes
+            "local-job.py",
+            task_order=task_order,
+            run_cores=run_cores,
+            run_memory=run_memory,
+            processes=self.processes,
+            pin_cores=self.pin_cores,
+            memory_budget=self.memory_budget,
+            max_memory_pressure=self.max_memory_pressure,
+            in_process=self.in_process,
+            supervisor=self.supervisor,
+            sync_at_end=self.exp.durability == "batch",
+            shard_size=self.exp.run_dir_layout.shard_size,
+            shard_levels=self.exp.run_dir_layout.levels,
         )
 
         self.exp.add_new_file("", self.EXP_RUN_SCRIPT, script, permissions=0o755)
+        # The run IDs in an old journal may refer to different runs.
+        for filename in [local_executor.RUN_JOURNAL_FILENAME, status.STATUS_FILENAME]:
+            path = os.path.join(self.exp.path, filename)
+            if os.path.exists(path):
+                os.remove(path)
 
     def start_runs(self):
-        tools.run_command(
-            [tools.get_python_executable(), self.EXP_RUN_SCRIPT], cwd=self.exp.path
+        cmd = [tools.get_python_executable(), self.EXP_RUN_SCRIPT]
+        if self.resume:
+            cmd.append("--resume")
+        tools.run_command(cmd, cwd=self.exp.path)
+
+    def run_steps(self, steps):
+        for step in steps:
+            step()
+
+
+class WorkQueueEnvironment(Environment):
+    """
+    Environment for running experiments on several machines without a
+    grid engine.
+
+    The start step runs a coordinator that hands out one run at a time
+    to each worker. Workers can join at any time: on each machine that
+    sees the experiment directory (e.g., on a network file system),
+    start as many workers as you like with the ``worker`` script in the
+    experiment directory::
+
+        cd /shared/data/myexp
+        ./worker --processes 4
+
+    Workers send heartbeats while they execute a run. If a worker
+    disconnects or misses its heartbeats for *heartbeat_timeout*
+    seconds, its run is handed to another worker. A worker that
+    receives no acknowledgement for its heartbeats kills its run
+    before that happens (see :mod:`lab.work_queue`). The coordinator
+    finishes once all runs are done.
+
+    """
+
+    EXP_RUN_SCRIPT = "run"
+
+    def __init__(
+        self,
+        host="",
+        port=0,
+        local_workers=0,
+        heartbeat_timeout=60,
+        resume=False,
+        **kwargs,
+    ):
+        """
+        The coordinator listens on *host* and *port*. By default, it
+        accepts connections on all interfaces on a free port. Workers
+        read the address and a secret token from the file
+        ``work-queue`` in the experiment directory.
+
+        If *local_workers* is positive, the coordinator starts that
+        many workers on its own machine.
+
+        Like for the :class:`.LocalEnvironment`, the ``run`` script
+        records the runs in the ``run-journal`` file and the ``status``
+        file. If *resume* is True (or the experiment script is called
+        with ``--resume``), the start step skips the runs that finished
+        before.
+
+        See :py:class:`~lab.environments.Environment` for inherited
+        parameters.
+
+        """
+        Environment.__init__(self, **kwargs)
+        if local_workers < 0:
+            raise ValueError("local_workers must not be negative.")
+        if heartbeat_timeout <= 2 * KILL_GRACE_PERIOD:
+            raise ValueError(
+                f"heartbeat_timeout must exceed {2 * KILL_GRACE_PERIOD} seconds."
+            )
+        self.host = host
+        self.port = port
+        self.local_workers = local_workers
+        self.heartbeat_timeout = heartbeat_timeout
+        self.resume = resume
+
+    def write_main_script(self):
+        script = tools.fill_template(
+            "work-queue-job.py",
+            task_order=self._get_task_order(),
+            host=self.host,
+            port=self.port,
+            local_workers=self.local_workers,
+            heartbeat_timeout=self.heartbeat_timeout,
+            shard_size=self.exp.run_dir_layout.shard_size,
+            shard_levels=self.exp.run_dir_layout.levels,
+        )
+        self.exp.add_new_file("", self.EXP_RUN_SCRIPT, script, permissions=0o755)
+        worker_script = tools.fill_template(
+            "work-queue-worker.py", sync_at_end=self.exp.durability == "batch"
+        )
+        self.exp.add_new_file(
+            "", work_queue.WORKER_SCRIPT, worker_script, permissions=0o755
         )
+        # The run IDs in an old journal may refer to different runs.
+        for filename in [local_executor.RUN_JOURNAL_FILENAME, status.STATUS_FILENAME]:
+            path = os.path.join(self.exp.path, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def start_runs(self):
+        cmd = [tools.get_python_executable(), self.EXP_RUN_SCRIPT]
+        if self.resume:
+            cmd.append("--resume")
+        tools.run_command(cmd, cwd=self.exp.path)
 
     def run_steps(self, steps):
         for step in steps:
@@ -127,7 +435,7 @@ class GridEnvironment(Environment):
     # Can be overridden in derived classes.
     MAX_TASKS = float("inf")
 
-    def __init__(self, email=None, extra_options=None, **kwargs):
+    def __init__(self, email=None, extra_options=None, results_log=False, **kwargs):
         """
 
         If the main experiment step is part of the selected steps, the
@@ -152,6 +460,15 @@ class GridEnvironment(Environment):
 
             extra_options='#SBATCH --cpus-per-task=2'
 
+        If *results_log* is True, each grid task appends the properties
+        of its run to the results log (see :mod:`lab.results_log`), so
+        that fetching doesn't have to open the files of every run
+        directory. This starts an additional Python interpreter per
+        run, which only pays off for experiments with many short runs,
+        and needs a file system that supports ``lockf()`` locks, e.g.,
+        NFS with a lock manager. Otherwise, runs are missing from the
+        log and the fetcher reads their run directories.
+
         See :py:class:`~lab.environments.Environment` for inherited
         parameters.
 
@@ -159,6 +476,7 @@ class GridEnvironment(Environment):
         Environment.__init__(self, **kwargs)
         self.email = email
         self.extra_options = extra_options or "## (not used)"
+        self.results_log = results_log
 
     def start_runs(self):
         # The queue will start the experiment by itself.
@@ -172,7 +490,9 @@ class GridEnvironment(Environment):
         )
 
     def _get_num_runs(self):
-        num_runs = len(self.exp.runs)
+        num_runs = len(self.exp._get_run_ids_to_start())
+        if num_runs == 0:
+            logging.critical("All runs are up to date, there is nothing to start.")
         if num_runs > self.MAX_TASKS:
             logging.critical(
                 "You are trying to submit a job with %d tasks, "
@@ -205,6 +525,12 @@ class GridEnvironment(Environment):
             task_order=" ".join(str(i) for i in self._get_task_order()),
             exp_path="../" + self.exp.name,
             python=tools.get_python_executable(),
+            shard_size=self.exp.run_dir_layout.shard_size,
+            shard_levels=self.exp.run_dir_layout.levels,
+            sync_at_end="true" if self.exp.durability == "batch" else "false",
+            results_log="true" if self.results_log else "false",
+            # Orders the results of different submissions (see lab.results_log).
+            epoch=time.time(),
         )
 
     def _get_step_job_body(self, step):
@@ -246,11 +572,21 @@ class GridEnvironment(Environment):
                 "already been submitted. Are you sure you want to "
                 "delete the grid-steps and submit it again?" % job_dir
             )
-            tools.remove_path(job_dir)
+            tools.remove_path(job_dir, background=True)
 
-        # Overwrite exp dir if it exists.
-        if any(is_build_step(step) for step in steps):
+        build_steps = [step for step in steps if is_build_step(step)]
+        incremental = any(step.kwargs.get("incremental") for step in build_steps)
+        if build_steps and not incremental:
+            # Overwrite exp dir if it exists.
             self.exp._remove_experiment_dir()
+        elif incremental and os.path.exists(
+            os.path.join(self.exp.path, lab.experiment.BUILD_MANIFEST_FILENAME)
+        ):
+            # Only submit the runs that the incremental build will leave
+            # unfinished.
+            _, self.exp._run_ids_to_start = self.exp._plan_incremental_build(
+                self.exp._compute_run_fingerprints()
+            )
 
         # Remove eval dir if it exists.
         if os.path.exists(self.exp.eval_dir):
@@ -258,7 +594,7 @@ class GridEnvironment(Environment):
                 'The evaluation directory "%s" already exists. '
                 "Do you want to remove it?" % self.exp.eval_dir
             )
-            tools.remove_path(self.exp.eval_dir)
+            tools.remove_path(self.exp.eval_dir, background=True)
 
         # Create job dir only when we need it.
         tools.makedirs(job_dir)
@@ -17,14 +17,19 @@
 
 from collections import OrderedDict
 from glob import glob
+import hashlib
 import logging
+import multiprocessing
 import os
 import subprocess
 import sys
 
-from lab import environments, tools
+from lab import archive, environments, results_log, runner, status, tools
+from lab.calls.call import RESOURCE_USAGE_ATTRIBUTES
+from lab.calls.limits import LIMIT_BACKENDS
 from lab.fetcher import Fetcher
 from lab.steps import get_step, get_steps_text, Step
+from lab.tools import json
 
 
 # How many tasks to group into one top-level directory.
@@ -44,9 +49,22 @@ steps_group.add_argument(
 steps_group.add_argument(
     "--all", dest="run_all_steps", action="store_true", help="Run all steps."
 )
+ARGPARSER.add_argument(
+    "--resume",
+    action="store_true",
+    help="Skip finished runs and restart interrupted runs of a local experiment.",
+)
 
 STATIC_EXPERIMENT_PROPERTIES_FILENAME = "static-experiment-properties"
 STATIC_RUN_PROPERTIES_FILENAME = "static-properties"
+RESOURCE_STORE_DIR = "resource-store"
+BUILD_MANIFEST_FILENAME = "build-manifest"
+RUN_DIR_INDEX_FILENAME = "run-dirs"
+DURABILITY_POLICIES = ["command", "run", "batch"]
+
+# Experiment that is built by the worker processes in Experiment._build_runs().
+# Forked workers inherit it, which saves us from pickling the runs.
+_EXPERIMENT_TO_BUILD = None
 
 
 def get_default_data_dir():
@@ -68,10 +86,129 @@ def _get_default_experiment_dir():
     return os.path.join(get_default_data_dir(), _get_default_experiment_name())
 
 
+def _get_run_summary(run):
+    """Return the ID string, cores and memory limit of the expanded *run*."""
+    return (
+        "-".join(run.properties["id"]),
+        run.properties.get("cores", 1),
+        run._get_memory_limit(),
+    )
+
+
+def _build_run(run_id):
+    """Build a single run in a worker process of the build pool.
+
+    Return the summary of the run and an error message or None.
+    """
+    try:
+        run = _EXPERIMENT_TO_BUILD.runs[run_id - 1]._expand()
+        run.build(run_id)
+    except SystemExit as err:
+        # logging.critical() calls sys.exit(), which would kill the worker
+        # and leave the pool waiting forever. Report the error instead.
+        return None, str(err)
+    return _get_run_summary(run), None
+
+
+class RunDirLayout:
+    """Assign run directories to run IDs.
+
+    Runs are grouped into shard directories. Each shard holds at most
+    *shard_size* entries and there are *levels* nested levels of
+    shards. The default layout stores runs 1-100 in
+    ``runs-00001-00100/00001`` to ``runs-00001-00100/00100`` and so on.
+    For very large experiments, use more levels to keep the number of
+    entries per directory small:
+
+    >>> layout = RunDirLayout(shard_size=1000, levels=2)
+    >>> layout.get_run_dir(1234567)
+    'runs-1000001-2000000/runs-1234001-1235000/1234567'
+
+    """
+
+    def __init__(self, shard_size=SHARD_SIZE, levels=1):
+        if shard_size < 1 or levels < 1:
+            logging.critical("shard_size and levels must be positive")
+        self.shard_size = shard_size
+        self.levels = levels
+
+    def get_run_dir(self, run_id):
+        """Return the run directory relative to the experiment directory."""
+        parts = []
+        for level in range(self.levels, 0, -1):
+            size = self.shard_size**level
+            lower = ((run_id - 1) // size) * size + 1
+            upper = lower + size - 1
+            parts.append(f"runs-{lower:0>5}-{upper:0>5}")
+        parts.append(f"{run_id:0>5}")
+        return "/".join(parts)
+
+
 def get_run_dir(task_id):
-    lower = ((task_id - 1) // SHARD_SIZE) * SHARD_SIZE + 1
-    upper = ((task_id + SHARD_SIZE - 1) // SHARD_SIZE) * SHARD_SIZE
-    return "runs-{lower:0>5}-{upper:0>5}/{task_id:0>5}".format(**locals())
+    """Return the run directory for *task_id* in the default layout."""
+    return RunDirLayout().get_run_dir(task_id)
+
+
+def get_run_dirs(exp_dir, exclude=()):
+    """Return the sorted absolute paths of all run directories in *exp_dir*.
+
+    Use the run directory index of the experiment if it exists and
+    search the directory for the default layout otherwise. Run
+    directories in *exclude* (relative to *exp_dir*) are skipped
+    without looking at them.
+    """
+    index = load_run_dir_index(exp_dir)
+    if index:
+        run_dirs = [
+            os.path.join(exp_dir, run_dir)
+            for run_dir in index.values()
+            if run_dir not in exclude
+        ]
+        return sorted(run_dir for run_dir in run_dirs if os.path.isdir(run_dir))
+    run_dirs = glob(os.path.join(exp_dir, "runs-*-*", "*"))
+    return sorted(
+        run_dir
+        for run_dir in run_dirs
+        if os.path.relpath(run_dir, exp_dir) not in exclude
+    )
+
+
+def load_run_dir_index(exp_dir):
+    """Return a dictionary mapping run ID strings to run directories.
+
+    The keys are the joined parts of the runs' *id* properties (e.g.,
+    ``"algo1-task1"``). The values are relative to *exp_dir*. If the
+    experiment has no index, the dictionary is empty. ::
+
+        index = load_run_dir_index("data/my-exp")
+        run_dir = index["lmcut-gripper-prob01.pddl"]
+
+    """
+    return tools.Properties(os.path.join(exp_dir, RUN_DIR_INDEX_FILENAME))
+
+
+def _get_path_signature(path):
+    """Return a cheap fingerprint of the file or directory at *path*."""
+    if not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    signature = []
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs.sort()
+        for filename in sorted(files):
+            abs_path = os.path.join(root, filename)
+            signature.append(
+                [os.path.relpath(abs_path, path), _get_path_signature(abs_path)]
+            )
+    return signature
+
+
+def _compute_spec_hash(spec):
+    return hashlib.sha1(
+        tools.get_bytes(json.dumps(spec, sort_keys=True, default=str))
+    ).hexdigest()
 
 
 def _check_name(name, typ, extra_chars=""):
@@ -92,12 +229,13 @@ def _check_name(name, typ, extra_chars=""):
 
 
 class _Resource:
-    def __init__(self, name, source, dest, symlink, is_parser):
+    def __init__(self, name, source, dest, symlink, is_parser, hardlink=False):
         self.name = name
         self.source = source
         self.dest = dest
         self.symlink = symlink
         self.is_parser = is_parser
+        self.hardlink = hardlink
 
 
 class _Buildable:
@@ -136,7 +274,7 @@ class _Buildable:
         if name in self.env_vars_relative:
             logging.critical(f"Parser and resource names must be unique: {name!r}")
 
-    def add_resource(self, name, source, dest="", symlink=False):
+    def add_resource(self, name, source, dest="", symlink=False, hardlink=False):
         """Include the file or directory *source* in the experiment or run.
 
         *name* is an alias for the resource in commands. It must start with a
@@ -148,6 +286,15 @@ class _Buildable:
         destination filename. If you only want an alias for your resource, but
         don't want to copy or link it, set *dest* to None.
 
+        If *symlink* is True, create a symbolic link to *source* instead
+        of copying it. If *hardlink* is True, hard-link the files of
+        *source* instead of copying them, which is much faster for large
+        resources. Where hard links are impossible, files are reflinked
+        or copied. Commands must not modify hard-linked files in place,
+        since this changes *source* as well. Copying other resources to
+        the same destination is fine, though, since existing files are
+        removed before they are overwritten.
+
         Example::
 
         >>> exp = Experiment()
@@ -169,7 +316,9 @@ class _Buildable:
         if name:
             self._check_alias(name)
             self.env_vars_relative[name] = dest
-        self.resources.append(_Resource(name, source, dest, symlink, is_parser=False))
+        self.resources.append(
+            _Resource(name, source, dest, symlink, is_parser=False, hardlink=hardlink)
+        )
 
     def add_new_file(self, name, dest, content, permissions=0o644):
         """
@@ -218,7 +367,11 @@ class _Buildable:
         After *time_limit* seconds the signal SIGXCPU is sent to the
         command. The process can catch this signal and exit gracefully.
         If it doesn't catch the SIGXCPU signal, the command is aborted
-        with SIGKILL after five additional seconds.
+        with SIGKILL after five additional seconds. If the command uses
+        more than 1.5 times *time_limit* (and at least 30 seconds) of
+        wall-clock time, e.g., because it waits for I/O, it is aborted
+        together with all processes it started: first with SIGTERM and
+        five seconds later with SIGKILL.
 
         The command is aborted with SIGKILL when it uses more than
         *memory_limit* MiB.
@@ -231,7 +384,18 @@ class _Buildable:
         handled by the process.
 
         By default, there are limits for the log and error output, but
-        time and memory are not restricted.
+        time and memory are not restricted. Pass *limit_backend* to
+        override how the experiment enforces the limits for this
+        command (see :class:`Experiment`).
+
+        After the command finishes, its resource usage is added to the
+        run's properties: ``<name>_wall_time`` and ``<name>_cpu_time``
+        (in seconds), ``<name>_peak_rss`` (peak resident memory in KiB),
+        ``<name>_voluntary_context_switches``,
+        ``<name>_involuntary_context_switches``, ``<name>_block_reads``
+        and ``<name>_block_writes``. If the command runs in its own
+        cgroup, ``<name>_peak_memory`` holds the peak memory usage (in
+        KiB) of all its processes.
 
         All *kwargs* (except ``stdin``) are passed to `subprocess.Popen
         <http://docs.python.org/library/subprocess.html>`_. Instead of
@@ -323,8 +487,52 @@ class _Buildable:
 
             # Even if the directory containing a resource has already been added,
             # we copy the resource since we might want to overwrite it.
+            if resource.hardlink:
+                logging.debug(f"Linking {resource.source} to {dest}")
+                tools.link(resource.source, dest)
+                continue
+
             logging.debug(f"Copying {resource.source} to {dest}")
-            tools.copy(resource.source, dest)
+            resource_store = self._get_resource_store()
+            if resource_store:
+                resource_store.copy(resource.source, dest)
+            else:
+                tools.copy(resource.source, dest)
+
+    def _get_resource_store(self):
+        return None
+
+    def _get_spec(self, path_signatures):
+        """Return a JSON-serializable description of everything we build.
+
+        Used for detecting which runs changed between two builds.
+        *path_signatures* caches the signatures of resource paths.
+        """
+
+        def get_signature(source):
+            if source not in path_signatures:
+                path_signatures[source] = _get_path_signature(source)
+            return path_signatures[source]
+
+        return {
+            "commands": list(self.commands.items()),
+            "env_vars": self.env_vars_relative,
+            "new_files": self.new_files,
+            "properties": {
+                key: value for key, value in self.properties.items() if key != "run_dir"
+            },
+            "resources": [
+                [
+                    res.name,
+                    res.source,
+                    get_signature(res.source),
+                    res.dest,
+                    res.symlink,
+                    res.hardlink,
+                ]
+                for res in self.resources
+            ],
+        }
 
 
 class Experiment(_Buildable):
@@ -361,7 +569,14 @@ class Experiment(_Buildable):
 
     """
 
-    def __init__(self, path=None, environment=None):
+    def __init__(
+        self,
+        path=None,
+        environment=None,
+        run_dir_layout=None,
+        durability="command",
+        limit_backend="rlimit",
+    ):
         """
         The experiment will be built at *path*. It defaults to
         ``<scriptdir>/data/<scriptname>/``. E.g., for the script
@@ -377,6 +592,40 @@ class Experiment(_Buildable):
         Alternatively, you can derive your own class from
         :ref:`Environment <environments>`.
 
+        *run_dir_layout* must be a :class:`.RunDirLayout` instance. It
+        determines the run directory of each run. The default layout
+        groups 100 runs per directory. Each build writes the file
+        ``run-dirs``, which maps run IDs to run directories (see
+        :func:`load_run_dir_index`).
+
+        *durability* determines when the output of the runs is forced to
+        disk with ``fsync()``:
+
+        * ``"command"`` (default): after each command of a run.
+        * ``"run"``: once at the end of each run.
+        * ``"batch"``: only once after the environment has executed all
+          runs of a job (``LocalEnvironment``) or after each grid job.
+          If the machine crashes, the output of runs that finished
+          before may be lost.
+
+        Syncing less often makes short runs faster, especially on
+        network file systems.
+
+        *limit_backend* determines how the time and memory limits of
+        commands are enforced (see :mod:`lab.calls.limits`):
+
+        * ``"rlimit"`` (default): set resource limits for the process of
+          each command.
+        * ``"auto"``: use cgroups if the runs can create them and
+          resource limits otherwise. Results may then depend on the
+          machine that executes a run.
+        * ``"cgroup"``: run each command in its own cgroup (version 2),
+          which limits and measures all processes of the command
+          together. Runs abort if no cgroup can be created.
+
+        You can override the backend for single commands by passing
+        *limit_backend* to :meth:`add_command`.
+
         """
         tools.configure_logging()
 
@@ -387,9 +636,28 @@ class Experiment(_Buildable):
             logging.critical("Path contains commas or colons: %s" % self.path)
         self.environment = environment or environments.LocalEnvironment()
         self.environment.exp = self
+        self.run_dir_layout = run_dir_layout or RunDirLayout()
+        if durability not in DURABILITY_POLICIES:
+            logging.critical(
+                f"durability must be one of {DURABILITY_POLICIES}, not {durability!r}"
+            )
+        self.durability = durability
+        if limit_backend not in LIMIT_BACKENDS:
+            logging.critical(
+                f"limit_backend must be one of {LIMIT_BACKENDS}, not {limit_backend!r}"
+            )
+        self.limit_backend = limit_backend
 
         self.steps = []
         self.runs = []
+        self._resource_store = None
+        # Properties that runs share, stored under the hash of their content.
+        self._property_groups = {}
+        # IDs of the runs that start_runs() executes (None means all runs).
+        self._run_ids_to_start = None
+        # Map run IDs to the summaries (see _get_run_summary()) that the
+        # build collects while it expands the runs.
+        self._run_summaries = {}
 
         self.set_property("experiment_file", self._script)
 
@@ -483,13 +751,17 @@ class Experiment(_Buildable):
         self.resources.append(
             _Resource(name, path_to_parser, dest, symlink=False, is_parser=True)
         )
-        self.add_command(name, [tools.get_python_executable(), f"{{{name}}}"])
+        # Don't clutter the properties with the resource usage of parsers.
+        self.add_command(
+            name, [tools.get_python_executable(), f"{{{name}}}"], properties_file=None
+        )
 
     def add_parse_again_step(self):
         """
         Add a step that copies the parsers from their originally specified
         locations to the experiment directory and runs all of them again. This
-        step overwrites the existing properties file in each run dir.
+        step overwrites the existing properties file in each run dir and
+        removes the results log (see :mod:`lab.results_log`).
 
         Do not forget to run the default fetch step again to overwrite
         existing data in the -eval dir of the experiment.
@@ -502,20 +774,38 @@ class Experiment(_Buildable):
             # Copy all parsers from their source to their destination again.
             self._build_resources(only_parsers=True)
 
-            run_dirs = sorted(glob(os.path.join(self.path, "runs-*-*", "*")))
+            # The results log holds the old properties.
+            results_log.remove_results_log(self.path)
+
+            run_dirs = get_run_dirs(self.path)
 
             total_dirs = len(run_dirs)
             logging.info(f"Parsing properties in {total_dirs:d} run directories")
             for index, run_dir in enumerate(run_dirs, start=1):
-                if os.path.exists(os.path.join(run_dir, "properties")):
-                    # print "removing path {}".format(os.path.join(run_dir, 'properties'))
-                    tools.remove_path(os.path.join(run_dir, "properties"))
+                props_file = os.path.join(run_dir, "properties")
+                if os.path.exists(props_file):
+                    # Keep the resource usage that the commands recorded.
+                    usage_suffixes = tuple(
+                        "_" + attribute for attribute in RESOURCE_USAGE_ATTRIBUTES
+                    )
+                    usage = {
+                        key: value
+                        for key, value in tools.Properties(props_file).items()
+                        if key.endswith(usage_suffixes)
+                    }
+                    tools.remove_path(props_file)
+                    if usage:
+                        props = tools.Properties(props_file)
+                        props.update(usage)
+                        props.write()
                 loglevel = logging.INFO if index % 100 == 0 else logging.DEBUG
                 logging.log(loglevel, f"Parsing run: {index:6d}/{total_dirs:d}")
                 for resource in self.resources:
                     if resource.is_parser:
                         parser_filename = self.env_vars_relative[resource.name]
-                        rel_parser = os.path.join("../../", parser_filename)
+                        rel_parser = os.path.relpath(
+                            self._get_abs_path(parser_filename), start=run_dir
+                        )
                         # Since parsers often produce output which we would
                         # rather not want to see for each individual run, we
                         # suppress it here.
@@ -632,14 +922,36 @@ class Experiment(_Buildable):
             env = self.environment
         else:
             env = environments.LocalEnvironment()
+        if args.resume:
+            if not isinstance(
+                env,
+                (environments.LocalEnvironment, environments.WorkQueueEnvironment),
+            ):
+                logging.critical(
+                    "--resume is only supported for local and work-queue experiments."
+                )
+            env.resume = True
         env.run_steps(steps)
 
+    def _get_run_ids_to_start(self):
+        if self._run_ids_to_start is None:
+            return list(range(1, len(self.runs) + 1))
+        return self._run_ids_to_start
+
     def _remove_experiment_dir(self):
         if os.path.exists(self.path):
             tools.confirm_overwrite_or_abort(self.path)
-            tools.remove_path(self.path)
+            tools.remove_path(self.path, background=True)
 
-    def build(self, write_to_disk=True):
+    def build(
+        self,
+        write_to_disk=True,
+        jobs=1,
+        deduplicate_resources=False,
+        incremental=False,
+        compact=False,
+        archive=False,
+    ):
         """
         Finalize the internal data structures, then write all files
         needed for the experiment to disk.
@@ -649,19 +961,240 @@ class Experiment(_Buildable):
         FastDownwardExperiments.build() which turns the added algorithms
         and benchmarks into Runs.
 
+        Use *jobs* to write the run directories with multiple processes
+        in parallel. The layout of the experiment directory and the
+        progress messages are the same as for a sequential build. ::
+
+            exp.add_step("build", exp.build, jobs=8)
+
+        If *deduplicate_resources* is True, files that runs copy via
+        :meth:`.add_resource` are stored only once in the
+        ``resource-store`` subdirectory and hard-linked (or, if that's
+        impossible, reflinked or copied) into the run directories.
+        This saves time and disk space if many runs use identical files.
+        Since hard links share their content, commands must not modify
+        deduplicated files in place.
+
+        If *incremental* is True, the build writes the file
+        ``build-manifest``, which stores a hash of the commands, resources
+        and static properties of each run. If the experiment directory
+        already contains a manifest from an earlier incremental build,
+        the directory is not deleted. Instead, run directories whose
+        hash is unchanged are kept (including their results) and only
+        new or changed runs are written. Afterwards, :meth:`.start_runs`
+        only executes the new and changed runs and the unchanged runs
+        that have never been started. Computing the hashes takes an
+        extra pass over all runs and resources, so other builds skip it.
+
+        If *compact* is True, don't write a directory with a ``run``
+        script for each run. Instead, write the specifications of all
+        runs to the indexed file ``run-specs.jsonl`` and a generic
+        ``runner`` script that executes a single run from it (see
+        :mod:`lab.runner`). This way, building the experiment only
+        writes a constant number of files. The run directories, their
+        static properties and the run resources are created when the
+        runs are started. Compact builds ignore *jobs* and
+        *deduplicate_resources*.
+
+        If *archive* is True, pack all run directories into the single
+        uncompressed archive ``runs.tar`` with an index of the byte
+        range of each run (see :mod:`lab.archive`) instead of writing
+        them to the experiment directory. When a run is started, the
+        ``runner`` script extracts only this run to a temporary
+        directory on the compute node (under ``$TMPDIR`` if set),
+        executes it there and copies the finished run directory back
+        to the experiment directory. This avoids many small file
+        operations on shared file systems. Archived builds ignore *jobs*
+        and *deduplicate_resources* and can't be combined with
+        *compact*.
+
         """
+        if not isinstance(jobs, int) or jobs < 1:
+            logging.critical(f"jobs must be a positive integer: {jobs}")
+        if compact and archive:
+            logging.critical("Compact builds can't be archived.")
         if not write_to_disk:
             return
 
         logging.info('Experiment path: "%s"' % self.path)
-        self._remove_experiment_dir()
+        self._run_summaries = {}
+        if incremental:
+            run_fingerprints = self._compute_run_fingerprints()
+        if incremental and os.path.exists(self._get_abs_path(BUILD_MANIFEST_FILENAME)):
+            kept_runs, self._run_ids_to_start = self._plan_incremental_build(
+                run_fingerprints
+            )
+            self._remove_outdated_files(kept_runs)
+            run_ids_to_build = [
+                run_id
+                for run_id in range(1, len(self.runs) + 1)
+                if run_id not in kept_runs
+            ]
+        else:
+            self._remove_experiment_dir()
+            self._run_ids_to_start = None
+            run_ids_to_build = list(range(1, len(self.runs) + 1))
         tools.makedirs(self.path)
+        if deduplicate_resources:
+            self._resource_store = tools.ResourceStore(
+                os.path.join(self.path, RESOURCE_STORE_DIR)
+            )
+        if compact:
+            self._build_run_specs()
+        elif archive:
+            self._build_run_archive()
+        else:
+            self._build_runs(jobs, run_ids_to_build)
+        # The environment uses the run summaries collected while writing
+        # the runs, so that it doesn't have to expand them again.
         self.environment.write_main_script()
+        if compact or archive:
+            self.add_new_file(
+                "",
+                runner.RUNNER_FILENAME,
+                tools.fill_template("runner.py"),
+                permissions=0o755,
+            )
 
         self._build_new_files()
         self._build_resources()
-        self._build_runs()
         self._build_properties_file(STATIC_EXPERIMENT_PROPERTIES_FILENAME)
+        self._write_property_groups()
+        if incremental:
+            self._write_build_manifest(run_fingerprints)
+        self._write_run_dir_index()
+
+    def _compute_run_fingerprints(self):
+        """Return the ID string and specification hash of each run in run order.
+
+        Also store the summaries of the runs.
+        """
+        path_signatures = {}
+        # Changes to the experiment affect all runs.
+        exp_spec = self._get_spec(path_signatures)
+        del exp_spec["properties"]
+        run_fingerprints = []
+        for run_id, run in enumerate(self.runs, 1):
+            run = run._expand()
+            run._check_id()
+            self._run_summaries[run_id] = _get_run_summary(run)
+            run_spec = run._get_spec(path_signatures)
+            run_spec["property_groups"] = [
+                self._property_groups[key]
+                for key in run.properties.get("property_groups", [])
+            ]
+            run_fingerprints.append(
+                ("-".join(run.properties["id"]), _compute_spec_hash([exp_spec, run_spec]))
+            )
+        return run_fingerprints
+
+    def _write_property_groups(self):
+        if self._property_groups:
+            groups = tools.Properties(self._get_abs_path(tools.PROPERTY_GROUPS_FILENAME))
+            groups.update(self._property_groups)
+            groups.write()
+
+    def _load_build_manifest(self):
+        return tools.Properties(self._get_abs_path(BUILD_MANIFEST_FILENAME))
+
+    def _write_build_manifest(self, run_fingerprints):
+        manifest = tools.Properties(self._get_abs_path(BUILD_MANIFEST_FILENAME))
+        manifest.update(run_fingerprints)
+        manifest.write()
+
+    def _write_run_dir_index(self):
+        index = tools.Properties(self._get_abs_path(RUN_DIR_INDEX_FILENAME))
+        for run_id, (id_string, _, _) in sorted(self._run_summaries.items()):
+            index[id_string] = self.run_dir_layout.get_run_dir(run_id)
+        index.write()
+
+    def _plan_incremental_build(self, run_fingerprints):
+        """Compare the runs to the build manifest on disk.
+
+        Return a dictionary mapping the IDs of unchanged runs to their
+        current run directories and the sorted list of IDs of runs that
+        have to be started.
+        """
+        manifest = self._load_build_manifest()
+        old_run_dirs = load_run_dir_index(self.path)
+        kept_runs = {}
+        run_ids_to_start = []
+        seen_ids = set()
+        for run_id, (id_string, run_hash) in enumerate(run_fingerprints, 1):
+            if id_string in seen_ids:
+                logging.critical(f"Incremental builds need unique run IDs: {id_string}")
+            seen_ids.add(id_string)
+            old_run_dir = old_run_dirs.get(id_string)
+            if (
+                manifest.get(id_string) == run_hash
+                and old_run_dir
+                and os.path.isdir(self._get_abs_path(old_run_dir))
+            ):
+                kept_runs[run_id] = old_run_dir
+                if os.path.exists(
+                    self._get_abs_path(os.path.join(old_run_dir, "driver.log"))
+                ):
+                    continue
+            run_ids_to_start.append(run_id)
+        logging.info(
+            f"Keeping {len(kept_runs)} unchanged runs, starting "
+            f"{len(run_ids_to_start)} runs"
+        )
+        return kept_runs, run_ids_to_start
+
+    def _remove_outdated_files(self, kept_runs):
+        """Remove everything except the kept runs and move those into place."""
+        tmp_dir = self._get_abs_path("incremental-build-tmp")
+        if os.path.exists(tmp_dir):
+            tools.remove_path(tmp_dir)
+        layout = self.run_dir_layout
+        moved_runs = {
+            run_id: old_run_dir
+            for run_id, old_run_dir in kept_runs.items()
+            if old_run_dir != layout.get_run_dir(run_id)
+        }
+        for run_id, old_run_dir in moved_runs.items():
+            os.renames(
+                self._get_abs_path(old_run_dir), os.path.join(tmp_dir, str(run_id))
+            )
+
+        kept_run_dirs = {
+            layout.get_run_dir(run_id)
+            for run_id in kept_runs
+            if run_id not in moved_runs
+        }
+
+        def remove_outdated_run_dirs(shard_dir):
+            for name in os.listdir(shard_dir):
+                path = os.path.join(shard_dir, name)
+                if name.startswith("runs-") and os.path.isdir(path):
+                    remove_outdated_run_dirs(path)
+                elif self._get_rel_path(path) not in kept_run_dirs:
+                    tools.remove_path(path)
+            if not os.listdir(shard_dir):
+                os.rmdir(shard_dir)
+
+        for name in os.listdir(self.path):
+            path = self._get_abs_path(name)
+            if name in {os.path.basename(tmp_dir), RESOURCE_STORE_DIR}:
+                continue
+            if name.startswith("runs-") and os.path.isdir(path):
+                remove_outdated_run_dirs(path)
+            else:
+                tools.remove_path(path)
+
+        for run_id in moved_runs:
+            rel_run_dir = layout.get_run_dir(run_id)
+            os.renames(
+                os.path.join(tmp_dir, str(run_id)), self._get_abs_path(rel_run_dir)
+            )
+            static_props = tools.Properties(
+                os.path.join(
+                    self._get_abs_path(rel_run_dir), STATIC_RUN_PROPERTIES_FILENAME
+                )
+            )
+            static_props["run_dir"] = rel_run_dir
+            static_props.write()
 
     def start_runs(self):
         """Execute all runs that were added to the experiment.
@@ -672,23 +1205,125 @@ class Experiment(_Buildable):
         """
         self.environment.start_runs()
 
-    def _build_runs(self):
-        """
-        Uses the relative directory information and writes all runs to disc.
+    def show_status(self, prometheus_file=None):
+        """Print the progress of the runs of the experiment.
+
+        While a local experiment runs, the status is read from the
+        ``status`` file that the job updates every few seconds. For
+        grid experiments, it is collected from the run directories.
+        The status lists the number of finished, failed, running and
+        pending runs, the throughput, the estimated time until all runs
+        finish and the run that each worker executes. ::
+
+            exp.add_step("status", exp.show_status)
+
+        If *prometheus_file* is given, the status is also written to
+        this file in the textfile format of the Prometheus node
+        exporter. Its name must end in ``.prom``.
+
         """
+        status_file = os.path.join(self.path, status.STATUS_FILENAME)
+        if os.path.exists(status_file):
+            run_status = status.read_status_file(status_file)
+        else:
+            props = tools.Properties(
+                os.path.join(self.path, STATIC_EXPERIMENT_PROPERTIES_FILENAME)
+            )
+            run_status = status.get_grid_status(
+                get_run_dirs(self.path), props.get("runs", len(self.runs))
+            )
+        print(status.format_status(run_status))
+        if prometheus_file:
+            status.write_prometheus_file(prometheus_file, run_status, self.name)
+
+    def _build_run_specs(self):
+        """Write the specifications of all runs to a single indexed file."""
         if not self.runs:
             logging.critical("No runs have been added to the experiment.")
         num_runs = len(self.runs)
         self.set_property("runs", num_runs)
+        logging.info("Writing specifications of %d runs" % num_runs)
+        writer = runner.RunSpecsWriter(self.path)
+        try:
+            for run_id, run in enumerate(self.runs, 1):
+                run = run._expand()
+                writer.add(run._get_run_spec(run_id))
+                self._run_summaries[run_id] = _get_run_summary(run)
+        finally:
+            writer.close()
+        logging.info("Finished writing run specifications")
+
+    def _build_run_archive(self):
+        """Pack all run directories into a single indexed archive."""
+        if not self.runs:
+            logging.critical("No runs have been added to the experiment.")
+        num_runs = len(self.runs)
+        self.set_property("runs", num_runs)
+        logging.info("Packing %d runs" % num_runs)
+        writer = archive.RunArchiveWriter(self.path)
+        try:
+            for run_id, run in enumerate(self.runs, 1):
+                run = run._expand()
+                run._set_run_dir(run_id)
+                run._build_run_script()
+                writer.add(run._get_run_spec(run_id), STATIC_RUN_PROPERTIES_FILENAME)
+                self._run_summaries[run_id] = _get_run_summary(run)
+                if run_id % 100 == 0:
+                    logging.info("Pack run %6d/%d" % (run_id, num_runs))
+        finally:
+            writer.close()
+        logging.info("Finished packing runs")
+
+    def _build_runs(self, jobs=1, run_ids=None):
+        """
+        Uses the relative directory information and writes all runs to disc.
+
+        If given, only write the runs with the IDs in *run_ids*.
+        """
+        if not self.runs:
+            logging.critical("No runs have been added to the experiment.")
+        self.set_property("runs", len(self.runs))
+        if run_ids is None:
+            run_ids = list(range(1, len(self.runs) + 1))
+        num_runs = len(run_ids)
         logging.info("Building %d runs" % num_runs)
-        for index, run in enumerate(self.runs, 1):
-            if index % 100 == 0:
-                logging.info("Build run %6d/%d" % (index, num_runs))
-            for name, (command, kwargs) in self.commands.items():
-                run.add_command(name, command, **kwargs)
-            run.build(index)
+        if jobs == 1:
+            for index, run_id in enumerate(run_ids, 1):
+                if index % 100 == 0:
+                    logging.info("Build run %6d/%d" % (index, num_runs))
+                run = self.runs[run_id - 1]._expand()
+                run.build(run_id)
+                self._run_summaries[run_id] = _get_run_summary(run)
+        else:
+            self._build_runs_in_parallel(jobs, run_ids)
         logging.info("Finished building runs")
 
+    def _build_runs_in_parallel(self, jobs, run_ids):
+        global _EXPERIMENT_TO_BUILD
+        num_runs = len(run_ids)
+        logging.info(f"Building runs with {jobs} processes")
+        _EXPERIMENT_TO_BUILD = self
+        # Workers need the runs, so we have to fork them.
+        pool = multiprocessing.get_context("fork").Pool(processes=jobs)
+        try:
+            # Let each worker build whole shards. Results arrive in order,
+            # so we can log the progress exactly like a sequential build.
+            results = pool.imap(
+                _build_run, run_ids, chunksize=self.run_dir_layout.shard_size
+            )
+            for index, (run_id, (summary, error)) in enumerate(
+                zip(run_ids, results), 1
+            ):
+                if error:
+                    logging.critical(f"Building run {run_id} failed: {error}")
+                self._run_summaries[run_id] = summary
+                if index % 100 == 0:
+                    logging.info("Build run %6d/%d" % (index, num_runs))
+        finally:
+            pool.terminate()
+            pool.join()
+            _EXPERIMENT_TO_BUILD = None
+
 
 class Run(_Buildable):
     """
@@ -706,15 +1341,50 @@ class Run(_Buildable):
         self.experiment = experiment
         self.path = None
 
+    def add_property_group(self, properties):
+        """Add the dictionary *properties* to the run's properties.
+
+        Use this method for properties that many runs share, e.g., the
+        settings of an algorithm. Each distinct group is stored only
+        once in the experiment directory and the runs only store a
+        reference to it. The fetcher keeps this representation in the
+        evaluation directory and reports expand the groups when they
+        load the properties. Properties that are set with
+        :meth:`.set_property` take precedence over groups.
+
+        >>> exp = Experiment()
+        >>> run = exp.add_run()
+        >>> run.add_property_group({'algorithm': 'astar', 'search': 'astar()'})
+
+        """
+        key = _compute_spec_hash(properties)
+        self.experiment._property_groups[key] = properties
+        groups = self.properties.setdefault("property_groups", [])
+        if key not in groups:
+            groups.append(key)
+
+    def _expand(self):
+        """Return the run object that is written to disk for this run.
+
+        Entries of ``Experiment.runs`` may be compact placeholders that
+        create their run object only while the run is written. A
+        regular run is its own run object.
+
+        """
+        return self
+
+    def _set_run_dir(self, run_id):
+        rel_run_dir = self.experiment.run_dir_layout.get_run_dir(run_id)
+        self.set_property("run_dir", rel_run_dir)
+        self.path = os.path.join(self.experiment.path, rel_run_dir)
+
     def build(self, run_id):
         """Write the run's files to disk.
 
         This method is called automatically by the experiment.
 
         """
-        rel_run_dir = get_run_dir(run_id)
-        self.set_property("run_dir", rel_run_dir)
-        self.path = os.path.join(self.experiment.path, rel_run_dir)
+        self._set_run_dir(run_id)
         os.makedirs(self.path)
 
         # We need to build the run script before the resources, because
@@ -725,8 +1395,63 @@ class Run(_Buildable):
         self._check_id()
         self._build_properties_file(STATIC_RUN_PROPERTIES_FILENAME)
 
-    def _build_run_script(self):
-        if not self.commands:
+    def _get_run_spec(self, run_id):
+        """Return everything the generic runner needs for executing this run.
+
+        This method is called automatically by the experiment for
+        compact experiment layouts (see :mod:`lab.runner`).
+
+        """
+        self._set_run_dir(run_id)
+        self._check_id()
+        resources = []
+        for resource in self.resources:
+            if not os.path.exists(resource.source):
+                logging.critical(f"Resource not found: {resource.source}")
+            dest = self._get_abs_path(resource.dest)
+            if dest.startswith(self.path):
+                resources.append(
+                    [os.path.abspath(resource.source), resource.dest, resource.symlink]
+                )
+        return {
+            "run_dir": self.properties["run_dir"],
+            "calls": self._get_calls(),
+            "new_files": self.new_files,
+            "resources": resources,
+            "properties": self.properties,
+            "sync_output": self.experiment.durability == "run",
+            # Parsers are commands with the same name as their resource.
+            "parsers": [
+                resource.name
+                for resource in self.experiment.resources
+                if resource.is_parser
+            ],
+        }
+
+    def _get_memory_limit(self):
+        """Return the highest memory limit (in MiB) of the run's commands.
+
+        The commands of a run are executed one after the other, so this
+        is the most memory the run may use. Return None if no command
+        has a memory limit.
+        """
+        limits = [
+            kwargs["memory_limit"]
+            for _, kwargs in list(self.commands.values())
+            + list(self.experiment.commands.values())
+            if kwargs.get("memory_limit") is not None
+        ]
+        return max(limits, default=None)
+
+    def _get_resource_store(self):
+        return self.experiment._resource_store
+
+    def _get_calls(self):
+        """Return the arguments and keyword arguments for all commands.
+
+        Resource names in the commands are replaced by paths.
+        """
+        if not self.commands and not self.experiment.commands:
             logging.critical("Please add at least one command")
 
         exp_vars = self.experiment._env_vars
@@ -741,41 +1466,56 @@ class Run(_Buildable):
         env_vars.update(run_vars)
         env_vars = self._prepare_env_vars(env_vars)
 
-        def make_call(name, cmd, kwargs):
-            kwargs["name"] = name
-
-            # Support running globally installed binaries.
-            def format_arg(arg):
-                if isinstance(arg, str):
-                    try:
-                        return repr(arg.format(**env_vars))
-                    except KeyError as err:
-                        logging.critical(f"Resource {err} is undefined.")
-                else:
-                    return repr(str(arg))
-
-            def format_key_value_pair(key, val):
-                if isinstance(val, str):
-                    formatted_value = format_arg(val)
-                else:
-                    formatted_value = repr(val)
-                return f"{key}={formatted_value}"
-
-            cmd_string = "[{}]".format(", ".join([format_arg(arg) for arg in cmd]))
-            kwargs_string = ", ".join(
-                format_key_value_pair(key, value)
-                for key, value in sorted(kwargs.items())
+        # Support running globally installed binaries.
+        def format_arg(arg):
+            if isinstance(arg, str):
+                try:
+                    return arg.format(**env_vars)
+                except KeyError as err:
+                    logging.critical(f"Resource {err} is undefined.")
+            else:
+                return str(arg)
+
+        # Experiment commands are appended to the commands of each run.
+        commands = list(self.commands.items())
+        for name, command in self.experiment.commands.items():
+            if name in self.commands:
+                logging.critical(f"Command names must be unique: {name}")
+            commands.append((name, command))
+
+        calls = []
+        for name, (cmd, kwargs) in commands:
+            kwargs = dict(kwargs, name=name)
+            if self.experiment.durability != "command":
+                kwargs["fsync"] = False
+            if self.experiment.limit_backend != "rlimit":
+                kwargs.setdefault("limit_backend", self.experiment.limit_backend)
+            calls.append(
+                (
+                    [format_arg(arg) for arg in cmd],
+                    {
+                        key: format_arg(value) if isinstance(value, str) else value
+                        for key, value in kwargs.items()
+                    },
+                )
             )
-            parts = [cmd_string]
-            if kwargs_string:
-                parts.append(kwargs_string)
+        return calls
+
+    def _build_run_script(self):
+        def make_call(args, kwargs):
+            parts = [repr(args)] + [
+                f"{key}={value!r}" for key, value in sorted(kwargs.items())
+            ]
             return "Call({}, **redirects).wait()\n".format(", ".join(parts))
 
         calls_text = "\n".join(
-            make_call(name, cmd, kwargs)
-            for name, (cmd, kwargs) in self.commands.items()
+            make_call(args, kwargs) for args, kwargs in self._get_calls()
+        )
+        run_script = tools.fill_template(
+            "run.py",
+            calls=calls_text,
+            sync_output=self.experiment.durability == "run",
         )
-        run_script = tools.fill_template("run.py", calls=calls_text)
 
         self.add_new_file("", "run", run_script, permissions=0o755)
 
@@ -18,7 +18,7 @@ import logging
 import os
 import sys
 
-from lab import tools
+from lab import archive, results_log, runner, tools
 import lab.experiment
 
 
@@ -33,7 +33,7 @@ def _check_eval_dir(eval_dir):
             .lower()
         )
         if answer == "o":
-            tools.remove_path(eval_dir)
+            tools.remove_path(eval_dir, background=True)
         elif answer == "m":
             pass
         elif answer == "c":
@@ -43,6 +43,13 @@ def _check_eval_dir(eval_dir):
             logging.critical(f'Invalid answer: "{answer}"')
 
 
+def _filter_runs(run_filter, props, property_groups):
+    if run_filter.filters:
+        # Filters need to see all properties of a run.
+        tools.expand_property_groups(props, property_groups)
+    run_filter.apply(props)
+
+
 class Fetcher:
     """
     Collect data from the runs of an experiment and store it in an
@@ -59,34 +66,7 @@ class Fetcher:
     """
 
     def fetch_dir(self, run_dir):
-        static_props = tools.Properties(
-            filename=os.path.join(
-                run_dir, lab.experiment.STATIC_RUN_PROPERTIES_FILENAME
-            )
-        )
-        dynamic_props = tools.Properties(filename=os.path.join(run_dir, "properties"))
-
-        props = tools.Properties()
-        props.update(static_props)
-        props.update(dynamic_props)
-
-        driver_log = os.path.join(run_dir, "driver.log")
-        if not os.path.exists(driver_log):
-            props.add_unexplained_error(
-                "driver.log is missing. Probably the run was never started."
-            )
-
-        driver_err = os.path.join(run_dir, "driver.err")
-        run_err = os.path.join(run_dir, "run.err")
-        for logfile in [driver_err, run_err]:
-            if os.path.exists(logfile):
-                with open(logfile) as f:
-                    content = f.read()
-                if content:
-                    props.add_unexplained_error(
-                        "{}: {}".format(os.path.basename(logfile), content)
-                    )
-        return props
+        return results_log.read_run_dir(run_dir)
 
     def __call__(self, src_dir, eval_dir=None, merge=None, filter=None, **kwargs):
         """
@@ -114,16 +94,18 @@ class Fetcher:
             # No action needed, data will be merged.
             pass
         else:
-            tools.remove_path(eval_dir)
+            tools.remove_path(eval_dir, background=True)
 
         # Load properties in the eval_dir if there are any already.
         combined_props = tools.Properties(os.path.join(eval_dir, "properties"))
-        fetch_from_eval_dir = not os.path.exists(
-            os.path.join(src_dir, "runs-00001-00100")
-        )
+        combined_groups = tools.load_property_groups(eval_dir)
+        src_groups = tools.load_property_groups(src_dir)
+        fetch_from_eval_dir = not glob(
+            os.path.join(src_dir, "runs-*-*")
+        ) and not runner.uses_runner(src_dir)
         if fetch_from_eval_dir:
             src_props = tools.Properties(filename=os.path.join(src_dir, "properties"))
-            run_filter.apply(src_props)
+            _filter_runs(run_filter, src_props, src_groups)
             combined_props.update(src_props)
             logging.info("Fetched properties of {} runs.".format(len(src_props)))
         else:
@@ -132,7 +114,18 @@ class Fetcher:
                 logging.error("There was output to *-grid-steps/slurm.err")
 
             new_props = tools.Properties()
-            run_dirs = sorted(glob(os.path.join(src_dir, "runs-*-*", "*")))
+            # Finished runs appended their properties to the results log.
+            logged_props = results_log.read_results_log(src_dir)
+            if logged_props:
+                logging.info(
+                    f"Read properties of {len(logged_props):d} runs from the "
+                    f"results log"
+                )
+            for props in logged_props.values():
+                if slurm_err_content:
+                    tools.add_unexplained_error(props, "output-to-slurm.err")
+                new_props["-".join(props["id"])] = props
+            run_dirs = lab.experiment.get_run_dirs(src_dir, exclude=logged_props)
             total_dirs = len(run_dirs)
             logging.info(f"Scanning properties from {total_dirs:d} run directories")
             for index, run_dir in enumerate(run_dirs, start=1):
@@ -143,8 +136,31 @@ class Fetcher:
                     props.add_unexplained_error("output-to-slurm.err")
                 id_string = "-".join(props["id"])
                 new_props[id_string] = props
-            run_filter.apply(new_props)
+            if runner.has_run_specs(src_dir):
+                # Compact experiments have no directories for unstarted runs.
+                for spec in runner.read_run_specs(src_dir):
+                    if spec["run_dir"] in logged_props:
+                        continue
+                    run_dir = os.path.join(src_dir, spec["run_dir"])
+                    if not os.path.isdir(run_dir):
+                        props = self.fetch_dir(run_dir)
+                        props.update(spec["properties"])
+                        new_props["-".join(props["id"])] = props
+            elif archive.has_run_archive(src_dir):
+                # Archived experiments have no directories for unstarted runs.
+                for run_dir, static_props in archive.read_static_run_properties(
+                    src_dir, lab.experiment.STATIC_RUN_PROPERTIES_FILENAME
+                ):
+                    if run_dir in logged_props:
+                        continue
+                    run_dir = os.path.join(src_dir, run_dir)
+                    if not os.path.isdir(run_dir):
+                        props = self.fetch_dir(run_dir)
+                        props.update(static_props)
+                        new_props["-".join(props["id"])] = props
+            _filter_runs(run_filter, new_props, src_groups)
             combined_props.update(new_props)
+        combined_groups.update(src_groups)
 
         unexplained_errors = 0
         for props in combined_props.values():
@@ -155,6 +171,8 @@ class Fetcher:
 
         tools.makedirs(eval_dir)
         combined_props.write()
+        if combined_groups:
+            combined_groups.write()
         logging.info(
             "Wrote properties file (contains {unexplained_errors} "
             "runs with unexplained errors).".format(**locals())
@@ -0,0 +1,689 @@
+# Lab is a Python package for evaluating algorithms.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Execute the runs of an experiment on the local machine.
+
+The executor treats each usable CPU core as a slot. A run occupies as
+many slots as it needs cores (run property ``cores``, default 1) and,
+if possible, is pinned to its cores with ``os.sched_setaffinity``.
+Cores are grouped by NUMA node and the cores of a run are taken from a
+single node whenever possible.
+
+Runs may also declare how much memory they need (the highest
+``memory_limit`` of their commands). The executor only starts a run if
+the declared memory of all running runs plus the new run fits into the
+memory budget. In addition, it postpones new runs while the machine
+has too little available memory (``MemAvailable`` in ``/proc/meminfo``)
+or spends too much time stalled on memory (``/proc/pressure/memory``).
+
+Instead of starting a new Python interpreter for each run, the executor
+can also fork itself and execute a Python function in the child
+process, e.g., :func:`lab.runner.execute_run_in_process`. This avoids
+the startup cost of the interpreter and the ``lab`` imports.
+
+The executor can record the runs it starts and finishes in an
+append-only journal. If the job is interrupted, it can be resumed:
+finished runs are skipped and interrupted runs are started again.
+"""
+
+from collections import deque
+import glob
+import logging
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+import traceback
+
+from lab.status import STATUS_INTERVAL
+
+
+def _parse_cpu_list(text):
+    """
+    >>> _parse_cpu_list("0-3,8,10-11")
+    [0, 1, 2, 3, 8, 10, 11]
+    """
+    cores = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        lower, _, upper = part.partition("-")
+        cores.extend(range(int(lower), int(upper or lower) + 1))
+    return cores
+
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _get_cgroup_v2_dirs():
+    """Return the cgroup v2 directory of this process and the root directory."""
+    cgroup_dirs = []
+    for line in (_read_file("/proc/self/cgroup") or "").splitlines():
+        if line.startswith("0::"):
+            cgroup_dirs.append(os.path.join("/sys/fs/cgroup", line[3:].lstrip("/")))
+    return cgroup_dirs + ["/sys/fs/cgroup"]
+
+
+def _get_cgroup_cpu_limit():
+    """Return the number of cores allowed by the CPU quota of our cgroup or None."""
+    # cgroup v2: the quota is in cpu.max of the cgroup of this process.
+    for path in _get_cgroup_v2_dirs():
+        content = _read_file(os.path.join(path, "cpu.max"))
+        if content:
+            quota, _, period = content.partition(" ")
+            if quota == "max":
+                return None
+            return max(1, math.ceil(int(quota) / int(period)))
+    # cgroup v1
+    quota = _read_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return max(1, math.ceil(int(quota) / int(period)))
+    return None
+
+
+def _get_affinity():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def get_core_groups():
+    """Return the cores that this process may use, grouped by NUMA node.
+
+    The cores are taken from the affinity mask of the process. If a
+    cgroup CPU quota allows fewer cores, the cores are picked from all
+    NUMA nodes in turn.
+    """
+    affinity = _get_affinity()
+    groups = []
+    for node_dir in sorted(glob.glob("/sys/devices/system/node/node[0-9]*")):
+        cpu_list = _read_file(os.path.join(node_dir, "cpulist"))
+        if cpu_list is not None:
+            cores = [core for core in _parse_cpu_list(cpu_list) if core in affinity]
+            if cores:
+                groups.append(cores)
+    grouped_cores = {core for group in groups for core in group}
+    if not groups or grouped_cores != set(affinity):
+        # NUMA information is missing or incomplete.
+        groups = [affinity]
+
+    limit = _get_cgroup_cpu_limit()
+    if limit is not None and limit < len(affinity):
+        groups = _select_cores(groups, limit)
+    return groups
+
+
+def _select_cores(groups, num_cores):
+    """Pick *num_cores* cores from the groups in round-robin fashion.
+
+    >>> _select_cores([[0, 1, 2, 3], [4, 5, 6, 7]], 3)
+    [[0, 1], [4]]
+    """
+    selected = [[] for _ in groups]
+    queues = [deque(group) for group in groups]
+    while num_cores > 0:
+        for index, queue in enumerate(queues):
+            if queue and num_cores > 0:
+                selected[index].append(queue.popleft())
+                num_cores -= 1
+    return [group for group in selected if group]
+
+
+def get_num_usable_cores():
+    return sum(len(group) for group in get_core_groups())
+
+
+def _parse_meminfo(text):
+    """Return the values from /proc/meminfo in MiB.
+
+    >>> info = _parse_meminfo("MemTotal: 16384000 kB\\nMemAvailable: 8192000 kB")
+    >>> info["MemTotal"], info["MemAvailable"]
+    (16000, 8000)
+    """
+    info = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(":")
+        parts = value.split()
+        if parts and parts[0].isdigit():
+            info[key] = int(parts[0]) // 1024 if parts[1:] == ["kB"] else int(parts[0])
+    return info
+
+
+def _parse_memory_pressure(text):
+    """Return the share of time (in percent) in which some tasks were
+    stalled on memory during the last ten seconds.
+
+    >>> _parse_memory_pressure(
+    ...     "some avg10=1.50 avg60=0.20 avg300=0.00 total=123\\n"
+    ...     "full avg10=0.70 avg60=0.10 avg300=0.00 total=45")
+    1.5
+    """
+    for line in text.splitlines():
+        kind, *fields = line.split()
+        if kind == "some":
+            values = dict(field.split("=") for field in fields)
+            return float(values["avg10"])
+    return None
+
+
+def _get_cgroup_memory_limit():
+    """Return the memory limit (in MiB) of our cgroup or None."""
+    for path in _get_cgroup_v2_dirs():
+        content = _read_file(os.path.join(path, "memory.max"))
+        if content:
+            return None if content == "max" else int(content) // 2**20
+    content = _read_file("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    if content and int(content) < 2**60:
+        return int(content) // 2**20
+    return None
+
+
+def get_total_memory():
+    """Return the memory (in MiB) that runs may use together.
+
+    This is the physical memory of the machine or the memory limit of
+    our cgroup, whichever is lower. Return None if it is unknown.
+    """
+    meminfo = _parse_meminfo(_read_file("/proc/meminfo") or "")
+    limits = [meminfo.get("MemTotal"), _get_cgroup_memory_limit()]
+    return min((limit for limit in limits if limit is not None), default=None)
+
+
+# Files that a run writes into its run directory when it executes.
+RUN_OUTPUT_FILES = ["properties", "run.log", "run.err", "driver.log", "driver.err"]
+
+
+def reset_run_dir(run_dir):
+    """Remove the files that a previous, interrupted attempt of the run
+    in *run_dir* wrote, so that a new attempt starts from scratch."""
+    for filename in RUN_OUTPUT_FILES:
+        path = os.path.join(run_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class MemoryMonitor:
+    """Keep track of the memory that runs declare and that is available.
+
+    A run may only start if its declared memory and the declared memory
+    of all running runs fit into *budget* MiB. If *budget* is None, only
+    the live signals are considered.
+
+    The live signals make the executor wait if fewer than
+    *min_available* MiB (default: the declared memory of the new run)
+    are available or if the memory pressure (percentage of time in
+    which some tasks were stalled on memory during the last ten
+    seconds) exceeds *max_pressure*.
+
+    >>> monitor = MemoryMonitor(budget=8000)
+    >>> monitor.fits(5000)
+    True
+    >>> monitor.reserve(5000)
+    >>> monitor.fits(4000), monitor.fits(None)
+    (False, True)
+    >>> monitor.release(5000)
+    >>> monitor.fits(8000)
+    True
+    """
+
+    def __init__(self, budget=None, min_available=None, max_pressure=10.0):
+        self.budget = budget
+        self.min_available = min_available
+        self.max_pressure = max_pressure
+        self.reserved = 0
+
+    def fits(self, memory):
+        return self.budget is None or self.reserved + (memory or 0) <= self.budget
+
+    def reserve(self, memory):
+        self.reserved += memory or 0
+
+    def release(self, memory):
+        self.reserved -= memory or 0
+
+    def get_shortage(self, memory):
+        """Return a description of the memory shortage or None if a run
+        that needs *memory* MiB may start now."""
+        meminfo = _parse_meminfo(_read_file("/proc/meminfo") or "")
+        available = meminfo.get("MemAvailable")
+        min_available = self.min_available
+        if min_available is None:
+            min_available = memory or 0
+        if available is not None and available < min_available:
+            return f"only {available} MiB of memory available"
+        pressure = _parse_memory_pressure(_read_file("/proc/pressure/memory") or "")
+        if pressure is not None and pressure > self.max_pressure:
+            return f"memory pressure is {pressure:.1f}%"
+        return None
+
+
+class CoreAllocator:
+    """Assign sets of cores to runs.
+
+    *core_groups* is a list of lists of cores, one list per NUMA node.
+
+    >>> allocator = CoreAllocator([[0, 1, 2, 3], [4, 5]])
+    >>> allocator.allocate(2)
+    [4, 5]
+    >>> allocator.allocate(3)
+    [0, 1, 2]
+    >>> allocator.allocate(2) is None
+    True
+    >>> allocator.release([4, 5])
+    >>> allocator.allocate(3)
+    [3, 4, 5]
+    """
+
+    def __init__(self, core_groups):
+        self.free = [list(group) for group in core_groups]
+        self._group_index = {
+            core: index for index, group in enumerate(core_groups) for core in group
+        }
+
+    @property
+    def num_free(self):
+        return sum(len(group) for group in self.free)
+
+    def allocate(self, num_cores):
+        """Return a list of *num_cores* free cores or None if there are
+        not enough free cores."""
+        if num_cores > self.num_free:
+            return None
+        # Prefer the NUMA node that fits the run most tightly.
+        fitting = [group for group in self.free if len(group) >= num_cores]
+        if fitting:
+            group = min(fitting, key=len)
+            cores, group[:] = group[:num_cores], group[num_cores:]
+            return cores
+        # Otherwise, spread the run over the nodes with the most free cores.
+        cores = []
+        for group in sorted(self.free, key=len, reverse=True):
+            taken = group[: num_cores - len(cores)]
+            del group[: len(taken)]
+            cores.extend(taken)
+        return sorted(cores)
+
+    def release(self, cores):
+        for core in cores:
+            self.free[self._group_index[core]].append(core)
+        for group in self.free:
+            group.sort()
+
+
+RUN_JOURNAL_FILENAME = "run-journal"
+
+
+class RunJournal:
+    """Append-only record of started and finished runs in *path*.
+
+    Each line is either ``started <run_id>`` or ``finished <run_id>
+    <returncode> <ok|error>``. If *resume* is True, the existing
+    entries are loaded and new entries are appended. Otherwise, the
+    journal is cleared.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), RUN_JOURNAL_FILENAME)
+    >>> journal = RunJournal(path)
+    >>> for run_id in [1, 2, 3]:
+    ...     journal.record_start(run_id)
+    >>> journal.record_finish(1, 0, error=False)
+    >>> journal.record_finish(3, 1, error=True)
+    >>> journal.close()
+    >>> journal = RunJournal(path, resume=True)
+    >>> journal.finished, journal.failed, journal.interrupted
+    ({1, 3}, {3}, {2})
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.finished = set()
+        self.failed = set()
+        self.interrupted = set()
+        if resume and os.path.exists(path):
+            self._load()
+        self.file = open(path, "a" if resume else "w", buffering=1)
+
+    def _load(self):
+        started = set()
+        complete_size = 0
+        with open(self.path) as f:
+            for line in f:
+                # A line without newline was cut off by a crash.
+                if not line.endswith("\n"):
+                    break
+                complete_size += len(line)
+                event, run_id, *status = line.split()
+                if event == "started":
+                    started.add(int(run_id))
+                elif event == "finished":
+                    self.finished.add(int(run_id))
+                    if status[-1] != "ok":
+                        self.failed.add(int(run_id))
+                    else:
+                        self.failed.discard(int(run_id))
+        self.interrupted = started - self.finished
+        # Drop a cut-off line, so that new entries start on a new line.
+        os.truncate(self.path, complete_size)
+
+    def record_start(self, run_id):
+        self.file.write(f"started {run_id}\n")
+
+    def record_finish(self, run_id, returncode, error):
+        status = "error" if error else "ok"
+        self.file.write(f"finished {run_id} {returncode} {status}\n")
+
+    def close(self):
+        self.file.close()
+
+
+class _ForkedProcess:
+    """Child process that executes a Python function (see :meth:`start`)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    @classmethod
+    def start(cls, function, stdout, stderr, cwd, preexec_fn=None):
+        """Fork and call *function* in the child process.
+
+        The return value of *function* is the exit code of the child.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            return cls(pid)
+        retcode = 1
+        try:
+            os.dup2(stdout.fileno(), 1)
+            os.dup2(stderr.fileno(), 2)
+            os.chdir(cwd)
+            if preexec_fn:
+                preexec_fn()
+            retcode = function() or 0
+        except SystemExit as err:
+            if isinstance(err.code, str):
+                print(err.code, file=sys.stderr)
+            else:
+                retcode = err.code or 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # Skip the cleanup handlers of the parent process.
+            os._exit(retcode)
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+class _Task:
+    def __init__(self, index, task_id, run_id, run_dir, cmd, cores, memory):
+        self.index = index
+        self.task_id = task_id
+        self.run_id = run_id
+        self.run_dir = run_dir
+        self.cmd = cmd
+        self.cores = cores
+        self.memory = memory
+
+
+def format_cores(cores):
+    """Return a compact description of the sorted list of *cores*.
+
+    >>> format_cores([0, 1, 2, 5, 7, 8])
+    '0-2,5,7-8'
+    """
+    parts = []
+    for core in cores:
+        if parts and parts[-1][1] == core - 1:
+            parts[-1][1] = core
+        else:
+            parts.append([core, core])
+    return ",".join(
+        str(lower) if lower == upper else f"{lower}-{upper}" for lower, upper in parts
+    )
+
+
+class LocalExecutor:
+    """Start runs on *processes* cores of the local machine.
+
+    If *pin_cores* is True and the platform supports it, each run is
+    restricted to its assigned cores. *memory_monitor* is a
+    :class:`MemoryMonitor` that decides whether there is enough memory
+    for starting another run. If *journal* is a :class:`RunJournal`,
+    the executor records the start and end of each run in it. Runs
+    that are aborted because the executor is interrupted don't count
+    as finished. If *status* is a :class:`lab.status.StatusFile`, the
+    executor reports its progress in it. If *results_log* is a
+    :class:`lab.results_log.ResultsLog`, the executor appends the
+    properties of each finished run to it.
+    """
+
+    # Bounds (in seconds) for waiting until the memory shortage is over.
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 30
+
+    def __init__(
+        self,
+        processes,
+        pin_cores=True,
+        memory_monitor=None,
+        journal=None,
+        status=None,
+        results_log=None,
+    ):
+        groups = get_core_groups()
+        if processes < sum(len(group) for group in groups):
+            groups = _select_cores(groups, processes)
+        self.allocator = CoreAllocator(groups)
+        self.pin_cores = pin_cores and hasattr(os, "sched_setaffinity")
+        self.memory_monitor = memory_monitor or MemoryMonitor()
+        self.journal = journal
+        self.status = status
+        self.results_log = results_log
+        self._interrupted = False
+        self._pending = {}
+        self._num_tasks = 0
+        self._running = {}
+        self._errors = False
+        self._backoff = 0
+        self._postponing = False
+
+    def add_task(self, task_id, run_id, run_dir, cmd, cores=1, memory=None):
+        """Queue the run with the given IDs for execution.
+
+        *cmd* is either a command line or a function without arguments
+        that is called in a forked child process and returns the exit
+        code. The run needs *cores* cores and at most *memory* MiB.
+
+        Runs are started in the order in which they are added, but a
+        run with smaller requirements may overtake a run that has to
+        wait for enough free cores or memory.
+        """
+        if cores > self.allocator.num_free:
+            logging.critical(
+                f"Run {run_id} needs {cores} cores, but only "
+                f"{self.allocator.num_free} are available."
+            )
+        budget = self.memory_monitor.budget
+        if memory is not None and budget is not None and memory > budget:
+            logging.critical(
+                f"Run {run_id} needs {memory} MiB, but the memory budget "
+                f"is {budget} MiB."
+            )
+        queue = self._pending.setdefault((cores, memory), deque())
+        queue.append(
+            _Task(self._num_tasks, task_id, run_id, run_dir, cmd, cores, memory)
+        )
+        self._num_tasks += 1
+
+    def _pop_next_task(self):
+        # Among the first tasks for each combination of requirements,
+        # pick the earliest one that fits.
+        num_free = self.allocator.num_free
+        candidates = [
+            queue[0]
+            for (cores, memory), queue in self._pending.items()
+            if queue and cores <= num_free and self.memory_monitor.fits(memory)
+        ]
+        if not candidates:
+            return None
+        task = min(candidates, key=lambda task: task.index)
+        if self._running:
+            # Without running runs, waiting wouldn't free any memory.
+            shortage = self.memory_monitor.get_shortage(task.memory)
+            if shortage:
+                self._backoff = min(
+                    max(2 * self._backoff, self.MIN_BACKOFF), self.MAX_BACKOFF
+                )
+                if not self._postponing:
+                    # Log only when the shortage begins, not on every retry.
+                    logging.info(f"Postponing new runs: {shortage}")
+                    self._postponing = True
+                return None
+        if self._postponing:
+            logging.info("Resuming to start new runs")
+            self._postponing = False
+        self._backoff = 0
+        self._pending[(task.cores, task.memory)].popleft()
+        return task
+
+    def _start(self, task):
+        cores = self.allocator.allocate(task.cores)
+        self.memory_monitor.reserve(task.memory)
+        driver_log = open(os.path.join(task.run_dir, "driver.log"), "w")
+        driver_err = open(os.path.join(task.run_dir, "driver.err"), "w")
+        if self.pin_cores:
+            location = f" on cores {format_cores(cores)}"
+
+            def preexec_fn():
+                os.sched_setaffinity(0, cores)
+
+        else:
+            location = ""
+            preexec_fn = None
+        logging.info(
+            f"Starting run {task.run_id} (TASK_ID {task.task_id}) "
+            f"in {task.run_dir}{location}"
+        )
+        try:
+            if callable(task.cmd):
+                process = _ForkedProcess.start(
+                    task.cmd, driver_log, driver_err, task.run_dir, preexec_fn
+                )
+            else:
+                process = subprocess.Popen(
+                    task.cmd,
+                    cwd=task.run_dir,
+                    stdout=driver_log,
+                    stderr=driver_err,
+                    preexec_fn=preexec_fn,
+                )
+        except OSError as err:
+            driver_err.write(f"Could not start run: {err}\n")
+            driver_err.flush()
+            self._finish(task, cores, driver_log, driver_err, returncode=None)
+            return
+        if self.journal:
+            self.journal.record_start(task.run_id)
+        if self.status:
+            self.status.record_start(format_cores(cores), task.run_id, task.run_dir)
+        self._running[process.pid] = (process, task, cores, driver_log, driver_err)
+
+    def _finish(self, task, cores, driver_log, driver_err, returncode):
+        self.allocator.release(cores)
+        self.memory_monitor.release(task.memory)
+        for f in [driver_log, driver_err]:
+            f.close()
+        error = returncode != 0 or os.path.getsize(driver_err.name) != 0
+        if error:
+            self._errors = True
+        if self.journal and returncode is not None and not self._interrupted:
+            self.journal.record_finish(task.run_id, returncode, error)
+        if self.status and returncode is not None:
+            self.status.record_finish(format_cores(cores), error)
+        for f in [driver_log, driver_err]:
+            if os.path.getsize(f.name) == 0:
+                os.remove(f.name)
+        if self.results_log and returncode is not None and not self._interrupted:
+            self.results_log.append_run(task.run_dir)
+
+    def _wait_for_any(self, timeout=None):
+        """Wait until a run finishes or *timeout* seconds have passed."""
+        if timeout is None:
+            pid, status = os.waitpid(-1, 0)
+        else:
+            deadline = time.monotonic() + timeout
+            delay = 0.001
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            while pid == 0 and time.monotonic() < deadline:
+                time.sleep(delay)
+                # Poll quickly at first, so that short runs are reaped fast.
+                delay = min(2 * delay, 0.1)
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+        if pid not in self._running:
+            return
+        process, task, cores, driver_log, driver_err = self._running.pop(pid)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        self._finish(task, cores, driver_log, driver_err, process.returncode)
+
+    def run(self):
+        """Execute all queued runs and return True iff all runs succeeded."""
+        try:
+            while self._running or any(self._pending.values()):
+                task = self._pop_next_task()
+                while task:
+                    self._start(task)
+                    task = self._pop_next_task()
+                if self._running:
+                    timeout = self._backoff or None
+                    if self.status:
+                        # Wake up regularly to refresh the status file.
+                        timeout = min(timeout or STATUS_INTERVAL, STATUS_INTERVAL)
+                    self._wait_for_any(timeout=timeout)
+                    if self.status:
+                        self.status.write()
+        except KeyboardInterrupt:
+            logging.warning("Main script interrupted")
+            self._interrupted = True
+            for process, *_ in self._running.values():
+                process.terminate()
+            while self._running:
+                self._wait_for_any()
+            self._errors = True
+        if self.status:
+            self.status.write(force=True)
+        return not self._errors
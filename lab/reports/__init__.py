@@ -441,6 +441,9 @@ class Report:
 
         logging.info("Reading properties file")
         self.props = tools.Properties(filename=props_file)
+        tools.expand_property_groups(
+            self.props, tools.load_property_groups(self.eval_dir)
+        )
         logging.info("Reading properties file finished")
         if not self.props:
             logging.critical("properties file in evaluation dir is empty.")
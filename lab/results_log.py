@@ -0,0 +1,190 @@
+# Lab is a Python package for evaluating algorithms.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collect the properties of finished runs in an append-only log.
+
+When a run finishes, the process that started it reads the run
+directory like the fetcher does (see :func:`read_run_dir`) and appends
+the resulting properties to the results log, the directory
+``results-log`` in the experiment directory. The fetcher then reads
+the log sequentially instead of opening the files of every run
+directory and only scans the run directories of runs that are missing
+from the log.
+
+The log consists of segments, one per writer: the local job and each
+work-queue worker write their own segment, while the runs of a Slurm
+job on the same node share one (see the *results_log* parameter of
+:class:`~lab.environments.GridEnvironment`). Each record is a single
+line of JSON that is appended while holding a lock on the segment. If
+the segment can't be locked, the record is skipped and the fetcher
+reads the run directory instead. Readers ignore a final line that a
+crash cut off.
+
+A run may have several records, e.g., after it was restarted. Each
+record stores the *epoch*, i.e., the time at which the job, the
+work-queue coordinator or the Slurm submission started the runs on a
+single machine, and the number of the *attempt* within this epoch,
+counted by the work-queue coordinator or by Slurm. The record with the
+highest epoch and attempt wins. Unlike the times at which records are
+written, these values don't depend on the clocks of the machines that
+execute the runs.
+"""
+
+import fcntl
+import logging
+import os
+import platform
+import time
+
+from lab import tools
+from lab.tools import json
+import lab.experiment
+
+
+RESULTS_LOG_DIR = "results-log"
+
+
+def read_run_dir(run_dir):
+    """Return the properties of the run in *run_dir*, including the
+    unexplained errors that its driver files reveal."""
+    static_props = tools.Properties(
+        filename=os.path.join(run_dir, lab.experiment.STATIC_RUN_PROPERTIES_FILENAME)
+    )
+    dynamic_props = tools.Properties(filename=os.path.join(run_dir, "properties"))
+
+    props = tools.Properties()
+    props.update(static_props)
+    props.update(dynamic_props)
+
+    driver_log = os.path.join(run_dir, "driver.log")
+    if not os.path.exists(driver_log):
+        props.add_unexplained_error(
+            "driver.log is missing. Probably the run was never started."
+        )
+
+    driver_err = os.path.join(run_dir, "driver.err")
+    run_err = os.path.join(run_dir, "run.err")
+    for logfile in [driver_err, run_err]:
+        if os.path.exists(logfile):
+            with open(logfile) as f:
+                content = f.read()
+            if content:
+                props.add_unexplained_error(
+                    "{}: {}".format(os.path.basename(logfile), content)
+                )
+    return props
+
+
+class ResultsLog:
+    """Append the properties of finished runs of *exp_dir* to the
+    segment *segment* of its results log.
+
+    By default, each process writes its own segment and the records
+    belong to the epoch that starts when the log is created.
+    """
+
+    def __init__(self, exp_dir, segment=None, epoch=None):
+        self.exp_dir = os.path.abspath(exp_dir)
+        self.epoch = time.time() if epoch is None else epoch
+        segment = segment or f"{platform.node()}-{os.getpid()}"
+        self.path = os.path.join(self.exp_dir, RESULTS_LOG_DIR, f"{segment}.jsonl")
+        self._fd = None
+
+    def _write(self, data):
+        if self._fd is None:
+            tools.makedirs(os.path.dirname(self.path))
+            self._fd = os.open(
+                self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        except OSError as err:
+            # E.g., network file systems without lock support. Records
+            # of concurrent writers could interleave, so we leave it to
+            # the fetcher to read the run directory.
+            logging.warning(f"Could not lock {self.path} ({err}) -> skip record")
+            return
+        try:
+            while data:
+                data = data[os.write(self._fd, data) :]
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def append_run(self, run_dir, attempt=1, epoch=None):
+        """Append the properties of the finished run in *run_dir*."""
+        run_dir = os.path.join(self.exp_dir, run_dir)
+        props = read_run_dir(run_dir)
+        record = {
+            "run_dir": os.path.relpath(run_dir, self.exp_dir),
+            "epoch": self.epoch if epoch is None else epoch,
+            "attempt": attempt,
+            "properties": props,
+        }
+        self._write((json.dumps(record) + "\n").encode("utf-8"))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def append_run(exp_dir, run_dir, epoch, attempt):
+    """Append the properties of the run in *run_dir* to the segment of
+    this node. Slurm jobs call this function after each run and pass
+    the submission time and the restart count as strings."""
+    results_log = ResultsLog(exp_dir, segment=platform.node(), epoch=float(epoch))
+    try:
+        results_log.append_run(run_dir, attempt=int(attempt))
+    finally:
+        results_log.close()
+
+
+def read_results_log(exp_dir):
+    """Return a dictionary that maps the run directories (relative to
+    *exp_dir*) in the results log to their properties.
+
+    If the log contains several records for a run, the one with the
+    highest epoch and attempt wins.
+    """
+    log_dir = os.path.join(exp_dir, RESULTS_LOG_DIR)
+    if not os.path.isdir(log_dir):
+        return {}
+    run_props = {}
+    run_keys = {}
+    for segment in sorted(os.listdir(log_dir)):
+        path = os.path.join(log_dir, segment)
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # The writer crashed before finishing the record.
+                    break
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                    run_dir = record["run_dir"]
+                    key = (record["epoch"], record["attempt"])
+                    if key >= run_keys.get(run_dir, key):
+                        run_props[run_dir] = record["properties"]
+                        run_keys[run_dir] = key
+                except (ValueError, KeyError, TypeError):
+                    logging.warning(f"Skipping invalid record in {path}")
+    return run_props
+
+
+def remove_results_log(exp_dir):
+    """Remove the results log, e.g., after the properties changed."""
+    log_dir = os.path.join(exp_dir, RESULTS_LOG_DIR)
+    if os.path.exists(log_dir):
+        tools.remove_path(log_dir)
@@ -0,0 +1,268 @@
+# Lab is a Python package for evaluating algorithms.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Execute runs of experiments that use the compact layout.
+
+Instead of writing a directory with a generated ``run`` script for each
+run, compact experiments store the specifications of all runs in a
+single file with one JSON object per line. An index file holds the byte
+offset of each line, so the runner can load the specification of run
+*i* without parsing the other runs. Run directories are only created
+when the runs are started.
+
+The runner also executes runs of experiments whose run directories are
+packed into a single archive (see :mod:`lab.archive`).
+
+Runs can also be executed in the calling Python process (see
+:func:`execute_run_in_process`), which saves starting a new interpreter
+for each run and, in compact experiments, for each parser.
+"""
+
+import contextlib
+import logging
+import os
+import platform
+import runpy
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from lab import archive, tools
+from lab.calls.call import Call
+import lab.experiment
+from lab.tools import json
+
+
+RUN_SPECS_FILENAME = "run-specs.jsonl"
+RUN_SPECS_INDEX_FILENAME = "run-specs.index"
+RUNNER_FILENAME = "runner"
+
+# Offsets are stored as little-endian unsigned 64-bit integers.
+_OFFSET_FORMAT = "<Q"
+_OFFSET_SIZE = struct.calcsize(_OFFSET_FORMAT)
+
+
+class RunSpecsWriter:
+    """Write run specifications in run ID order to *exp_dir*."""
+
+    def __init__(self, exp_dir):
+        self.specs_file = open(os.path.join(exp_dir, RUN_SPECS_FILENAME), "wb")
+        self.index_file = open(os.path.join(exp_dir, RUN_SPECS_INDEX_FILENAME), "wb")
+
+    def add(self, spec):
+        self.index_file.write(struct.pack(_OFFSET_FORMAT, self.specs_file.tell()))
+        line = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+        self.specs_file.write(tools.get_bytes(line + "\n"))
+
+    def close(self):
+        self.specs_file.close()
+        self.index_file.close()
+
+
+def has_run_specs(exp_dir):
+    return os.path.exists(os.path.join(exp_dir, RUN_SPECS_FILENAME))
+
+
+def read_run_spec(exp_dir, run_id):
+    """Return the specification of the run with the given (1-based) ID."""
+    with open(os.path.join(exp_dir, RUN_SPECS_INDEX_FILENAME), "rb") as f:
+        f.seek((run_id - 1) * _OFFSET_SIZE)
+        data = f.read(_OFFSET_SIZE)
+    if len(data) != _OFFSET_SIZE:
+        logging.critical(f"There is no run with ID {run_id} in {exp_dir}")
+    (offset,) = struct.unpack(_OFFSET_FORMAT, data)
+    with open(os.path.join(exp_dir, RUN_SPECS_FILENAME), "rb") as f:
+        f.seek(offset)
+        return json.loads(tools.get_string(f.readline()))
+
+
+def read_run_specs(exp_dir):
+    """Yield the specifications of all runs in run ID order."""
+    with open(os.path.join(exp_dir, RUN_SPECS_FILENAME)) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def prepare_run_dir(exp_dir, spec):
+    """Create the run directory with its static properties and resources."""
+    run_dir = os.path.join(exp_dir, spec["run_dir"])
+    tools.makedirs(run_dir)
+    for dest, content, permissions in spec["new_files"]:
+        filename = os.path.join(run_dir, dest)
+        tools.makedirs(os.path.dirname(filename))
+        tools.write_file(filename, content)
+        os.chmod(filename, permissions)
+    for source, dest, symlink in spec["resources"]:
+        dest = os.path.join(run_dir, dest)
+        if os.path.lexists(dest) and (symlink or os.path.islink(dest)):
+            os.remove(dest)
+        if symlink:
+            os.symlink(os.path.relpath(source, start=run_dir), dest)
+        else:
+            tools.copy(source, dest)
+    props = tools.Properties(
+        os.path.join(run_dir, lab.experiment.STATIC_RUN_PROPERTIES_FILENAME)
+    )
+    props.update(spec["properties"])
+    props.write()
+    return run_dir
+
+
+def uses_runner(exp_dir):
+    """Return True if runs are started with the generic runner script."""
+    return has_run_specs(exp_dir) or archive.has_run_archive(exp_dir)
+
+
+def _copy_run_dir(src, dest):
+    """Copy the files in *src* to *dest* and keep symbolic links as they are."""
+    for root, dirs, files in os.walk(src):
+        dest_root = os.path.join(dest, os.path.relpath(root, src))
+        tools.makedirs(dest_root)
+        for name in dirs + files:
+            src_path = os.path.join(root, name)
+            dest_path = os.path.join(dest_root, name)
+            if os.path.islink(src_path):
+                if os.path.lexists(dest_path):
+                    os.remove(dest_path)
+                os.symlink(os.readlink(src_path), dest_path)
+            elif name in files:
+                shutil.copy2(src_path, dest_path)
+
+
+def _run_script(path, cwd):
+    """Execute the Python script *path* in the current process and
+    return its exit code."""
+    old_cwd, old_argv = os.getcwd(), sys.argv
+    os.chdir(cwd)
+    sys.argv = [path]
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except SystemExit as err:
+        if isinstance(err.code, str):
+            print(err.code, file=sys.stderr)
+            return 1
+        return err.code or 0
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        os.chdir(old_cwd)
+        sys.argv = old_argv
+    return 0
+
+
+def _run_parser(name, path, stdout, stderr):
+    """Execute the parser script *path* in the current process.
+
+    Like for parsers that run in their own process, the output and log
+    messages of the parser are written to *stdout* and *stderr*.
+    """
+    start_time = time.time()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        retcode = _run_script(path, os.getcwd())
+    for stream in [stdout, stderr]:
+        stream.flush()
+    # Parsers point the log handlers to their output streams.
+    tools.configure_logging()
+    logging.info(f"{name} wall-clock time: {time.time() - start_time:.2f}s")
+    logging.info(f"{name} exit code: {retcode}")
+    return retcode
+
+
+def execute_archived_run(exp_dir, run_id, in_process=False):
+    """Extract the given run to node-local storage, execute it there and
+    copy the run directory back to the experiment directory.
+
+    The run is extracted to a temporary directory, i.e., under
+    ``$TMPDIR`` if the variable is set. If *in_process* is True, the
+    run script is executed in the current process. Return the exit code
+    of the run script.
+    """
+    scratch_dir = tempfile.mkdtemp(prefix="lab-run-")
+    try:
+        # Mirror the top level of the experiment directory, so that
+        # relative paths from the run to experiment files stay valid.
+        for name in os.listdir(exp_dir):
+            if not name.startswith("runs-"):
+                os.symlink(os.path.join(exp_dir, name), os.path.join(scratch_dir, name))
+        run_dir = archive.extract_run(exp_dir, run_id, scratch_dir)
+        local_run_dir = os.path.join(scratch_dir, run_dir)
+        if in_process:
+            retcode = _run_script("run", local_run_dir)
+        else:
+            retcode = subprocess.call(
+                [tools.get_python_executable(), "run"], cwd=local_run_dir
+            )
+        _copy_run_dir(local_run_dir, os.path.join(exp_dir, run_dir))
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return retcode
+
+
+def execute_run(exp_dir, run_id, in_process_parsers=False):
+    """Prepare the run directory of the given run and execute its commands.
+
+    This does the same as the ``run`` script in each run directory of
+    experiments with the regular layout. If *in_process_parsers* is
+    True, parsers are executed in the current process.
+    """
+    if archive.has_run_archive(exp_dir):
+        return execute_archived_run(exp_dir, run_id)
+    spec = read_run_spec(exp_dir, run_id)
+    run_dir = prepare_run_dir(exp_dir, spec)
+    os.chdir(run_dir)
+
+    logging.info(f"node: {platform.node()}")
+
+    run_log = open("run.log", "w")
+    run_err = open("run.err", "w", buffering=1)  # line buffering
+    redirects = {"stdout": run_log, "stderr": run_err}
+    parsers = set(spec.get("parsers", [])) if in_process_parsers else set()
+
+    for args, kwargs in spec["calls"]:
+        if kwargs["name"] in parsers:
+            _run_parser(kwargs["name"], args[-1], run_log, run_err)
+        else:
+            Call(args, **kwargs, **redirects).wait()
+
+    for f in [run_log, run_err]:
+        if spec.get("sync_output"):
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+        if os.path.getsize(f.name) == 0:
+            os.remove(f.name)
+
+
+def execute_run_in_process(exp_dir, run_id, run_dir):
+    """Execute the given run in the current process and return its exit code.
+
+    The commands of the run are still executed in their own processes,
+    but for compact experiments the parsers are executed in the current
+    process. For the other layouts, the run script is executed in the
+    current process.
+    """
+    exp_dir = os.path.abspath(exp_dir)
+    if has_run_specs(exp_dir):
+        execute_run(exp_dir, run_id, in_process_parsers=True)
+        return 0
+    if archive.has_run_archive(exp_dir):
+        return execute_archived_run(exp_dir, run_id, in_process=True)
+    return _run_script("run", os.path.join(exp_dir, run_dir))
@@ -0,0 +1,271 @@
+# Lab is a Python package for evaluating algorithms.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Report the progress of running experiments.
+
+The :class:`~lab.local_executor.LocalExecutor` keeps the JSON file
+``status`` in the experiment directory up to date. Grid jobs write the
+start and end time of each run to the file ``run-timing`` in the run
+directory, which :func:`get_grid_status` turns into the same summary.
+:func:`format_status` and :func:`format_prometheus` render it.
+"""
+
+from collections import deque
+import os
+import time
+
+from lab import tools
+from lab.tools import json
+
+
+STATUS_FILENAME = "status"
+RUN_TIMING_FILENAME = "run-timing"
+
+# Seconds between two updates of the status file.
+STATUS_INTERVAL = 2
+
+# Throughput is measured over the runs that finished in the last
+# THROUGHPUT_WINDOW seconds.
+THROUGHPUT_WINDOW = 600
+
+
+def _write_atomically(path, content):
+    """Replace *path* by a file with *content*, so that readers never
+    see a partially written file."""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    tools.write_file(tmp_path, content)
+    os.replace(tmp_path, path)
+
+
+def _summarize(total, finished, failed, durations, finish_times, workers, now):
+    """Return the status dictionary for the given counts and times."""
+    recent = [t for t in finish_times if t > now - THROUGHPUT_WINDOW]
+    first_finish = min(finish_times) if finish_times else now
+    window = min(THROUGHPUT_WINDOW, max(now - first_finish, 60))
+    runs_per_minute = 60 * len(recent) / window
+    pending = max(0, total - finished - len(workers))
+    mean_time = sum(durations) / len(durations) if durations else None
+    eta = None
+    if mean_time is not None:
+        remaining_time = pending * mean_time + sum(
+            max(0, mean_time - worker["elapsed"]) for worker in workers
+        )
+        eta = round(remaining_time / max(1, len(workers)))
+    return {
+        "updated": round(now),
+        "total": total,
+        "finished": finished,
+        "failed": failed,
+        "running": len(workers),
+        "pending": pending,
+        "runs_per_minute": round(runs_per_minute, 2),
+        "mean_run_time": None if mean_time is None else round(mean_time, 2),
+        "eta": eta,
+        "workers": workers,
+    }
+
+
+class StatusFile:
+    """Track the runs of a local job and write their status to *path*.
+
+    *total* is the number of runs of the job. *finished* and *failed*
+    count the runs that finished before the job started.
+
+    The file is replaced atomically at most every
+    :data:`STATUS_INTERVAL` seconds.
+    """
+
+    def __init__(self, path, total, finished=0, failed=0):
+        self.path = path
+        self.total = total
+        self.finished = finished
+        self.failed = failed
+        self.durations = []
+        self.finish_times = deque()
+        self.running = {}
+        self.last_write = None
+
+    def record_start(self, worker, run_id, run_dir):
+        self.running[worker] = (run_id, run_dir, time.time())
+        self.write()
+
+    def record_finish(self, worker, error):
+        _, _, start = self.running.pop(worker)
+        now = time.time()
+        self.finished += 1
+        self.failed += error
+        self.durations.append(now - start)
+        self.finish_times.append(now)
+        while self.finish_times[0] < now - THROUGHPUT_WINDOW:
+            self.finish_times.popleft()
+        self.write()
+
+    def record_abort(self, worker):
+        """Forget the run of *worker* without counting it as finished."""
+        self.running.pop(worker, None)
+        self.write()
+
+    def get_status(self):
+        now = time.time()
+        workers = [
+            {
+                "worker": worker,
+                "run_id": run_id,
+                "run_dir": run_dir,
+                "elapsed": round(now - start, 1),
+            }
+            for worker, (run_id, run_dir, start) in sorted(self.running.items())
+        ]
+        return _summarize(
+            self.total,
+            self.finished,
+            self.failed,
+            self.durations,
+            self.finish_times,
+            workers,
+            now,
+        )
+
+    def write(self, force=False):
+        now = time.monotonic()
+        if force or self.last_write is None or now - self.last_write >= STATUS_INTERVAL:
+            _write_atomically(self.path, json.dumps(self.get_status(), indent=2) + "\n")
+            self.last_write = now
+
+
+def _read_run_timing(path):
+    """Return start time, host, end time and exit code of a grid run.
+
+    Missing values are None.
+    """
+    start = host = end = retcode = None
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[0] == "started":
+                start, host = float(parts[1]), parts[2]
+            elif len(parts) == 3 and parts[0] == "finished":
+                end, retcode = float(parts[1]), int(parts[2])
+    return start, host, end, retcode
+
+
+def get_grid_status(run_dirs, total):
+    """Collect the status of grid runs from their ``run-timing`` files."""
+    now = time.time()
+    finished = failed = 0
+    durations = []
+    finish_times = []
+    workers = []
+    for run_dir in run_dirs:
+        path = os.path.join(run_dir, RUN_TIMING_FILENAME)
+        if not os.path.exists(path):
+            continue
+        start, host, end, retcode = _read_run_timing(path)
+        if start is None:
+            continue
+        if end is None:
+            workers.append(
+                {
+                    "worker": host,
+                    "run_dir": run_dir,
+                    "elapsed": round(now - start, 1),
+                }
+            )
+        else:
+            finished += 1
+            failed += retcode != 0
+            durations.append(end - start)
+            finish_times.append(end)
+    return _summarize(total, finished, failed, durations, finish_times, workers, now)
+
+
+def read_status_file(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _format_duration(seconds):
+    """
+    >>> _format_duration(3725)
+    '1:02:05'
+    >>> _format_duration(None)
+    'unknown'
+    """
+    if seconds is None:
+        return "unknown"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def format_status(status):
+    """Return a human-readable summary of *status*."""
+    age = time.time() - status["updated"]
+    lines = [
+        f"Finished: {status['finished']}/{status['total']} "
+        f"({status['failed']} failed)",
+        f"Running: {status['running']}, pending: {status['pending']}",
+        f"Throughput: {status['runs_per_minute']} runs/min, "
+        f"mean run time: {_format_duration(status['mean_run_time'])}",
+        f"ETA: {_format_duration(status['eta'])}",
+        f"Last update: {_format_duration(age)} ago",
+    ]
+    for worker in status["workers"]:
+        run = worker.get("run_id", worker["run_dir"])
+        lines.append(
+            f"  {worker['worker']}: run {run} for "
+            f"{_format_duration(worker['elapsed'])}"
+        )
+    return "\n".join(lines)
+
+
+def format_prometheus(status, experiment):
+    """Return *status* in the text format of Prometheus' node exporter.
+
+    >>> status = {"total": 10, "finished": 4, "failed": 1, "running": 2,
+    ...     "pending": 4, "runs_per_minute": 1.5, "eta": 120, "updated": 7}
+    >>> print(format_prometheus(status, "exp1"))  # doctest: +ELLIPSIS
+    # HELP lab_runs_total Number of runs in the experiment.
+    # TYPE lab_runs_total gauge
+    lab_runs_total{experiment="exp1"} 10
+    ...
+    lab_status_updated_seconds{experiment="exp1"} 7
+    <BLANKLINE>
+    """
+    metrics = [
+        ("runs_total", "total", "Number of runs in the experiment."),
+        ("runs_finished", "finished", "Number of finished runs."),
+        ("runs_failed", "failed", "Number of failed runs."),
+        ("runs_running", "running", "Number of running runs."),
+        ("runs_pending", "pending", "Number of runs that have not started."),
+        ("runs_per_minute", "runs_per_minute", "Recently finished runs per minute."),
+        ("eta_seconds", "eta", "Estimated seconds until all runs finish."),
+        ("status_updated_seconds", "updated", "Time of the last status update."),
+    ]
+    label = experiment.replace("\\", "\\\\").replace('"', '\\"')
+    lines = []
+    for name, key, help_text in metrics:
+        if status.get(key) is None:
+            continue
+        lines.append(f"# HELP lab_{name} {help_text}")
+        lines.append(f"# TYPE lab_{name} gauge")
+        lines.append(f'lab_{name}{{experiment="{label}"}} {status[key]}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_file(path, status, experiment):
+    """Write *status* to the textfile *path* for Prometheus' node exporter."""
+    _write_atomically(path, format_prometheus(status, experiment))
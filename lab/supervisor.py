@@ -0,0 +1,242 @@
+# Lab is a Python package for evaluating algorithms.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Execute the runs of compact experiments from a single event loop.
+
+The :class:`~lab.local_executor.LocalExecutor` starts a Python process
+for each run, which starts and watches the commands of the run. The
+:class:`RunSupervisor` starts the commands of all runs directly from
+one asyncio event loop in the job process instead. Each run is a
+coroutine that executes its commands one after the other. The event
+loop wakes up when a command exits (SIGCHLD) and every
+:data:`~lab.calls.call.MONITOR_INTERVAL` seconds to enforce the limits
+of all running commands.
+
+The commands are not started with :func:`asyncio.create_subprocess_exec`
+but with the :class:`~lab.calls.call.Call` objects that run scripts
+use, which the loop polls instead of blocking in :meth:`Call.wait
+<lab.calls.call.Call.wait>`. This way, the supervisor enforces limits,
+kills process groups and records resource usage (from ``wait4()``)
+exactly like run scripts, and both share the limit backends of
+:mod:`lab.calls.limits`. Since all output goes to files, asyncio's
+pipe transports would not help anyway. Parsers are commands like any
+other, so each of them still starts its own Python interpreter. Only
+the interpreter per run is saved.
+"""
+
+import asyncio
+import logging
+import os
+import platform
+import signal
+import time
+
+from lab import runner, tools
+from lab.calls.call import Call, MONITOR_INTERVAL
+from lab.local_executor import format_cores, LocalExecutor
+from lab.status import STATUS_INTERVAL
+
+
+class _LevelFilter(logging.Filter):
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = errors
+
+    def filter(self, record):
+        return (record.levelno > logging.WARNING) == self.errors
+
+
+def _get_run_logger(run_id, stdout, stderr):
+    """Return a logger that writes to the driver files of a run.
+
+    Like in run scripts (see :func:`lab.tools.configure_logging`),
+    errors go to *stderr* and all other messages to *stdout*.
+    """
+    # Don't register the logger, so it is freed after the run.
+    logger = logging.Logger(f"run-{run_id}")
+    formatter = logging.Formatter("%(asctime)-s %(levelname)-8s %(message)s")
+    for stream, errors in [(stdout, False), (stderr, True)]:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(formatter)
+        handler.addFilter(_LevelFilter(errors))
+        logger.addHandler(handler)
+    return logger
+
+
+class RunSupervisor(LocalExecutor):
+    """Execute the runs of the compact experiment in *exp_dir*.
+
+    All other arguments are the same as for :class:`LocalExecutor`.
+    The *cmd* of the tasks is ignored: the commands of each run are
+    read from the run specifications of the experiment.
+    """
+
+    def __init__(self, exp_dir, processes, **kwargs):
+        super().__init__(processes, **kwargs)
+        if not runner.has_run_specs(exp_dir):
+            logging.critical(
+                "The run supervisor needs a compact experiment "
+                "(exp.build(compact=True))."
+            )
+        self.exp_dir = os.path.abspath(exp_dir)
+        # Map running commands to the futures that their runs wait for.
+        self._calls = {}
+        self._loop = None
+        self._wakeup = None
+        self._run_finished = False
+
+    def _start(self, task):
+        cores = self.allocator.allocate(task.cores)
+        self.memory_monitor.reserve(task.memory)
+        run_dir = os.path.join(self.exp_dir, task.run_dir)
+        tools.makedirs(run_dir)
+        driver_log = open(os.path.join(run_dir, "driver.log"), "w")
+        driver_err = open(os.path.join(run_dir, "driver.err"), "w")
+        location = f" on cores {format_cores(cores)}" if self.pin_cores else ""
+        logging.info(
+            f"Starting run {task.run_id} (TASK_ID {task.task_id}) "
+            f"in {task.run_dir}{location}"
+        )
+        if self.journal:
+            self.journal.record_start(task.run_id)
+        if self.status:
+            self.status.record_start(format_cores(cores), task.run_id, task.run_dir)
+        self._running[task.run_id] = task
+        self._loop.create_task(self._execute_run(task, cores, driver_log, driver_err))
+
+    async def _wait(self, call):
+        future = self._loop.create_future()
+        self._calls[call] = future
+        await future
+
+    async def _execute_run(self, task, cores, driver_log, driver_err):
+        """Do what :func:`lab.runner.execute_run` does in a run process."""
+        logger = _get_run_logger(task.run_id, driver_log, driver_err)
+        if self.pin_cores:
+
+            def preexec_fn():
+                os.sched_setaffinity(0, cores)
+
+        else:
+            preexec_fn = None
+        returncode = 0
+        try:
+            spec = runner.read_run_spec(self.exp_dir, task.run_id)
+            run_dir = runner.prepare_run_dir(self.exp_dir, spec)
+            logger.info(f"node: {platform.node()}")
+            run_log_path = os.path.join(run_dir, "run.log")
+            run_err_path = os.path.join(run_dir, "run.err")
+            with open(run_log_path, "w") as run_log, open(
+                run_err_path, "w", buffering=1
+            ) as run_err:
+                for args, kwargs in spec["calls"]:
+                    if self._interrupted:
+                        break
+                    kwargs = dict(kwargs)
+                    # The job process doesn't change into the run directory.
+                    properties_file = kwargs.pop("properties_file", "properties")
+                    if properties_file is not None:
+                        properties_file = os.path.join(run_dir, properties_file)
+                    call = Call(
+                        args,
+                        stdout=run_log,
+                        stderr=run_err,
+                        cwd=run_dir,
+                        preexec_fn=preexec_fn,
+                        properties_file=properties_file,
+                        logger=logger,
+                        forward_signals=False,
+                        **kwargs,
+                    )
+                    await self._wait(call)
+                    call.finish()
+                if spec.get("sync_output"):
+                    for f in [run_log, run_err]:
+                        f.flush()
+                        os.fsync(f.fileno())
+            for path in [run_log_path, run_err_path]:
+                if os.path.getsize(path) == 0:
+                    os.remove(path)
+        except (Exception, SystemExit) as err:
+            # Call exits if the executable is missing.
+            logger.error(f"Run {task.run_id} failed: {err}")
+            returncode = 1
+        finally:
+            del self._running[task.run_id]
+            self._finish(task, cores, driver_log, driver_err, returncode)
+            self._run_finished = True
+            self._wakeup.set()
+
+    def _interrupt(self):
+        logging.warning("Main script interrupted")
+        self._interrupted = True
+        self._errors = True
+        self._pending.clear()
+        for call in self._calls:
+            call._abort("interrupted")
+
+    def _poll_calls(self):
+        for call, future in list(self._calls.items()):
+            if call.poll() is not None:
+                del self._calls[call]
+                future.set_result(None)
+
+    async def _supervise(self):
+        self._wakeup = asyncio.Event()
+        self._loop.add_signal_handler(signal.SIGCHLD, self._wakeup.set)
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            self._loop.add_signal_handler(sig, self._interrupt)
+        next_admission = 0
+        while self._running or any(self._pending.values()):
+            if time.monotonic() >= next_admission:
+                task = self._pop_next_task()
+                while task:
+                    self._start(task)
+                    task = self._pop_next_task()
+                # Wait for a run to finish or the backoff to pass.
+                next_admission = float("inf")
+                if self._backoff:
+                    next_admission = time.monotonic() + self._backoff
+            timeout = STATUS_INTERVAL
+            if self._calls:
+                timeout = MONITOR_INTERVAL
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._run_finished:
+                # The run may have freed enough cores and memory.
+                self._run_finished = False
+                next_admission = 0
+            self._poll_calls()
+            if self.status:
+                self.status.write()
+        if self.status:
+            self.status.write(force=True)
+        return not self._errors
+
+    def run(self):
+        """Execute all queued runs and return True iff all runs succeeded."""
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            return self._loop.run_until_complete(self._supervise())
+        finally:
+            for sig in [signal.SIGCHLD, signal.SIGINT, signal.SIGTERM]:
+                self._loop.remove_signal_handler(sig)
+            self._loop.close()
+            asyncio.set_event_loop(None)
@@ -15,14 +15,19 @@
 
 import argparse
 import colorsys
+import errno
 import functools
+import hashlib
 import logging
 import os
 import pkgutil
+import queue
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 
 
 # Use simplejson where it's available, because it is compatible (just separately
@@ -168,12 +173,72 @@ def confirm_overwrite_or_abort(path):
     )
 
 
-def remove_path(path):
+def _remove_tree_in_parallel(path, num_threads):
+    """Remove the directory tree at *path* with *num_threads* threads."""
+    # Split the tree into subtrees until there are enough of them to keep
+    # all threads busy. Files outside of the subtrees are removed last.
+    subtrees = [path]
+    for _ in range(3):
+        if len(subtrees) >= 4 * num_threads:
+            break
+        subdirs = []
+        for subtree in subtrees:
+            with os.scandir(subtree) as entries:
+                subdirs.extend(
+                    entry.path
+                    for entry in entries
+                    if entry.is_dir(follow_symlinks=False)
+                )
+        if not subdirs:
+            break
+        subtrees = subdirs
+    # We use plain threads, because thread pools from concurrent.futures
+    # don't accept new work while the interpreter shuts down.
+    work = queue.Queue()
+    for subtree in subtrees:
+        work.put(subtree)
+
+    def remove_subtrees():
+        while True:
+            try:
+                subtree = work.get_nowait()
+            except queue.Empty:
+                return
+            shutil.rmtree(subtree, ignore_errors=True)
+
+    threads = [threading.Thread(target=remove_subtrees) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def remove_path(path, background=False):
+    """Remove the file or directory at *path*.
+
+    If *background* is True and *path* is a directory, atomically move
+    it to a hidden sibling directory and return immediately. A
+    background thread then removes the old tree with multiple threads.
+    The Python interpreter waits for unfinished removals before it
+    exits.
+
+    """
     if os.path.isfile(path):
         try:
             os.remove(path)
         except OSError:
             pass
+    elif background and os.path.isdir(path):
+        path = os.path.abspath(path)
+        parent, name = os.path.split(path)
+        trash_dir = tempfile.mkdtemp(prefix=f".{name}-removed-", dir=parent)
+        os.rename(path, os.path.join(trash_dir, name))
+        num_threads = min(32, (os.cpu_count() or 1) + 4)
+        logging.info(f'Removing "{path}" in the background')
+        threading.Thread(
+            target=_remove_tree_in_parallel, args=(trash_dir, num_threads)
+        ).start()
     else:
         shutil.rmtree(path)
 
@@ -277,6 +342,32 @@ class Properties(dict):
         write_file(self.filename, str(self))
 
 
+# Name of the file that stores property groups in experiment and eval dirs.
+PROPERTY_GROUPS_FILENAME = "property-groups"
+
+
+def load_property_groups(directory):
+    """Return the property groups stored in *directory*."""
+    return Properties(os.path.join(directory, PROPERTY_GROUPS_FILENAME))
+
+
+def expand_property_groups(props, property_groups):
+    """Replace the references to property groups in each run of *props*
+    by the properties of the groups.
+
+    Properties of the run take precedence over properties of its groups.
+    """
+    for run in props.values():
+        for key in run.pop("property_groups", []):
+            if key not in property_groups:
+                logging.critical(
+                    f'Property group "{key}" is missing. Please copy the file '
+                    f'"{PROPERTY_GROUPS_FILENAME}" along with the properties file.'
+                )
+            for attribute, value in property_groups[key].items():
+                run.setdefault(attribute, value)
+
+
 class RunFilter:
     def __init__(self, filter, **kwargs):
         self.filters = make_list(filter)
@@ -360,7 +451,8 @@ def fast_updatetree(src, dst, symlinks=False, ignore=None):
         # If dstname is a symbolic link, remove it before trying to override it.
         # Without this shutil.copy2 cannot override broken symbolic links and
         # it will override the file that the link points to if the link is valid.
-        if os.path.islink(dstname):
+        # For the same reason, we remove files that may be hard links.
+        if os.path.islink(dstname) or os.path.isfile(dstname):
             os.remove(dstname)
         try:
             if symlinks and os.path.islink(srcname):
@@ -391,12 +483,13 @@ def copy(src, dest, ignores=None):
     """
     Copies a file or directory to another file or directory.
     """
-    if os.path.isfile(src) and os.path.isdir(dest):
-        makedirs(dest)
-        dest = os.path.join(dest, os.path.basename(src))
-        shutil.copy2(src, dest)
-    elif os.path.isfile(src):
+    if os.path.isfile(src):
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(src))
         makedirs(os.path.dirname(dest))
+        # Don't write through hard links (see link()).
+        if os.path.islink(dest) or os.path.isfile(dest):
+            os.remove(dest)
         shutil.copy2(src, dest)
     elif os.path.isdir(src):
         ignore = shutil.ignore_patterns(*ignores) if ignores else None
@@ -409,6 +502,158 @@ def copy(src, dest, ignores=None):
         )
 
 
+# ioctl request for cloning a whole file on filesystems with reflink support
+# (e.g., Btrfs and XFS). See "man ioctl_ficlone".
+FICLONE = 0x40049409
+
+
+def clone_file(src, dest):
+    """
+    Copy the file *src* to *dest* as cheaply as the filesystem allows.
+
+    Try a reflink first, then an in-kernel copy and fall back to a
+    regular copy. File metadata is copied as with shutil.copy2().
+    """
+    with open(src, "rb") as infile, open(dest, "wb") as outfile:
+        try:
+            import fcntl
+
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+        except (ImportError, OSError):
+            try:
+                size = os.fstat(infile.fileno()).st_size
+                while os.copy_file_range(infile.fileno(), outfile.fileno(), size):
+                    pass
+            except (AttributeError, OSError):
+                infile.seek(0)
+                outfile.seek(0)
+                outfile.truncate()
+                shutil.copyfileobj(infile, outfile)
+    shutil.copystat(src, dest)
+
+
+def compute_file_hash(path):
+    """Return the SHA-256 hex digest of the file content at *path*."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ResourceStore:
+    """Content-addressed store for resources that many runs share.
+
+    Each distinct file is stored once under *path* and deployed to its
+    destinations as a hard link. If hard links are impossible, the
+    stored file is cloned with :func:`clone_file`. Since hard links
+    share their content, runs must not modify such files in place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Avoid hashing the same source file twice.
+        self._source_to_key = {}
+        self._key_to_stored_file = {}
+        self._num_extra_copies = 0
+
+    def _get_key(self, src):
+        stat = os.stat(src)
+        source_id = (os.path.abspath(src), stat.st_size, stat.st_mtime_ns)
+        if source_id not in self._source_to_key:
+            # Files with equal content but different permissions differ.
+            self._source_to_key[source_id] = "{}-{:o}".format(
+                compute_file_hash(src), stat.st_mode & 0o7777
+            )
+        return self._source_to_key[source_id]
+
+    def _add_to_store(self, src, stored_file):
+        makedirs(os.path.dirname(stored_file))
+        # Parallel builds may store the same file concurrently, so we
+        # copy to a temporary file and move it into place atomically.
+        tmp_file = f"{stored_file}.tmp-{os.getpid()}"
+        clone_file(src, tmp_file)
+        os.replace(tmp_file, stored_file)
+
+    def _get_stored_file(self, src):
+        key = self._get_key(src)
+        if key not in self._key_to_stored_file:
+            stored_file = os.path.join(self.path, key[:2], key)
+            if not os.path.exists(stored_file):
+                self._add_to_store(src, stored_file)
+            self._key_to_stored_file[key] = stored_file
+        return self._key_to_stored_file[key]
+
+    def _deploy_file(self, src, dest):
+        stored_file = self._get_stored_file(src)
+        # Never write through an existing hard link into the store.
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(stored_file, dest)
+        except OSError as err:
+            if err.errno == errno.EMLINK:
+                # The stored file has too many links. Continue with a fresh copy.
+                self._num_extra_copies += 1
+                new_stored_file = "{}.{}-{}".format(
+                    stored_file, os.getpid(), self._num_extra_copies
+                )
+                self._add_to_store(stored_file, new_stored_file)
+                self._key_to_stored_file[self._get_key(src)] = new_stored_file
+                os.link(new_stored_file, dest)
+            else:
+                clone_file(stored_file, dest)
+
+    def copy(self, src, dest):
+        """Deploy file or directory *src* to *dest* like :func:`copy`."""
+        _deploy_path(src, dest, self._deploy_file)
+
+
+def _deploy_path(src, dest, deploy_file):
+    """Recreate *src* at *dest* like :func:`copy`, but use the function
+    *deploy_file* for copying each file."""
+    if os.path.isfile(src):
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(src))
+        makedirs(os.path.dirname(dest))
+        deploy_file(src, dest)
+    elif os.path.isdir(src):
+        for root, _, files in os.walk(src, followlinks=True):
+            dest_dir = os.path.join(dest, os.path.relpath(root, src))
+            makedirs(dest_dir)
+            for filename in files:
+                deploy_file(
+                    os.path.join(root, filename), os.path.join(dest_dir, filename)
+                )
+    else:
+        logging.critical(
+            "Path {} cannot be copied to {}".format(
+                os.path.abspath(src), os.path.abspath(dest)
+            )
+        )
+
+
+def _link_file(src, dest):
+    # Never write through an existing hard link.
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        clone_file(src, dest)
+
+
+def link(src, dest):
+    """
+    Hard-link the file or directory *src* to *dest*.
+
+    Directories are recreated like with :func:`copy` and their files are
+    hard-linked. If that's impossible (e.g., across filesystems), the
+    files are cloned with :func:`clone_file`.
+    """
+    _deploy_path(src, dest, _link_file)
+
+
 def get_color(fraction, min_wins):
     assert 0 <= fraction <= 1, fraction
     if min_wins:
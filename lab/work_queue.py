@@ -0,0 +1,563 @@
+# Lab is a Python package for evaluating algorithms.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Distribute the runs of an experiment to workers on several machines.
+
+The :class:`Coordinator` listens on a TCP socket and hands out one run
+at a time to each connected worker (see :func:`run_worker`). The
+experiment directory must be reachable under the same relative layout
+on all machines, e.g., on a network file system: workers execute the
+runs in the experiment directory and only report back their exit codes.
+
+Coordinator and workers exchange JSON objects, one per line:
+
+* worker: ``{"type": "hello", "worker": ..., "token": ...}``
+* coordinator: ``{"type": "run", "run_id": ..., ...}`` or ``{"type": "done"}``
+* worker, before and while the run executes: ``{"type": "heartbeat"}``
+* worker: ``{"type": "finished", "run_id": ..., "returncode": ..., "error": ...}``
+* coordinator, for each heartbeat and the finished message: ``{"type": "ack"}``
+
+The coordinator writes its address and a random token to the file
+``work-queue`` in the experiment directory. Only workers that can read
+this file can connect. If a worker disconnects or misses its heartbeats
+for *heartbeat_timeout* seconds, its run is handed to the next worker.
+
+Each acknowledged heartbeat grants the worker a lease of half the
+heartbeat timeout, counted from when it sent the heartbeat. A worker
+only starts the run once the coordinator acknowledged its first
+heartbeat and aborts the run as soon as its lease expires, so the run
+is dead :data:`~lab.calls.call.KILL_GRACE_PERIOD` seconds later. The
+coordinator hands out a run again only when *heartbeat_timeout*
+seconds have passed since it acknowledged the last heartbeat, so two
+attempts of a run never overlap if *heartbeat_timeout* exceeds twice
+the grace period. Workers append the properties of a run to the
+results log only after the coordinator acknowledged that it finished.
+"""
+
+import asyncio
+from collections import Counter, deque
+import hmac
+import logging
+import os
+import platform
+import secrets
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+from lab import local_executor, results_log, runner, tools
+from lab.calls.call import Call
+from lab.tools import json
+
+
+WORK_QUEUE_FILENAME = "work-queue"
+WORKER_SCRIPT = "worker"
+
+# Seconds after which the run of a silent worker is handed out again.
+# Workers send heartbeats three times as often.
+HEARTBEAT_TIMEOUT = 60
+
+# Give up on runs whose workers were lost this often.
+MAX_ATTEMPTS = 3
+
+
+def _encode(message):
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+def _decode(line):
+    message = json.loads(line.decode("utf-8"))
+    if not isinstance(message, dict) or "type" not in message:
+        raise ValueError(f"invalid message: {line!r}")
+    return message
+
+
+def read_address_file(exp_dir):
+    """Return host, port and token of the coordinator of *exp_dir*."""
+    path = os.path.join(exp_dir, WORK_QUEUE_FILENAME)
+    try:
+        with open(path) as f:
+            address = json.load(f)
+    except OSError:
+        logging.critical(f"{path} not found. Is the coordinator running?")
+    return address["host"], address["port"], address["token"]
+
+
+def _write_address_file(exp_dir, host, port, token):
+    path = os.path.join(exp_dir, WORK_QUEUE_FILENAME)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    # Only the user may read the token.
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"host": host, "port": port, "token": token}, f)
+    # Workers never see a partially written file.
+    os.replace(tmp_path, path)
+
+
+class _LostWorker(Exception):
+    pass
+
+
+class Coordinator:
+    """Hand out the runs of the experiment in *exp_dir* to workers.
+
+    The coordinator listens on *host* and *port*. The default host
+    accepts connections on all interfaces and the default port 0 picks
+    a free port. Workers find the address in the ``work-queue`` file.
+
+    If *local_workers* is positive, the coordinator starts that many
+    workers on the local machine itself.
+
+    *journal* and *status* are a :class:`~lab.local_executor.RunJournal`
+    and a :class:`~lab.status.StatusFile` that record the runs. Runs
+    whose workers were lost are handed out again, at most
+    *max_attempts* times in total.
+    """
+
+    def __init__(
+        self,
+        exp_dir,
+        host="",
+        port=0,
+        local_workers=0,
+        journal=None,
+        status=None,
+        heartbeat_timeout=HEARTBEAT_TIMEOUT,
+        max_attempts=MAX_ATTEMPTS,
+    ):
+        self.exp_dir = os.path.abspath(exp_dir)
+        self.host = host
+        self.port = port
+        self.local_workers = local_workers
+        self.journal = journal
+        self.status = status
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.token = secrets.token_hex(16)
+        self._queue = deque()
+        self._attempts = Counter()
+        # Orders the results of different starts (see lab.results_log).
+        self._epoch = time.time()
+        # Map the IDs of running runs to their workers.
+        self._running = {}
+        self._errors = False
+        self._interrupted = False
+        self._handlers = set()
+        self._local_processes = []
+        self._loop = None
+        self._changed = None
+
+    def add_task(self, task_id, run_id, run_dir):
+        self._queue.append((task_id, run_id, run_dir))
+
+    def _is_done(self):
+        return self._interrupted or not (self._queue or self._running)
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def _next_task(self):
+        """Wait for a run to hand out and return None if there is none left."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._queue or self._is_done())
+            if self._interrupted or not self._queue:
+                return None
+            return self._queue.popleft()
+
+    async def _receive(self, reader):
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.heartbeat_timeout)
+        except asyncio.TimeoutError:
+            raise _LostWorker(f"no heartbeat for {self.heartbeat_timeout}s")
+        except OSError as err:
+            raise _LostWorker(err)
+        if not line:
+            raise _LostWorker("connection closed")
+        try:
+            return _decode(line)
+        except ValueError as err:
+            raise _LostWorker(err)
+
+    async def _send(self, writer, message):
+        writer.write(_encode(message))
+        try:
+            await writer.drain()
+        except OSError as err:
+            raise _LostWorker(err)
+
+    def _start_run(self, task, worker):
+        task_id, run_id, run_dir = task
+        self._attempts[run_id] += 1
+        self._running[run_id] = worker
+        logging.info(
+            f"Starting run {run_id} (TASK_ID {task_id}) in {run_dir} on {worker}"
+        )
+        if self.journal:
+            self.journal.record_start(run_id)
+        if self.status:
+            self.status.record_start(worker, run_id, run_dir)
+
+    def _finish_run(self, task, worker, returncode, error):
+        _, run_id, _ = task
+        del self._running[run_id]
+        if error:
+            self._errors = True
+        if self.journal and not self._interrupted:
+            self.journal.record_finish(run_id, returncode, error)
+        if self.status:
+            self.status.record_finish(worker, error)
+
+    def _requeue_run(self, task, worker, reason):
+        _, run_id, _ = task
+        del self._running[run_id]
+        if self._interrupted:
+            return
+        if self._attempts[run_id] >= self.max_attempts:
+            # The run stays unfinished in the journal, so --resume retries it.
+            logging.error(
+                f"Lost worker {worker} ({reason}). Giving up on run {run_id} "
+                f"after {self._attempts[run_id]} attempts."
+            )
+            self._errors = True
+            if self.status:
+                self.status.record_finish(worker, error=True)
+        else:
+            logging.warning(
+                f"Lost worker {worker} ({reason}). Handing out run {run_id} again."
+            )
+            if self.status:
+                self.status.record_abort(worker)
+            self._queue.appendleft(task)
+
+    async def _handle_worker(self, reader, writer):
+        worker = None
+        task = None
+        # Time at which we acknowledged the last heartbeat for the run.
+        last_ack = None
+        try:
+            hello = await self._receive(reader)
+            if hello["type"] != "hello" or not hmac.compare_digest(
+                str(hello.get("token")), self.token
+            ):
+                logging.warning("Rejected a worker with an invalid token")
+                return
+            worker = str(hello.get("worker"))
+            logging.info(f"Worker {worker} connected")
+            while True:
+                task = await self._next_task()
+                if task is None:
+                    await self._send(writer, {"type": "done"})
+                    return
+                task_id, run_id, run_dir = task
+                last_ack = None
+                self._start_run(task, worker)
+                await self._send(
+                    writer,
+                    {
+                        "type": "run",
+                        "task_id": task_id,
+                        "run_id": run_id,
+                        "run_dir": run_dir,
+                        "epoch": self._epoch,
+                        "attempt": self._attempts[run_id],
+                        "heartbeat_interval": self.heartbeat_timeout / 3,
+                        "lease": self.heartbeat_timeout / 2,
+                    },
+                )
+                message = await self._receive(reader)
+                while message["type"] == "heartbeat":
+                    await self._send(writer, {"type": "ack"})
+                    last_ack = self._loop.time()
+                    message = await self._receive(reader)
+                if message["type"] != "finished" or message.get("run_id") != run_id:
+                    raise _LostWorker(f"unexpected message {message}")
+                self._finish_run(
+                    task, worker, message.get("returncode"), bool(message.get("error"))
+                )
+                task = None
+                await self._send(writer, {"type": "ack"})
+                await self._notify()
+        except _LostWorker as err:
+            if task:
+                if last_ack is not None:
+                    # Wait until the lease of the worker has surely expired.
+                    await asyncio.sleep(
+                        last_ack + self.heartbeat_timeout - self._loop.time()
+                    )
+                self._requeue_run(task, worker, err)
+                await self._notify()
+            elif worker:
+                logging.info(f"Worker {worker} disconnected ({err})")
+        finally:
+            writer.close()
+
+    def _accept(self, reader, writer):
+        handler = self._loop.create_task(self._handle_worker(reader, writer))
+        self._handlers.add(handler)
+        handler.add_done_callback(self._handlers.discard)
+
+    def _interrupt(self):
+        logging.warning("Main script interrupted")
+        self._interrupted = True
+        self._errors = True
+        for handler in self._handlers:
+            handler.cancel()
+        self._loop.create_task(self._notify())
+
+    def _start_local_workers(self, port):
+        host = self.host if self.host not in ["", "0.0.0.0"] else "127.0.0.1"
+        cmd = [
+            tools.get_python_executable(),
+            os.path.join(self.exp_dir, WORKER_SCRIPT),
+            "--address",
+            f"{host}:{port}",
+        ]
+        for _ in range(self.local_workers):
+            self._local_processes.append(subprocess.Popen(cmd, cwd=self.exp_dir))
+
+    async def _serve(self):
+        self._changed = asyncio.Condition()
+        # With port 0, each address family would get a different port.
+        server = await asyncio.start_server(
+            self._accept, self.host or "0.0.0.0", self.port
+        )
+        port = server.sockets[0].getsockname()[1]
+        host = self.host if self.host not in ["", "0.0.0.0"] else socket.getfqdn()
+        _write_address_file(self.exp_dir, host, port, self.token)
+        logging.info(
+            f"Waiting for workers on {host}:{port}. Start them with "
+            f"'{os.path.join(self.exp_dir, WORKER_SCRIPT)}' on any machine "
+            f"that sees the experiment directory."
+        )
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            self._loop.add_signal_handler(sig, self._interrupt)
+        self._start_local_workers(port)
+        async with self._changed:
+            await self._changed.wait_for(self._is_done)
+        server.close()
+        # Let the workers that wait for a run know that we're done.
+        if self._handlers:
+            await asyncio.wait(list(self._handlers))
+        await server.wait_closed()
+        if self.status:
+            self.status.write(force=True)
+        return not self._errors
+
+    def run(self):
+        """Hand out all queued runs and return True iff all runs succeeded."""
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            return self._loop.run_until_complete(self._serve())
+        finally:
+            for sig in [signal.SIGINT, signal.SIGTERM]:
+                self._loop.remove_signal_handler(sig)
+            self._loop.close()
+            asyncio.set_event_loop(None)
+            tools.remove_path(os.path.join(self.exp_dir, WORK_QUEUE_FILENAME))
+            for process in self._local_processes:
+                if self._interrupted:
+                    process.terminate()
+                process.wait()
+
+
+class _Connection:
+    """Blocking connection from a worker to the coordinator."""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.reader = self.sock.makefile("rb")
+        # The heartbeat thread sends messages, too.
+        self.lock = threading.Lock()
+        # Time (see time.monotonic()) at which the current lease expires.
+        self.lease_expiry = 0
+
+    def send(self, message):
+        with self.lock:
+            self.sock.sendall(_encode(message))
+
+    def receive(self):
+        line = self.reader.readline()
+        return _decode(line) if line else None
+
+    def receive_ack(self, timeout):
+        """Wait at most *timeout* seconds for an acknowledgement. After
+        a timeout, the connection can't be used anymore."""
+        if timeout <= 0:
+            raise socket.timeout("lease expired")
+        self.sock.settimeout(timeout)
+        try:
+            message = self.receive()
+        finally:
+            self.sock.settimeout(None)
+        if message is None or message["type"] != "ack":
+            raise ValueError(f"expected acknowledgement, got {message}")
+
+    def renew_lease(self, lease):
+        """Send a heartbeat and extend the lease once it is acknowledged."""
+        sent = time.monotonic()
+        self.send({"type": "heartbeat"})
+        self.receive_ack(self.lease_expiry - time.monotonic())
+        self.lease_expiry = sent + lease
+
+    def has_lease(self):
+        return time.monotonic() < self.lease_expiry
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+def _send_heartbeats(connection, interval, lease, stop, call):
+    while not stop.wait(interval):
+        try:
+            connection.renew_lease(lease)
+        except (OSError, ValueError) as err:
+            # The coordinator hands out the run again.
+            logging.error(f"Lost lease for run ({err}) -> abort run")
+            connection.lease_expiry = 0
+            call._abort("interrupted")
+            return
+
+
+def _execute_run(exp_dir, message, connection, log):
+    """Execute the run described by *message* and append its properties
+    to the results log *log*. Return whether the run failed.
+
+    Raise OSError or ValueError if the worker lost its lease.
+    """
+    run_id = message["run_id"]
+    run_dir = os.path.join(exp_dir, message["run_dir"])
+    lease = message["lease"]
+    # Start the lease before touching the run directory.
+    connection.lease_expiry = time.monotonic() + lease
+    connection.renew_lease(lease)
+    if runner.uses_runner(exp_dir):
+        if message["attempt"] > 1:
+            # Start from a fresh run directory.
+            tools.remove_path(run_dir)
+        tools.makedirs(run_dir)
+        cmd = [
+            tools.get_python_executable(),
+            os.path.join(exp_dir, runner.RUNNER_FILENAME),
+            str(run_id),
+        ]
+    else:
+        if message["attempt"] > 1:
+            local_executor.reset_run_dir(run_dir)
+        cmd = [tools.get_python_executable(), "run"]
+    logging.info(f"Starting run {run_id} in {message['run_dir']}")
+    driver_log = open(os.path.join(run_dir, "driver.log"), "w")
+    driver_err = open(os.path.join(run_dir, "driver.err"), "w")
+    call = Call(
+        cmd,
+        name="run",
+        cwd=run_dir,
+        stdout=driver_log,
+        stderr=driver_err,
+        properties_file=None,
+        limit_backend="rlimit",
+    )
+    stop = threading.Event()
+    heartbeats = threading.Thread(
+        target=_send_heartbeats,
+        args=(connection, message["heartbeat_interval"], lease, stop, call),
+        daemon=True,
+    )
+    heartbeats.start()
+    try:
+        returncode = call.wait()
+    finally:
+        stop.set()
+        heartbeats.join()
+    for f in [driver_log, driver_err]:
+        f.close()
+    if not connection.has_lease():
+        # Another worker may already execute the run.
+        raise OSError(f"lost lease for run {run_id}")
+    error = returncode != 0 or os.path.getsize(driver_err.name) != 0
+    for f in [driver_log, driver_err]:
+        if os.path.getsize(f.name) == 0:
+            os.remove(f.name)
+    connection.send(
+        {"type": "finished", "run_id": run_id, "returncode": returncode, "error": error}
+    )
+    connection.receive_ack(connection.lease_expiry - time.monotonic())
+    if call.kill_reason != "interrupted":
+        log.append_run(run_dir, attempt=message["attempt"], epoch=message["epoch"])
+    return error
+
+
+def run_worker(exp_dir, address=None):
+    """Execute runs of the experiment in *exp_dir* until the coordinator
+    has no runs left. Return True iff all runs succeeded.
+
+    *address* is ``"host:port"`` of the coordinator. By default, it is
+    read from the ``work-queue`` file.
+    """
+    host, port, token = read_address_file(exp_dir)
+    if address:
+        host, _, port = address.rpartition(":")
+    worker = f"{platform.node()}:{os.getpid()}"
+    try:
+        connection = _Connection(host, int(port))
+    except OSError as err:
+        logging.critical(f"Could not connect to coordinator at {host}:{port}: {err}")
+    log = results_log.ResultsLog(exp_dir)
+    success = True
+    try:
+        connection.send({"type": "hello", "worker": worker, "token": token})
+        while True:
+            message = connection.receive()
+            if message is None:
+                logging.error("Coordinator closed the connection")
+                return False
+            if message["type"] == "done":
+                return success
+            error = _execute_run(exp_dir, message, connection, log)
+            success = success and not error
+    except (OSError, ValueError) as err:
+        # E.g., the coordinator is gone or handed out our run again.
+        logging.error(f"Stopping worker: {err}")
+        return False
+    except KeyboardInterrupt:
+        logging.warning("Worker interrupted")
+        return False
+    finally:
+        connection.close()
+        log.close()
+
+
+def run_workers(exp_dir, processes=1, address=None):
+    """Execute runs with *processes* workers in parallel and return True
+    iff all runs succeeded."""
+    if processes == 1:
+        return run_worker(exp_dir, address)
+    cmd = [tools.get_python_executable(), os.path.join(exp_dir, WORKER_SCRIPT)]
+    if address:
+        cmd.extend(["--address", address])
+    workers = [subprocess.Popen(cmd, cwd=exp_dir) for _ in range(processes)]
+    try:
+        returncodes = [worker.wait() for worker in workers]
+    except KeyboardInterrupt:
+        # The workers received the signal, too.
+        for worker in workers:
+            worker.wait()
+        return False
+    return all(returncode == 0 for returncode in returncodes)
@@ -0,0 +1,636 @@
+import functools
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import types
+
+from downward.experiment import _AlgorithmSweep, _FastDownwardRunRecord
+from lab import runner, tools
+from lab.environments import (
+    LocalEnvironment,
+    LongestFirstTaskOrder,
+    ShortestFirstTaskOrder,
+    WorkQueueEnvironment,
+)
+from lab.experiment import (
+    Experiment,
+    get_run_dirs,
+    load_run_dir_index,
+    Run,
+    RunDirLayout,
+)
+from lab.fetcher import Fetcher
+from lab.local_executor import (
+    CoreAllocator,
+    LocalExecutor,
+    MemoryMonitor,
+    RUN_JOURNAL_FILENAME,
+)
+from lab.results_log import read_results_log, RESULTS_LOG_DIR
+from lab.status import (
+    format_prometheus,
+    read_status_file,
+    STATUS_FILENAME,
+    StatusFile,
+)
+from lab.work_queue import _Connection, Coordinator, read_address_file
+
+
+def _make_experiment(path, num_runs=250):
+    exp = Experiment(path)
+    exp.add_command("cleanup", ["echo", "done"])
+    for index in range(num_runs):
+        run = exp.add_run()
+        run.add_new_file("input", "input.txt", str(index))
+        run.add_command("solve", ["cat", "{input}"], time_limit=10)
+        run.set_property("id", ["algo", str(index)])
+    return exp
+
+
+def _get_tree(path):
+    tree = {}
+    for root, _, files in os.walk(path):
+        for filename in files:
+            abs_path = os.path.join(root, filename)
+            with open(abs_path) as f:
+                tree[os.path.relpath(abs_path, path)] = f.read()
+    return tree
+
+
+def test_parallel_build_matches_sequential_build(tmp_path):
+    sequential = _make_experiment(str(tmp_path / "sequential"))
+    sequential.build()
+    parallel = _make_experiment(str(tmp_path / "parallel"))
+    parallel.build(jobs=3)
+    sequential_tree = _get_tree(sequential.path)
+    parallel_tree = _get_tree(parallel.path)
+    assert sorted(sequential_tree) == sorted(parallel_tree)
+    for rel_path, content in sequential_tree.items():
+        if rel_path.endswith("properties") or rel_path == "run":
+            # Contain the absolute experiment path or the random task order.
+            continue
+        assert parallel_tree[rel_path] == content
+    assert os.path.isfile(os.path.join(parallel.path, "runs-00201-00300/00250/run"))
+
+
+def test_deduplicated_resources_are_hard_links(tmp_path):
+    resource = tmp_path / "solver.sh"
+    resource.write_text("#! /bin/sh\necho solved\n")
+    resource.chmod(0o755)
+    exp = Experiment(str(tmp_path / "exp"))
+    for index in range(3):
+        run = exp.add_run()
+        run.add_resource("solver", str(resource))
+        run.add_command("solve", ["{solver}"])
+        run.set_property("id", [str(index)])
+    exp.build(deduplicate_resources=True)
+    copies = [
+        os.path.join(exp.path, f"runs-00001-00100/{index:05d}/solver.sh")
+        for index in range(1, 4)
+    ]
+    assert len({os.stat(copy).st_ino for copy in copies}) == 1
+    assert os.stat(copies[0]).st_nlink == 4
+    assert os.access(copies[0], os.X_OK)
+
+
+def _make_incremental_experiment(path, values):
+    exp = Experiment(path)
+    for value in values:
+        run = exp.add_run()
+        run.add_command("solve", ["echo", value])
+        run.set_property("id", [value])
+    return exp
+
+
+def test_incremental_build_keeps_unchanged_runs(tmp_path):
+    path = str(tmp_path / "exp")
+    exp = _make_incremental_experiment(path, ["a", "b", "c"])
+    exp.build(incremental=True)
+    for run_dir in ["00001", "00002"]:
+        with open(os.path.join(path, "runs-00001-00100", run_dir, "driver.log"), "w"):
+            pass
+
+    # Add a new first run and change the commands of the second run.
+    exp = _make_incremental_experiment(path, ["new", "a", "b", "c"])
+    exp.runs[2].add_command("check", ["true"])
+    exp.build(incremental=True)
+    assert exp._get_run_ids_to_start() == [1, 3, 4]
+    # Run "a" was moved from 00001 to 00002 and kept its results.
+    assert os.path.exists(os.path.join(path, "runs-00001-00100/00002/driver.log"))
+    assert not os.path.exists(os.path.join(path, "runs-00001-00100/00003/driver.log"))
+    assert os.path.exists(os.path.join(path, "runs-00001-00100/00004/run"))
+    assert not os.path.exists(os.path.join(path, "runs-00001-00100/00005"))
+
+
+def test_incremental_build_rebuilds_runs_with_changed_link_mode(tmp_path):
+    resource = tmp_path / "input.txt"
+    resource.write_text("input\n")
+    path = str(tmp_path / "exp")
+    for hardlink in [False, True]:
+        exp = Experiment(path)
+        run = exp.add_run()
+        run.add_resource("input", str(resource), hardlink=hardlink)
+        run.add_command("solve", ["cat", "{input}"])
+        run.set_property("id", ["a"])
+        exp.build(incremental=True)
+    assert exp._get_run_ids_to_start() == [1]
+    copy = os.path.join(path, "runs-00001-00100/00001/input.txt")
+    assert os.stat(copy).st_ino == os.stat(resource).st_ino
+
+
+def test_compact_build_writes_indexed_run_specs(tmp_path):
+    exp = _make_experiment(str(tmp_path / "exp"), num_runs=150)
+    exp.build(compact=True)
+    assert not any(name.startswith("runs-") for name in os.listdir(exp.path))
+    spec = runner.read_run_spec(exp.path, 120)
+    assert spec["run_dir"] == "runs-00101-00200/00120"
+    assert spec["properties"]["id"] == ["algo", "119"]
+    assert spec["new_files"] == [["input.txt", "119", 0o644]]
+    assert [kwargs["name"] for _, kwargs in spec["calls"]] == ["solve", "cleanup"]
+    assert spec["calls"][0][0] == ["cat", "input.txt"]
+
+
+class _RunRecord:
+    __slots__ = ["experiment", "value"]
+
+    def __init__(self, experiment, value):
+        self.experiment = experiment
+        self.value = value
+
+    def _expand(self):
+        run = Run(self.experiment)
+        run.add_command("solve", ["echo", self.value])
+        run.set_property("id", [self.value])
+        return run
+
+
+def test_build_expands_run_records(tmp_path):
+    exp = Experiment(str(tmp_path / "exp"))
+    exp.add_command("cleanup", ["true"])
+    run = exp.add_run()
+    run.add_command("solve", ["echo", "regular"])
+    run.set_property("id", ["regular"])
+    for value in ["a", "b"]:
+        exp.add_run(_RunRecord(exp, value))
+    exp.build()
+    # Experiment commands are not copied into the runs.
+    assert list(run.commands) == ["solve"]
+    with open(os.path.join(exp.path, "runs-00001-00100/00003/run")) as f:
+        run_script = f.read()
+    assert "['echo', 'b']" in run_script
+    assert "name='cleanup'" in run_script
+
+
+def test_fast_downward_run_record_keeps_changes(tmp_path):
+    exp = Experiment(str(tmp_path / "exp"))
+    revision = types.SimpleNamespace(
+        repo="repo", local_rev="abc", global_rev="abc", summary="abc", build_options=[]
+    )
+    algo = types.SimpleNamespace(
+        name="astar",
+        cached_revision=revision,
+        driver_options=[],
+        component_options=[],
+        planner_command=["echo", "{domain}"],
+    )
+    task = types.SimpleNamespace(
+        domain="gripper",
+        problem="prob01.pddl",
+        domain_file="domain.pddl",
+        problem_file="prob01.pddl",
+        properties={"domain": "gripper", "problem": "prob01.pddl"},
+    )
+    exp.add_run(_FastDownwardRunRecord(exp, algo, task))
+    exp.runs[0].set_property("difficulty", "hard")
+    assert exp.runs[0].properties["difficulty"] == "hard"
+    assert exp.runs[0]._expand().properties["difficulty"] == "hard"
+
+
+def test_nested_run_dir_layout_and_index(tmp_path):
+    layout = RunDirLayout(shard_size=2, levels=2)
+    assert layout.get_run_dir(1) == "runs-00001-00004/runs-00001-00002/00001"
+    assert layout.get_run_dir(7) == "runs-00005-00008/runs-00007-00008/00007"
+    exp = Experiment(str(tmp_path / "exp"), run_dir_layout=layout)
+    for value in "abcde":
+        run = exp.add_run()
+        run.add_command("solve", ["echo", value])
+        run.set_property("id", [value])
+    exp.build()
+    index = load_run_dir_index(exp.path)
+    assert index["e"] == "runs-00005-00008/runs-00005-00006/00005"
+    assert len(get_run_dirs(exp.path)) == 5
+    assert os.path.isfile(os.path.join(exp.path, index["e"], "run"))
+
+
+def test_archived_build_extracts_single_run(tmp_path):
+    exp = Experiment(str(tmp_path / "exp"))
+    for value in ["a", "b", "c"]:
+        run = exp.add_run()
+        run.add_new_file("input", "input.txt", value)
+        run.add_command("solve", ["cat", "{input}"])
+        run.set_property("id", [value])
+    exp.build(archive=True)
+    assert not any(name.startswith("runs-") for name in os.listdir(exp.path))
+    assert runner.execute_run(exp.path, 2) == 0
+    run_dir = os.path.join(exp.path, "runs-00001-00100/00002")
+    with open(os.path.join(run_dir, "run.log")) as f:
+        assert f.read() == "b"
+    assert sorted(os.listdir(os.path.join(exp.path, "runs-00001-00100"))) == ["00002"]
+
+
+def test_hardlinked_resource_can_be_overwritten(tmp_path):
+    code = tmp_path / "code"
+    (code / "bin").mkdir(parents=True)
+    (code / "bin" / "solver").write_text("solver")
+    (code / "driver.py").write_text("cached driver")
+    patched_driver = tmp_path / "driver.py"
+    patched_driver.write_text("patched driver")
+    exp = Experiment(str(tmp_path / "exp"))
+    exp.add_resource("", str(code), "code", hardlink=True)
+    exp.add_resource("driver", str(patched_driver), "code/driver.py")
+    run = exp.add_run()
+    run.add_command("solve", ["{driver}"])
+    run.set_property("id", ["a"])
+    exp.build()
+    solver = os.path.join(exp.path, "code", "bin", "solver")
+    assert os.stat(solver).st_ino == (code / "bin" / "solver").stat().st_ino
+    with open(os.path.join(exp.path, "code", "driver.py")) as f:
+        assert f.read() == "patched driver"
+    assert (code / "driver.py").read_text() == "cached driver"
+
+
+def test_algorithm_sweep_expands_cross_product():
+    cached_revision = types.SimpleNamespace(name="rev")
+    sweep = _AlgorithmSweep(
+        "{h}-{w}",
+        cached_revision,
+        ["--search", "lazy_wastar([{h}()], w={w})"],
+        ["--overall-time-limit", "{w}m"],
+        {"h": {"add": "add", "landmarks": "lmcount"}, "w": [1, 5]},
+    )
+    algorithms = list(sweep)
+    assert len(sweep) == len(algorithms) == 4
+    assert [algo.name for algo in algorithms] == [
+        "add-1",
+        "add-5",
+        "landmarks-1",
+        "landmarks-5",
+    ]
+    assert algorithms[3].component_options == [
+        "--search",
+        "lazy_wastar([lmcount()], w=5)",
+    ]
+    assert algorithms[3].driver_options == ["--overall-time-limit", "5m"]
+    assert len(set(algorithms)) == 4
+
+
+def test_property_groups_are_stored_once(tmp_path):
+    exp = Experiment(str(tmp_path / "exp"))
+    for algo in ["astar", "gbfs"]:
+        for task in ["t1", "t2"]:
+            run = exp.add_run()
+            run.add_command("solve", ["echo", task])
+            run.set_property("id", [algo, task])
+            run.add_property_group({"algorithm": algo, "options": [algo, "--opt"]})
+    exp.build()
+    eval_dir = str(tmp_path / "eval")
+    Fetcher()(exp.path, eval_dir=eval_dir)
+    groups = tools.load_property_groups(eval_dir)
+    assert len(groups) == 2
+    props = tools.Properties(os.path.join(eval_dir, "properties"))
+    assert "options" not in props["gbfs-t2"]
+    tools.expand_property_groups(props, groups)
+    assert props["gbfs-t2"]["options"] == ["gbfs", "--opt"]
+    assert "property_groups" not in props["gbfs-t2"]
+
+
+def test_predicted_time_task_orders(tmp_path):
+    eval_dir = tmp_path / "eval"
+    eval_dir.mkdir()
+    props = tools.Properties(str(eval_dir / "properties"))
+    props.update({"a": {"planner_time": 5}, "b": {"planner_time": 50}, "c": {}})
+    props.write()
+    exp = _make_incremental_experiment(str(tmp_path / "exp"), ["a", "b", "c", "d"])
+    longest_first = LongestFirstTaskOrder(str(eval_dir))(exp, [1, 2, 3, 4])
+    assert sorted(longest_first[:2]) == [3, 4]
+    assert longest_first[2:] == [2, 1]
+    shortest_first = ShortestFirstTaskOrder(str(eval_dir))(exp, [1, 2, 3, 4])
+    assert shortest_first[:2] == [1, 2]
+
+
+def test_core_allocator_prefers_single_numa_node():
+    allocator = CoreAllocator([[0, 1, 2, 3], [4, 5, 6, 7]])
+    assert allocator.allocate(3) == [0, 1, 2]
+    assert allocator.allocate(2) == [4, 5]
+    assert allocator.allocate(4) is None
+    assert allocator.allocate(3) == [3, 6, 7]
+    allocator.release([0, 1, 2])
+    assert allocator.allocate(1) == [0]
+
+
+def test_local_executor_runs_tasks_in_order(tmp_path):
+    executor = LocalExecutor(processes=1)
+    for task_id, run_id in enumerate([2, 1], start=1):
+        run_dir = tmp_path / str(run_id)
+        run_dir.mkdir()
+        cmd = ["sh", "-c", f"echo {task_id} >> {tmp_path / 'order'}"]
+        executor.add_task(task_id, run_id, str(run_dir), cmd)
+    failing_dir = tmp_path / "3"
+    failing_dir.mkdir()
+    executor.add_task(3, 3, str(failing_dir), ["false"])
+    assert not executor.run()
+    assert (tmp_path / "order").read_text() == "1\n2\n"
+    assert not os.path.exists(tmp_path / "1" / "driver.err")
+
+
+def test_local_executor_writes_status(tmp_path):
+    status_file = StatusFile(str(tmp_path / STATUS_FILENAME), total=3)
+    executor = LocalExecutor(processes=1, status=status_file)
+    for run_id, cmd in enumerate([["true"], ["false"]], start=1):
+        run_dir = tmp_path / str(run_id)
+        run_dir.mkdir()
+        executor.add_task(run_id, run_id, str(run_dir), cmd)
+    assert not executor.run()
+    status = read_status_file(str(tmp_path / STATUS_FILENAME))
+    assert status["finished"] == 2
+    assert status["failed"] == 1
+    assert status["pending"] == 1
+    assert status["running"] == 0
+    assert status["eta"] is not None
+    assert 'lab_runs_failed{experiment="exp"} 1' in format_prometheus(status, "exp")
+
+
+def test_local_executor_respects_memory_budget(tmp_path):
+    executor = LocalExecutor(
+        processes=1, memory_monitor=MemoryMonitor(budget=4000, max_pressure=100)
+    )
+    executor.allocator = CoreAllocator([[0, 1, 2, 3]])
+    for run_id, memory in enumerate([3000, 2000, 1000, None], start=1):
+        executor.add_task(run_id, run_id, str(tmp_path), ["true"], memory=memory)
+    executor.memory_monitor.min_available = 0
+    started = []
+    task = executor._pop_next_task()
+    while task:
+        started.append(task.run_id)
+        executor.memory_monitor.reserve(task.memory)
+        executor._running[task.run_id] = task
+        task = executor._pop_next_task()
+    # Run 2 doesn't fit next to run 1, but the smaller runs 3 and 4 do.
+    assert started == [1, 3, 4]
+    assert executor.memory_monitor.reserved == 4000
+
+
+def test_resume_skips_finished_runs(tmp_path):
+    exp = Experiment(
+        str(tmp_path / "exp"), environment=LocalEnvironment(processes=1)
+    )
+    for value in ["a", "b", "c"]:
+        run = exp.add_run()
+        run.add_command("solve", ["echo", value])
+        run.set_property("id", [value])
+    exp.build()
+    journal = os.path.join(exp.path, RUN_JOURNAL_FILENAME)
+    with open(journal, "w") as f:
+        # Run 2 was interrupted and the last line was cut off by the crash.
+        f.write("started 1\nstarted 2\nfinished 1 0 ok\nstarted 3\nfinish")
+    subprocess.check_call([sys.executable, "run", "--resume"], cwd=exp.path)
+    shard_dir = os.path.join(exp.path, "runs-00001-00100")
+    assert not os.path.exists(os.path.join(shard_dir, "00001", "run.log"))
+    for run_dir in ["00002", "00003"]:
+        assert os.path.exists(os.path.join(shard_dir, run_dir, "run.log"))
+    with open(journal) as f:
+        lines = f.read().splitlines()
+    assert sorted(lines[-4:]) == [
+        "finished 2 0 ok",
+        "finished 3 0 ok",
+        "started 2",
+        "started 3",
+    ]
+
+
+def test_in_process_run_executes_parsers(tmp_path):
+    parser = tmp_path / "value-parser.py"
+    parser.write_text(
+        "from lab.parser import Parser\n"
+        "parser = Parser()\n"
+        "parser.add_pattern('value', r'value (\\d+)', type=int)\n"
+        "parser.parse()\n"
+    )
+    exp = Experiment(str(tmp_path / "exp"))
+    exp.add_parser(str(parser))
+    for value in ["1", "2"]:
+        run = exp.add_run()
+        run.add_command("solve", ["echo", f"value {value}"])
+        run.set_property("id", [value])
+    exp.build(compact=True)
+    executor = LocalExecutor(processes=1)
+    for run_id in [1, 2]:
+        run_dir = os.path.join(exp.path, exp.run_dir_layout.get_run_dir(run_id))
+        os.makedirs(run_dir)
+        function = functools.partial(
+            runner.execute_run_in_process, exp.path, run_id, run_dir
+        )
+        executor.add_task(run_id, run_id, run_dir, function)
+    assert executor.run()
+    props = tools.Properties(
+        os.path.join(exp.path, "runs-00001-00100", "00002", "properties")
+    )
+    assert props["value"] == 2
+
+
+def test_run_supervisor_executes_commands_and_parsers(tmp_path):
+    parser = tmp_path / "value-parser.py"
+    parser.write_text(
+        "from lab.parser import Parser\n"
+        "parser = Parser()\n"
+        "parser.add_pattern('value', r'value (\\d+)', type=int)\n"
+        "parser.parse()\n"
+    )
+    exp = Experiment(
+        str(tmp_path / "exp"),
+        environment=LocalEnvironment(processes=1, supervisor=True),
+    )
+    exp.add_parser(str(parser))
+    for value in ["1", "2", "3"]:
+        run = exp.add_run()
+        run.add_command("solve", ["echo", f"value {value}"])
+        run.set_property("id", [value])
+    exp.build(compact=True)
+    subprocess.check_call([sys.executable, "run"], cwd=exp.path)
+    for run_id in [1, 2, 3]:
+        run_dir = os.path.join(exp.path, exp.run_dir_layout.get_run_dir(run_id))
+        props = tools.Properties(os.path.join(run_dir, "properties"))
+        assert props["value"] == run_id
+        assert props["solve_wall_time"] >= 0
+        with open(os.path.join(run_dir, "driver.log")) as f:
+            assert "solve exit code: 0" in f.read()
+        assert not os.path.exists(os.path.join(run_dir, "driver.err"))
+    status = read_status_file(os.path.join(exp.path, STATUS_FILENAME))
+    assert status["finished"] == 3
+    assert status["failed"] == 0
+
+
+def test_work_queue_environment_executes_runs_on_local_workers(tmp_path):
+    exp = Experiment(
+        str(tmp_path / "exp"), environment=WorkQueueEnvironment(local_workers=2)
+    )
+    for value in ["a", "b", "c", "d"]:
+        run = exp.add_run()
+        run.add_command("solve", ["echo", value])
+        run.set_property("id", [value])
+    exp.build()
+    subprocess.check_call([sys.executable, "run"], cwd=exp.path)
+    for run_id, value in enumerate(["a", "b", "c", "d"], start=1):
+        run_dir = os.path.join(exp.path, exp.run_dir_layout.get_run_dir(run_id))
+        with open(os.path.join(run_dir, "run.log")) as f:
+            assert f.read() == f"{value}\n"
+    with open(os.path.join(exp.path, RUN_JOURNAL_FILENAME)) as f:
+        assert f.read().count(" 0 ok\n") == 4
+    assert not os.path.exists(os.path.join(exp.path, "work-queue"))
+
+
+def test_work_queue_resume_clears_interrupted_runs(tmp_path):
+    exp = Experiment(
+        str(tmp_path / "exp"), environment=WorkQueueEnvironment(local_workers=1)
+    )
+    run = exp.add_run()
+    run.add_command("solve", ["echo", "a"])
+    run.set_property("id", ["a"])
+    exp.build()
+    run_dir = os.path.join(exp.path, exp.run_dir_layout.get_run_dir(1))
+    props = tools.Properties(os.path.join(run_dir, "properties"))
+    props["kill_reason"] = "interrupted"
+    props.write()
+    with open(os.path.join(run_dir, "run.err"), "w") as f:
+        f.write("stale error\n")
+    with open(os.path.join(exp.path, RUN_JOURNAL_FILENAME), "w") as f:
+        f.write("started 1\n")
+    subprocess.check_call([sys.executable, "run", "--resume"], cwd=exp.path)
+    props = tools.Properties(os.path.join(run_dir, "properties"))
+    assert "kill_reason" not in props
+    assert props["solve_wall_time"] >= 0
+    assert not os.path.exists(os.path.join(run_dir, "run.err"))
+
+
+def test_work_queue_hands_out_runs_of_lost_workers_again(tmp_path):
+    coordinator = Coordinator(str(tmp_path), heartbeat_timeout=0.5)
+    coordinator.add_task(1, 1, "runs/00001")
+    messages = []
+
+    def connect(token):
+        host, port, _ = read_address_file(str(tmp_path))
+        connection = _Connection(host, port)
+        connection.send({"type": "hello", "worker": "w", "token": token})
+        return connection
+
+    def work():
+        while not os.path.exists(tmp_path / "work-queue"):
+            time.sleep(0.01)
+        _, _, token = read_address_file(str(tmp_path))
+        try:
+            intruder = connect("wrong-token")
+            messages.append(intruder.receive())
+            # The first worker starts the run and loses its connection.
+            silent = connect(token)
+            messages.append(silent.receive())
+            silent.send({"type": "heartbeat"})
+            messages.append(silent.receive())
+            acked = time.monotonic()
+            silent.close()
+            worker = connect(token)
+            messages.append(worker.receive())
+            # The run is handed out again only after the lease expired.
+            messages.append(time.monotonic() - acked)
+            worker.send(
+                {"type": "finished", "run_id": 1, "returncode": 0, "error": False}
+            )
+            messages.append(worker.receive())
+            messages.append(worker.receive())
+            for connection in [intruder, worker]:
+                connection.close()
+        finally:
+            if len(messages) < 7:
+                # Don't let the coordinator wait forever.
+                os.kill(os.getpid(), signal.SIGTERM)
+
+    workers = threading.Thread(target=work)
+    workers.start()
+    assert coordinator.run()
+    workers.join()
+    intruder_reply, first_run, ack, second_run, delay, finish_ack, done = messages
+    assert intruder_reply is None
+    assert (first_run["run_id"], first_run["attempt"]) == (1, 1)
+    assert first_run["lease"] == 0.25
+    assert ack == finish_ack == {"type": "ack"}
+    assert (second_run["run_id"], second_run["attempt"]) == (1, 2)
+    assert delay > 0.4
+    assert done == {"type": "done"}
+
+
+def test_fetcher_reads_results_log_and_scans_missing_runs(tmp_path):
+    exp = Experiment(str(tmp_path / "exp"), environment=LocalEnvironment(processes=1))
+    for value in ["a", "b", "c"]:
+        run = exp.add_run()
+        run.add_command("solve", ["echo", value])
+        run.set_property("id", [value])
+    exp.build()
+    subprocess.check_call([sys.executable, "run"], cwd=exp.path)
+    logged_props = read_results_log(exp.path)
+    log_dir = os.path.join(exp.path, RESULTS_LOG_DIR)
+    (segment,) = os.listdir(log_dir)
+    assert sorted(props["id"] for props in logged_props.values()) == [
+        ["a"],
+        ["b"],
+        ["c"],
+    ]
+    # Records of earlier epochs lose even if their segment is read last,
+    # and later attempts win within an epoch.
+    with open(os.path.join(log_dir, segment)) as f:
+        (record,) = [line for line in f if '"id": ["a"]' in line]
+    stale = re.sub(r'"epoch": [0-9.e+]+', '"epoch": 0', record)
+    retried = record.replace('"attempt": 1', '"attempt": 2')
+    with open(os.path.join(log_dir, "zzz.jsonl"), "w") as f:
+        f.write(stale.replace('"id": ["a"]', '"id": ["stale"]'))
+    with open(os.path.join(log_dir, "000.jsonl"), "w") as f:
+        f.write(retried.replace('"id": ["a"]', '"id": ["retried"]'))
+    retried_props = read_results_log(exp.path)
+    assert [props["id"] for props in retried_props.values()].count(["retried"]) == 1
+    for name in ["zzz.jsonl", "000.jsonl"]:
+        os.remove(os.path.join(log_dir, name))
+    for run_id in [1, 2, 3]:
+        run_dir = os.path.join(exp.path, exp.run_dir_layout.get_run_dir(run_id))
+        props = tools.Properties(os.path.join(run_dir, "properties"))
+        props["rescanned"] = True
+        props.write()
+    # Drop the record of the third run and simulate a cut-off record.
+    with open(os.path.join(log_dir, segment)) as f:
+        lines = [line for line in f if '"id": ["c"]' not in line]
+    with open(os.path.join(log_dir, segment), "w") as f:
+        f.writelines(lines)
+        f.write('{"run_dir": ')
+    eval_dir = str(tmp_path / "eval")
+    Fetcher()(exp.path, eval_dir, merge=True)
+    props = tools.Properties(os.path.join(eval_dir, "properties"))
+    assert props["a"]["solve_wall_time"] >= 0
+    assert "rescanned" not in props["a"] and "rescanned" not in props["b"]
+    assert props["c"]["rescanned"]
+
+
+def test_durability_policy_skips_fsync_per_command(tmp_path):
+    exp = Experiment(str(tmp_path / "exp"), durability="run")
+    run = exp.add_run()
+    run.add_command("solve", ["echo", "solved"])
+    run.set_property("id", ["a"])
+    exp.build()
+    run_dir = os.path.join(exp.path, "runs-00001-00100", "00001")
+    with open(os.path.join(run_dir, "run")) as f:
+        assert "fsync=False" in f.read()
+    subprocess.check_call([sys.executable, "run"], cwd=run_dir)
+    with open(os.path.join(run_dir, "run.log")) as f:
+        assert f.read() == "solved\n"
+    spec = exp.runs[0]._get_run_spec(1)
+    assert spec["sync_output"]
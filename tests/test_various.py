@@ -1,7 +1,16 @@
 import datetime
+import io
 import os
+import signal
+import sys
+import threading
+import time
+
+import pytest
 
 from lab import tools
+from lab.calls import limits
+from lab.calls.call import Call
 
 
 base = os.path.join("/tmp", str(datetime.datetime.now()))
@@ -45,6 +54,20 @@ def test_copy_dir_to_dir():
     )
 
 
+def test_remove_path_in_background():
+    parent = os.path.join(base, "remove")
+    tree = os.path.join(parent, "tree")
+    for index in range(20):
+        os.makedirs(os.path.join(tree, f"runs-{index}", "run"))
+        open(os.path.join(tree, f"runs-{index}", "run", "file"), "w").close()
+    tools.remove_path(tree, background=True)
+    assert not os.path.exists(tree)
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+    assert os.listdir(parent) == []
+
+
 def test_colors():
     row = {"col 1": 0, "col 2": 0.5, "col 3": 1}
     expected_min_wins = {
@@ -60,3 +83,96 @@ def test_colors():
     assert tools.get_colors(row, True) == expected_min_wins
     assert tools.get_colors(row, False) == expected_max_wins
     assert tools.rgb_fractions_to_html_color(1, 0, 0.5) == "rgb(255,0,127)"
+
+
+def test_call_cuts_off_output_at_hard_limit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    script = "import sys\nwhile True: sys.stdout.write('x' * 1024)\n"
+    with open(tmp_path / "run.log", "w") as run_log:
+        run_log.write("header\n")
+        retcode = Call(
+            [sys.executable, "-c", script],
+            name="writer",
+            stdout=run_log,
+            hard_stdout_limit=10,
+        ).wait()
+        run_log.write("footer\n")
+    assert retcode == -signal.SIGKILL
+    content = (tmp_path / "run.log").read_text()
+    assert content == "header\n" + "x" * 10 * 1024 + "footer\n"
+
+
+def test_call_copies_pipe_output_without_splitting_characters():
+    script = "import sys\nsys.stdout.buffer.write('\u00e4'.encode() * 100000)\n"
+    output = io.StringIO()
+    Call(
+        [sys.executable, "-c", script],
+        name="writer",
+        stdout=output,
+        properties_file=None,
+    ).wait()
+    assert output.getvalue() == "\u00e4" * 100000
+
+
+def test_call_writes_resource_usage_to_properties(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    script = "data = bytearray(50 * 1024 * 1024)\nsum(range(10 ** 6))\n"
+    Call([sys.executable, "-c", script], name="solve").wait()
+    props = tools.Properties("properties")
+    assert props["solve_peak_rss"] > 50 * 1024
+    assert props["solve_cpu_time"] > 0
+    assert props["solve_wall_time"] > 0
+    assert props["solve_voluntary_context_switches"] >= 0
+    assert props["solve_block_writes"] >= 0
+
+
+def test_limit_backend_falls_back_to_rlimit(tmp_path, monkeypatch):
+    # A cgroup v2 hierarchy without delegated controllers.
+    (tmp_path / "cgroup.controllers").write_text("cpu memory\n")
+    monkeypatch.setattr(limits, "CGROUP_ROOT", str(tmp_path))
+    limits.get_cgroup_parent.cache_clear()
+    try:
+        assert limits.get_cgroup_parent() is None
+        backend = limits.get_limit_backend("auto", "solve", 10, 100)
+        assert isinstance(backend, limits.RlimitBackend)
+        with pytest.raises(SystemExit):
+            limits.get_limit_backend("cgroup", "solve", 10, 100)
+    finally:
+        limits.get_cgroup_parent.cache_clear()
+
+
+def test_call_enforces_memory_limit_with_rlimit():
+    script = "data = bytearray(200 * 1024 * 1024)\n"
+    call = Call(
+        [sys.executable, "-c", script],
+        name="solve",
+        memory_limit=100,
+        limit_backend="rlimit",
+        stderr=io.StringIO(),
+        properties_file=None,
+    )
+    assert call.wait() != 0
+
+
+def test_call_aborts_process_group_at_wall_clock_limit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    call = Call(["sh", "-c", "sleep 60 & wait"], name="solve", time_limit=10)
+    call.wall_clock_time_limit = 0.5
+    assert call.wait() == -15
+    assert call.wall_time < 5
+    assert tools.Properties("properties")["solve_kill_reason"] == "wall_clock_time_limit"
+
+
+def test_call_kills_leftover_children():
+    # The background process inherits the pipe for stdout.
+    output = io.StringIO()
+    start = time.monotonic()
+    call = Call(
+        ["sh", "-c", "sleep 60 & echo $!"],
+        name="solve",
+        stdout=output,
+        properties_file=None,
+    )
+    assert call.wait() == 0
+    assert time.monotonic() - start < 5
+    assert call.kill_reason is None